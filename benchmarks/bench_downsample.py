@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+'''
+Throughput (images/s) of the FFT downsampling engine against the
+original one-image-at-a-time implementation.
+
+python benchmarks/bench_downsample.py --size 4096 --num 16 --height 512
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src',
+                    'cryoem-viz'))
+
+from utils.fft import Downsampler, available_backends  # noqa: E402
+
+
+def setupParserOptions():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--size',
+                    type=int,
+                    default=4096,
+                    help='Edge length of the square test images.')
+    ap.add_argument('--num',
+                    type=int,
+                    default=16,
+                    help='Number of images in the stack.')
+    ap.add_argument('--height',
+                    type=int,
+                    default=512,
+                    help='Height of the downsampled images.')
+    ap.add_argument('--workers',
+                    type=int,
+                    default=None,
+                    help='Threads for backends that support them.')
+    args = vars(ap.parse_args())
+    return args
+
+
+def downsample_reference(img, height):
+    '''The original utils.downsample.'''
+    m, n = img.shape[-2:]
+    ds_factor = m / height
+    width = int(n / ds_factor / 2) * 2
+    F = np.fft.rfft2(img)
+    A = F[..., 0:height // 2, 0:width // 2 + 1]
+    B = F[..., -height // 2:, 0:width // 2 + 1]
+    F = np.concatenate([A, B], axis=0)
+    f = np.fft.irfft2(F, s=(height, width))
+    return f
+
+
+def timeit(func, stack):
+    t0 = time.perf_counter()
+    out = func(stack)
+    return time.perf_counter() - t0, out
+
+
+def main(**args):
+    rng = np.random.default_rng(0)
+    stack = rng.standard_normal(
+        (args['num'], args['size'], args['size'])).astype(np.float32)
+    height = args['height']
+
+    t, ref = timeit(
+        lambda s: np.stack([downsample_reference(i, height) for i in s]),
+        stack)
+    print('%-10s %8.2f images/s' % ('reference', len(stack) / t))
+
+    for backend in available_backends():
+        ds = Downsampler(stack.shape, height, backend=backend,
+                         workers=args['workers'])
+        ds(stack[:1])  # warm up plans and buffers
+        t, out = timeit(ds, stack)
+        err = np.abs(out - ref).max() / (np.abs(ref).max() + 1e-12)
+        print('%-10s %8.2f images/s  (max rel. diff %.1e)' %
+              (backend, len(stack) / t, err))
+
+
+if __name__ == '__main__':
+    args = setupParserOptions()
+    main(**args)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+'''
+Browser render time and interaction latency of starviz scatter plots drawn
+with SVG (go.Scatter) and WebGL (go.Scattergl).
+Writes one page per point count and mode into --odir, and an index.html
+that loads them one after the other and tabulates, per page:
+
+  render  ms from navigation start until the plot is first painted
+  zoom    median ms of a change of the x range until painted
+  hover   median ms of a hover on a point until painted
+
+Open index.html in the browser to run the measurements.
+
+python benchmarks/bench_render.py --points 1000 10000 50000 200000 1000000
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src',
+                    'cryoem-viz'))
+
+from starviz import plot_scatter  # noqa: E402
+
+MEASURE = '''
+var gd = document.getElementById('{plot_id}');
+var name = window.location.pathname.split('/').pop();
+
+function painted() {
+    return new Promise(function (resolve) {
+        requestAnimationFrame(function () { setTimeout(resolve, 0); });
+    });
+}
+
+async function median(action, n) {
+    var t = [];
+    for (var i = 0; i < n; i++) {
+        var t0 = performance.now();
+        await action(i);
+        await painted();
+        t.push(performance.now() - t0);
+    }
+    t.sort(function (a, b) { return a - b; });
+    return t[Math.floor(n / 2)];
+}
+
+(async function () {
+    await painted();
+    var render = performance.now();
+    var r = gd._fullLayout.xaxis.range.slice();
+    var zoom = await median(function (i) {
+        var w = (r[1] - r[0]) * (i % 2 ? 1 : 0.5);
+        return Plotly.relayout(gd, {'xaxis.range': [r[0], r[0] + w]});
+    }, 10);
+    var hover = await median(function (i) {
+        Plotly.Fx.hover(gd, [{curveNumber: 0, pointNumber: i}]);
+        return Promise.resolve();
+    }, 10);
+    var result = {name: name, render: render, zoom: zoom, hover: hover};
+    console.log(JSON.stringify(result));
+    window.parent.postMessage(result, '*');
+})();
+'''
+
+INDEX = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>starviz render benchmark</title></head>
+<body>
+<table border="1" cellpadding="4" id="results">
+<tr><th>points</th><th>mode</th><th>html (MB)</th><th>write (s)</th>
+<th>render (ms)</th><th>zoom (ms)</th><th>hover (ms)</th></tr>
+</table>
+<iframe id="page" width="800" height="800"></iframe>
+<script>
+var cases = %s;
+var k = 0, timer = null;
+
+function row(c, r) {
+    var tr = document.createElement('tr');
+    [c.points, c.mode, c.mb.toFixed(1), c.write.toFixed(2),
+     r ? r.render.toFixed(0) : 'timeout',
+     r ? r.zoom.toFixed(1) : '', r ? r.hover.toFixed(1) : ''
+    ].forEach(function (v) {
+        var td = document.createElement('td');
+        td.textContent = v;
+        tr.appendChild(td);
+    });
+    document.getElementById('results').appendChild(tr);
+}
+
+function next(r) {
+    clearTimeout(timer);
+    if (k > 0) row(cases[k - 1], r);
+    if (k == cases.length) {
+        document.getElementById('page').remove();
+        return;
+    }
+    document.getElementById('page').src = cases[k++].file;
+    timer = setTimeout(function () { next(null); }, %d);
+}
+
+window.addEventListener('message', function (e) { next(e.data); });
+next();
+</script>
+</body>
+</html>
+'''
+
+
+def setupParserOptions():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--points',
+                    type=int,
+                    nargs='+',
+                    default=[1000, 10000, 50000, 200000, 1000000],
+                    help='Numbers of points to plot.')
+    ap.add_argument('-o',
+                    '--odir',
+                    default='bench_render',
+                    help='Output directory. Default is bench_render.')
+    ap.add_argument('--timeout',
+                    type=float,
+                    default=120.,
+                    help='Seconds before a page is given up on.')
+    args = vars(ap.parse_args())
+    return args
+
+
+def particles(n):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'rlnCoordinateX': rng.random(n) * 4000,
+        'rlnCoordinateY': rng.random(n) * 4000,
+        'rlnAutopickFigureOfMerit': rng.random(n),
+    })
+
+
+def main(**args):
+    odir = args['odir']
+    os.makedirs(odir, exist_ok=True)
+    cases = []
+    for n in args['points']:
+        df = particles(n)
+        for mode in ('svg', 'webgl'):
+            fname = '%s-%d.html' % (mode, n)
+            t0 = time.perf_counter()
+            fig = plot_scatter(df, 'rlnCoordinateX', 'rlnCoordinateY', True,
+                               render=mode)
+            fig.write_html(os.path.join(odir, fname),
+                           include_plotlyjs='directory',
+                           post_script=MEASURE)
+            t = time.perf_counter() - t0
+            mb = os.path.getsize(os.path.join(odir, fname)) / 2**20
+            cases.append(dict(file=fname, points=n, mode=mode, mb=mb,
+                              write=t))
+            print('%-6s %8d points: %6.1f MB written in %.2f s' %
+                  (mode, n, mb, t))
+    with open(os.path.join(odir, 'index.html'), 'w') as f:
+        f.write(INDEX % (json.dumps(cases), args['timeout'] * 1000))
+    print('Open %s in a browser to measure.' %
+          os.path.join(odir, 'index.html'))
+
+
+if __name__ == '__main__':
+    args = setupParserOptions()
+    main(**args)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+'''
+Time and memory of reading the numeric columns of a particle STAR file:
+starfile.read followed by select_dtypes (what the starviz tools did)
+against the column-projected utils.star.read_block.
+Each reader runs in a fresh process so peak RSS is comparable.
+
+python benchmarks/bench_star_columns.py --rows 1000000
+python benchmarks/bench_star_columns.py -i run_data.star
+'''
+
+import os
+import sys
+import time
+import resource
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src',
+                    'cryoem-viz'))
+
+import starfile  # noqa: E402
+from utils.star import read_block  # noqa: E402
+
+
+def setupParserOptions():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i',
+                    '--input',
+                    default=None,
+                    help='Particle star file to read. Default is a\
+                         generated one.')
+    ap.add_argument('--rows',
+                    type=int,
+                    default=1000000,
+                    help='Rows of the generated particle file.')
+    args = vars(ap.parse_args())
+    return args
+
+
+def particles(rows):
+    rng = np.random.default_rng(0)
+    mics = np.array(
+        ['MotionCorr/job002/Movies/mic_%05d.mrc' % i for i in range(1000)])
+    return pd.DataFrame({
+        'rlnCoordinateX': rng.random(rows) * 4000,
+        'rlnCoordinateY': rng.random(rows) * 4000,
+        'rlnImageName': np.char.add(
+            np.char.zfill(np.arange(rows).astype(str), 6),
+            '@Extract/job008/Movies/mic.mrcs'),
+        'rlnMicrographName': mics[rng.integers(0, len(mics), rows)],
+        'rlnDefocusU': rng.random(rows) * 20000 + 5000,
+        'rlnDefocusV': rng.random(rows) * 20000 + 5000,
+        'rlnAngleRot': rng.random(rows) * 360 - 180,
+        'rlnAngleTilt': rng.random(rows) * 180,
+        'rlnAnglePsi': rng.random(rows) * 360 - 180,
+        'rlnClassNumber': rng.integers(1, 5, rows),
+        'rlnOpticsGroup': np.ones(rows, dtype=int),
+    })
+
+
+def make_particles(path, rows):
+    starfile.write({'particles': particles(rows)}, path, overwrite=True)
+
+
+def _starfile(path):
+    return starfile.read(path, always_dict=True)['particles'].select_dtypes(
+        include='number')
+
+
+def _projected(path):
+    return read_block(path, 'particles', numeric=True)
+
+
+def measure(reader, path):
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    df = reader(path)
+    t = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return t, (peak - base) / 1024., df.shape
+
+
+def main(**args):
+    path = args['input']
+    if path is None:
+        path = 'bench_particles_%d.star' % args['rows']
+        if not os.path.exists(path):
+            print('Writing %s....' % path)
+            make_particles(path, args['rows'])
+
+    print('%-12s %10s %14s %s' % ('reader', 'time (s)', 'peak RSS (MB)',
+                                   'shape'))
+    for name, reader in (('starfile', _starfile), ('projected',
+                                                   _projected)):
+        with ProcessPoolExecutor(1) as ex:
+            t, mem, shape = ex.submit(measure, reader, path).result()
+        print('%-12s %10.2f %14.1f %s' % (name, t, mem, shape))
+
+
+if __name__ == '__main__':
+    args = setupParserOptions()
+    main(**args)
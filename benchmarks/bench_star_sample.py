@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+'''
+Time of a subset of a particle STAR file: the full read followed by
+DataFrame.sample (what the tools did) against utils.star.sample_star,
+which only parses the sampled rows. The sidecar cache is disabled.
+
+python benchmarks/bench_star_sample.py --rows 2000000 --subset 0.01
+'''
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src',
+                    'cryoem-viz'))
+os.environ['CRYOEM_VIZ_STAR_CACHE'] = '0'
+
+from utils.star import read_star, sample_star  # noqa: E402
+from bench_star_columns import make_particles  # noqa: E402
+
+
+def setupParserOptions():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i',
+                    '--input',
+                    default=None,
+                    help='Particle star file to read. Default is a\
+                         generated one.')
+    ap.add_argument('--rows',
+                    type=int,
+                    default=2000000,
+                    help='Rows of the generated particle file.')
+    ap.add_argument('--subset',
+                    type=float,
+                    default=0.01,
+                    help='Fraction of the particles to take.')
+    args = vars(ap.parse_args())
+    return args
+
+
+def main(**args):
+    path = args['input']
+    if path is None:
+        path = 'bench_particles_%d.star' % args['rows']
+        if not os.path.exists(path):
+            print('Writing %s....' % path)
+            make_particles(path, args['rows'])
+    subset = args['subset']
+    n = len(read_star(path, 'particles', columns=['rlnClassNumber']))
+
+    readers = (
+        ('full + sample',
+         lambda: read_star(path, 'particles').sample(frac=subset)),
+        ('bernoulli', lambda: sample_star(path, 'particles', subset, seed=0)),
+        ('reservoir',
+         lambda: sample_star(path, 'particles', round(subset * n), seed=0)),
+        ('stratified', lambda: sample_star(
+            path, 'particles', subset, 'rlnMicrographName', seed=0)),
+    )
+    print('%-14s %10s %s' % ('reader', 'time (s)', 'rows'))
+    for name, reader in readers:
+        t0 = time.perf_counter()
+        df = reader()
+        print('%-14s %10.2f %d' % (name, time.perf_counter() - t0, len(df)))
+
+
+if __name__ == '__main__':
+    args = setupParserOptions()
+    main(**args)
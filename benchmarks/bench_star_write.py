@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+'''
+Write time of a particle table with starfile.write against
+utils.star.write_star (plain and .gz). Each file is read back: string and
+integer columns must match exactly, the largest float error is reported.
+
+python benchmarks/bench_star_write.py --rows 1000000
+'''
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src',
+                    'cryoem-viz'))
+
+import starfile  # noqa: E402
+from utils.star import read_star, write_star  # noqa: E402
+from bench_star_columns import particles  # noqa: E402
+
+
+def setupParserOptions():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--rows',
+                    type=int,
+                    default=1000000,
+                    help='Rows of the particle table.')
+    args = vars(ap.parse_args())
+    return args
+
+
+def compare(back, df):
+    '''Largest float error of back against df, None on any other mismatch.'''
+    if list(back.columns) != list(df.columns) or len(back) != len(df):
+        return None
+    err = 0.
+    for c in df.columns:
+        a, b = back[c].to_numpy(), df[c].to_numpy()
+        if b.dtype.kind == 'f':
+            err = max(err, float(np.abs(a - b).max()))
+        elif not (a.astype(str) == b.astype(str)).all():
+            return None
+    return err
+
+
+def main(**args):
+    df = particles(args['rows'])
+    blocks = {
+        'optics':
+        pd.DataFrame({
+            'rlnOpticsGroupName': ['opticsGroup1'],
+            'rlnOpticsGroup': [1],
+            'rlnVoltage': [300.]
+        }),
+        'particles':
+        df
+    }
+
+    writers = (
+        ('starfile', 'a.star',
+         lambda b, p: starfile.write(b, p, overwrite=True)),
+        ('write_star', 'b.star', write_star),
+        ('write_star gz', 'c.star.gz', write_star),
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        print('%-14s %10s %10s %s' % ('writer', 'time (s)', 'size (MB)',
+                                       'max float error'))
+        for name, fname, writer in writers:
+            path = os.path.join(tmp, fname)
+            t0 = time.perf_counter()
+            writer(blocks, path)
+            t = time.perf_counter() - t0
+            back = read_star(path, 'particles', cache=False)
+            err = compare(back, df)
+            print('%-14s %10.2f %10.1f %s' %
+                  (name, t, os.path.getsize(path) / 2**20,
+                   'mismatch' if err is None else '%.3g' % err))
+
+
+if __name__ == '__main__':
+    args = setupParserOptions()
+    main(**args)
@@ -4,6 +4,8 @@ import os
 import glob
 import argparse
 from PIL import Image
+from utils.batch import run_batch, succeeded
+from utils.manifest import OutputIndex
 
 
 def setupParserOptions():
@@ -19,6 +21,11 @@ def setupParserOptions():
                     default=False,
                     action="store_true",
                     help='Skip the files already converted.')
+    ap.add_argument('--threads',
+                    type=int,
+                    default=None,
+                    help='Number of processes for conversion.\
+             Default is None, using os.cpu_count().')
     args = vars(ap.parse_args())
     return args
 
@@ -27,25 +34,30 @@ def is_eps(filename):
     return filename.endswith(('.eps'))
 
 
-def is_done(filename, odir):
-    oname = os.path.splitext(os.path.basename(filename))[0] + '.png'
-    return oname in os.listdir(odir)
+def output_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0] + '.png'
 
 
 def eps2png(img_eps, odir):
     im = Image.open(img_eps)
     fig = im.convert('RGBA')
-    oname = img_eps[:-4] + '.png'
-    fig.save(os.path.join(odir, oname), lossless=True)
+    fig.save(os.path.join(odir, output_name(img_eps)), lossless=True)
 
 
 def main(**args):
-    for f in glob.glob(args['input']):
-        if is_eps(f):
-            if args['skipdone'] and is_done(f, args['odir']):
-                pass
-            else:
-                eps2png(f, args['odir'])
+    index = OutputIndex(args['odir'])
+    files = [f for f in glob.glob(args['input']) if is_eps(f)]
+    todo = [
+        f for f in files
+        if not (args['skipdone'] and index.is_done(f, output_name(f)))
+    ]
+    summary = run_batch(eps2png, ((f, args['odir']) for f in todo),
+                        workers=args['threads'],
+                        skipped=len(files) - len(todo))
+    for f in succeeded(summary):
+        index.record(f, output_name(f))
+    index.save()
+    return summary
 
 
 if __name__ == '__main__':
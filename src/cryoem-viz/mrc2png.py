@@ -5,13 +5,13 @@ The output png files will have height as 512 px (default)
 and h/w ratio will be kept.
 '''
 
-import mrcfile
 import os
 import glob
-from utils.utils import downsample
+from utils.utils import to_image
+from utils.cache import get_cache, load_downsampled
 import argparse
-from PIL import Image
-import multiprocessing as mp
+from utils.batch import run_batch, succeeded
+from utils.manifest import OutputIndex
 
 
 def setupParserOptions():
@@ -38,8 +38,20 @@ def setupParserOptions():
                     type=int,
                     default=None,
                     help='Number of threads for conversion.\
-             Default is None, using mp.cpu_count().\
+             Default is None, using os.cpu_count().\
                  If get memory error, set it to a reasonable number.')
+    ap.add_argument('--fft_backend',
+                    default='numpy',
+                    help='FFT backend for downsampling, `numpy` or `scipy`.\
+             Default is numpy.')
+    ap.add_argument('--cache',
+                    default=None,
+                    help='Directory of the downsampled image cache.\
+             Default is $CRYOEM_VIZ_CACHE, no caching if unset.')
+    ap.add_argument('--cache_size',
+                    type=float,
+                    default=10.,
+                    help='Size limit of the cache in GB. Default is 10.')
     args = vars(ap.parse_args())
     return args
 
@@ -48,49 +60,32 @@ def is_mrc(filename):
     return filename.endswith(('.mrc'))
 
 
-def is_done(filename, odir):
-    oname = os.path.splitext(os.path.basename(filename))[0] + '.png'
-    return oname in os.listdir(odir)
-
-
-def scale_image(img, height):
-    newImg = downsample(img, height)
-    newImg = ((newImg - newImg.min()) /
-              ((newImg.max() - newImg.min()) + 1e-7) * 255)
-    newImg = Image.fromarray(newImg).convert('L')
-    return newImg
+def output_name(filename, prefix=''):
+    return os.path.splitext(prefix + os.path.basename(filename))[0] + '.png'
 
 
-def save_image(mrc_name, odir, height, skipdone, prefix):
-    if is_mrc(mrc_name):  # check if file is mrc
-        if skipdone and is_done(mrc_name, odir):
-            pass
-        else:
-            try:
-                micrograph = mrcfile.open(mrc_name, permissive=True).data
-                micrograph = micrograph.reshape(
-                    (micrograph.shape[-2], micrograph.shape[-1]))
-                newImg = scale_image(micrograph, height)
-                newImg.save(
-                    os.path.join(
-                        odir,
-                        os.path.splitext(prefix +
-                                         os.path.basename(mrc_name))[0] +
-                        '.png'))
-            except ValueError:
-                print('An error occured when trying to save ', mrc_name)
-                pass
-    else:
-        pass
+def save_image(mrc_name, odir, height, prefix, backend='numpy', cache=None):
+    newImg = to_image(load_downsampled(mrc_name, height, cache, backend)[0])
+    newImg.save(os.path.join(odir, output_name(mrc_name, prefix)))
 
 
 def mrc2png(**args):
-    threads = mp.cpu_count() if args['threads'] is None else args['threads']
-    with mp.Pool(threads) as pool:
-        print('Processing in %d parallel threads....' % threads)
-        pool.starmap(save_image, ((mrc_name, args['odir'], args['height'],
-                                   args['skipdone'], args['prefix'])
-                                  for mrc_name in glob.glob(args['input'])))
+    cache = get_cache(args['cache'], args['cache_size'])
+    index = OutputIndex(args['odir'], params=dict(height=args['height']))
+    files = [f for f in glob.glob(args['input']) if is_mrc(f)]
+    todo = [
+        f for f in files if not (args['skipdone'] and index.is_done(
+            f, output_name(f, args['prefix'])))
+    ]
+    summary = run_batch(save_image,
+                        ((f, args['odir'], args['height'], args['prefix'],
+                          args['fft_backend'], cache) for f in todo),
+                        workers=args['threads'],
+                        skipped=len(files) - len(todo))
+    for f in succeeded(summary):
+        index.record(f, output_name(f, args['prefix']))
+    index.save()
+    return summary
 
 
 if __name__ == '__main__':
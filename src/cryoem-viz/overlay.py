@@ -2,17 +2,88 @@
 '''
 INPUT: mrc and star file (coords) with the same file name.
 OUTPUT: html. Save in odir.
+With --batch, every coordinate star file of a glob is paired with its
+micrograph by name and all overlays are rendered in one process pool.
+Micrographs with the same base name would write the same overlay, all
+but the first are reported and skipped.
 '''
 
 import os
-import starfile
-import mrcfile
+import glob
+import numpy as np
 import pandas as pd
 import argparse
 import plotly.express as px
-import plotly.graph_objects as go
 
 from utils.utils import downsample
+from utils.cache import get_cache, load_downsampled
+from utils.batch import run_batch, print_timings
+from utils.manifest import OutputIndex
+from utils.star import read_star
+from utils.html import PLOTLYJS_MODES, bundle, write_figure, write_index
+from utils.plotting import RENDER_MODES, WEBGL_THRESHOLD, scatter_type
+from utils import tiles
+
+# Outputs of a batch between saves of the manifest.
+SAVE_EVERY = 50
+
+# uid of the trace of the picks with --continuous.
+PICKS = 'picks'
+
+# Continuous threshold slider of the picks trace, found by its uid. The
+# picks are sorted by their merit (customdata), so the picks above a
+# threshold are a suffix.
+THRESHOLD = '''
+var gd = document.getElementById('{plot_id}');
+(function () {
+    var k = gd.data.findIndex(function (d) { return d.uid === '@PICKS@'; });
+    // The arrays as plotly.js decoded them.
+    var t = gd._fullData.filter(function (d) { return d.index === k; })[0];
+    var full = {x: t.x, y: t.y, customdata: t.customdata};
+    var merit = full.customdata, n = merit.length;
+    var lo = n ? merit[0] : 0, hi = n ? merit[n - 1] : 1;
+    var box = document.createElement('div');
+    box.style.padding = '4px 10px';
+    box.innerHTML = 'Threshold: <input type="range" style="width: 60%;">' +
+        ' <span></span>';
+    gd.parentNode.insertBefore(box, gd);
+    var input = box.querySelector('input');
+    var label = box.querySelector('span');
+    input.min = lo;
+    input.max = hi;
+    input.step = (hi - lo) / 1000 || 1;
+    input.value = lo;
+
+    // First pick with a merit of at least v.
+    function first(v) {
+        var a = 0, b = n;
+        while (a < b) {
+            var m = (a + b) >> 1;
+            if (merit[m] < v) a = m + 1; else b = m;
+        }
+        return a;
+    }
+
+    var pending = false;
+    function update() {
+        pending = false;
+        var v = +input.value, i = v <= lo ? 0 : first(v);
+        label.textContent = v.toFixed(3) + ' (' + (n - i) + ' picks)';
+        Plotly.restyle(gd, {
+            x: [full.x.slice(i)],
+            y: [full.y.slice(i)],
+            customdata: [full.customdata.slice(i)]
+        }, [k]);
+    }
+    input.oninput = function () {
+        if (!pending) {
+            pending = true;
+            requestAnimationFrame(update);
+        }
+    };
+    label.textContent = lo.toFixed(3) + ' (' + n + ' picks)';
+})();
+'''.replace('@PICKS@', PICKS)
 
 
 def setupParserOptions():
@@ -36,10 +107,12 @@ def setupParserOptions():
                     action="store_true",
                     help='Skip the files already converted.')
     ap.add_argument('--height',
+                    type=int,
                     default=600,
                     help="Height of the scaled image. Default is 600.")
     ap.add_argument(
         '--binnum',
+        type=int,
         default=20,
         help="Number of bins for the merit slide bar. Default is 20.")
     ap.add_argument(
@@ -47,32 +120,118 @@ def setupParserOptions():
         default='rlnAutopickFigureOfMerit',
         help="Attributes to for the filtering slider.\
              Default is rlnAutopickFigureOfMerit.")
+    ap.add_argument('--continuous',
+                    default=False,
+                    action="store_true",
+                    help='Threshold the picks by --level with a continuous\
+             slider over one trace sorted by it, instead of\
+             --binnum traces. The html is about the same size,\
+             each pick is in one of the --binnum traces as well.')
+    ap.add_argument('--render',
+                    default='auto',
+                    choices=RENDER_MODES,
+                    help='Draw the scatter points with svg or webgl.\
+             Default is auto, webgl above %d points.' % WEBGL_THRESHOLD)
+    ap.add_argument('--compress',
+                    default=False,
+                    action="store_true",
+                    help='Write the plot data as float32/uint8 binary\
+             arrays deflated with zlib, decoded in the browser.\
+             Smaller html, needs a recent browser.')
+    ap.add_argument('--plotlyjs',
+                    default='embed',
+                    choices=PLOTLYJS_MODES,
+                    help='How the pages load plotly.js: embed it in every\
+             html, write it once as plotly-<version>.min.js\
+             into the output directory (the pages then work\
+             offline next to it, and an index.html linking them\
+             is written), or load it from the cdn. Default is\
+             embed.')
+    ap.add_argument('--tiles',
+                    default=False,
+                    action="store_true",
+                    help='Write a tile pyramid of the full size micrograph\
+             next to the html, and load only the tiles needed at the\
+             current zoom instead of embedding the image at --height.')
+    ap.add_argument('--cache',
+                    default=None,
+                    help='Directory of the downsampled image cache.\
+             Default is $CRYOEM_VIZ_CACHE, no caching if unset.')
+    ap.add_argument('--cache_size',
+                    type=float,
+                    default=10.,
+                    help='Size limit of the cache in GB. Default is 10.')
+    ap.add_argument('--batch',
+                    default=None,
+                    help='Wildcard path of coordinate star files (e.g.\
+             "AutoPick/job010/Unaligned_Movies/*_autopick.star")\
+             rendered together, instead of -i and --star.')
+    ap.add_argument('--micdir',
+                    default=None,
+                    help='Directory searched (recursively) for the mrc\
+             micrographs of --batch. Default is the directory of\
+             each star file.')
+    ap.add_argument('--suffix',
+                    default='_autopick',
+                    help='Suffix of the star file names after the\
+             micrograph name, with --batch. Default is _autopick.')
+    ap.add_argument('--threads',
+                    type=int,
+                    default=None,
+                    help='Number of processes rendering overlays with\
+             --batch. Default is None, using os.cpu_count().')
 
     args = vars(ap.parse_args())
     return args
 
 
-def plot_overlay_picks(df, img, img_h, bin_num, level):
+def plot_overlay_picks(df,
+                       img,
+                       img_h,
+                       bin_num,
+                       level,
+                       factor=None,
+                       render='auto',
+                       pyramid=None,
+                       continuous=False):
+    '''
+    If factor is given, img is already downsampled to img_h
+    by that factor. With a tile pyramid (see utils.tiles) img is not
+    used and the figure is drawn without an image.
+    With continuous, the picks are one trace sorted by level and the
+    page needs the THRESHOLD script for its threshold slider.
+    '''
 
-    factor = img_h / img.shape[0]
-    # img_w = int(img.shape[1] * factor)
-    img = downsample(img, img_h)
+    if factor is None:
+        factor = img_h / img.shape[0]
+        # img_w = int(img.shape[1] * factor)
+        img = downsample(img, img_h)
 
-    a = df[level].to_numpy()
-    if (a[0] == a).all():
+    if continuous:
+        # One bin of the picks sorted by level.
+        df = df.iloc[np.argsort(df[level].to_numpy(), kind='stable')]
         bin_num = 1
+        dfs = ((None, df), )
+    else:
+        a = df[level].to_numpy()
+        if (a[0] == a).all():
+            bin_num = 1
 
-    out, bins = pd.cut(df[level], bin_num, retbins=True)
-    dfs = tuple(df.groupby(out))
+        out, bins = pd.cut(df[level], bin_num, retbins=True)
+        dfs = tuple(df.groupby(out))
 
     # BELOW: plot overlay
-    fig = px.imshow(img, binary_string=True)
+    if pyramid is None:
+        fig = px.imshow(img, binary_string=True)
+    else:
+        fig = tiles.figure(pyramid, factor)
+    Scatter = scatter_type(len(df), render)
 
     i = 1
     for df in dfs:
         df = df[1]
         fig.add_trace(
-            go.Scatter(
+            Scatter(
                 x=df['rlnCoordinateX'] * factor,
                 y=df['rlnCoordinateY'] * factor,
                 mode='markers',
@@ -83,17 +242,16 @@ def plot_overlay_picks(df, img, img_h, bin_num, level):
                     opacity=i / bin_num,
                     showscale=False,
                 ),
-                text=[
-                    '{:0.3f}'.format(i) for i in df[level]
-                ],
-                hovertemplate='%{text}',
+                customdata=df[level],
+                hovertemplate='%{customdata:.3f}',
                 name="",
                 showlegend=False,
+                uid=PICKS if continuous else None,
             ))
         i += 1
 
     merit_steps = []
-    for i in range(len(fig.data)):
+    for i in range(0 if continuous else len(fig.data)):
         step = dict(
             method="update",
             args=[
@@ -139,6 +297,10 @@ def plot_overlay_picks(df, img, img_h, bin_num, level):
             },
         ),
     ]
+    if continuous:
+        # The threshold slider is THRESHOLD, outside of the plot.
+        sliders = sliders[1:]
+        sliders[0]['pad']['t'] = 0
 
     fig.update_layout(
         sliders=sliders,
@@ -164,31 +326,182 @@ def plot_overlay_picks(df, img, img_h, bin_num, level):
     return fig
 
 
-def main(**args):
+def output_name(mic):
+    return 'ls-' + os.path.splitext(os.path.basename(mic))[0] + '.html'
+
 
-    if args['oname'] is None:
-        oname = 'ls-' + os.path.splitext(os.path.basename(
-            args['input']))[0] + '.html'
+def render_overlay(mic,
+                   star,
+                   odir,
+                   oname,
+                   img_h=600,
+                   bin_num=20,
+                   level='rlnAutopickFigureOfMerit',
+                   render='auto',
+                   compress=False,
+                   plotlyjs='embed',
+                   tiled=False,
+                   continuous=False,
+                   cache=None):
+    pyramid = None
+    if tiled:
+        img = None
+        pyramid, path = tiles.write_micrograph_pyramid(mic, odir, oname)
+        shape = (pyramid['height'], pyramid['width'])
     else:
-        oname = args['oname']
+        img, shape = load_downsampled(mic, img_h, cache)
+    df = read_star(star, 0)
+    factor = img_h / shape[0]
+    fig = plot_overlay_picks(df,
+                             img,
+                             img_h,
+                             bin_num,
+                             level,
+                             factor=factor,
+                             render=render,
+                             pyramid=pyramid,
+                             continuous=continuous)
+    scripts = []
+    if pyramid is not None:
+        scripts.append(tiles.viewer(pyramid, path, factor))
+    if continuous:
+        scripts.append(THRESHOLD)
+    post_script = '\n'.join(scripts) or None
+
+    # fig.show(config={'responsive': False})
+    # BELOW: save as html
+    write_figure(fig, os.path.join(odir, oname), compress, plotlyjs,
+                 post_script)
+
+
+def pair_micrographs(stars, micdir=None, suffix='_autopick'):
+    '''
+    (micrograph, star) pairs of the coordinate star files, and the star
+    files without a micrograph. The micrograph of <name><suffix>.star is
+    <name>.mrc, in micdir or next to the star file.
+    '''
+    found = {}
+    if micdir is not None:
+        for mic in glob.glob(os.path.join(micdir, '**', '*.mrc'),
+                             recursive=True):
+            found.setdefault(os.path.splitext(os.path.basename(mic))[0],
+                             mic)
+    pairs, missing = [], []
+    for star in stars:
+        name = os.path.splitext(os.path.basename(star))[0]
+        if suffix and name.endswith(suffix):
+            name = name[:-len(suffix)]
+        if micdir is None:
+            mic = os.path.join(os.path.dirname(star), name + '.mrc')
+            mic = mic if os.path.exists(mic) else None
+        else:
+            mic = found.get(name)
+        if mic is None:
+            missing.append(star)
+        else:
+            pairs.append((mic, star))
+    return pairs, missing
+
+
+def unique_outputs(pairs):
+    '''
+    The (micrograph, star) pairs with distinct output names, and the
+    others as (pair, the pair that already has its output name).
+    output_name only uses the base name of the micrograph, so micrographs
+    of the same name in different directories would overwrite each
+    other's overlay.
+    '''
+    owner, unique, clashes = {}, [], []
+    for pair in pairs:
+        oname = output_name(pair[0])
+        if oname in owner:
+            clashes.append((pair, owner[oname]))
+        else:
+            owner[oname] = pair
+            unique.append(pair)
+    return unique, clashes
+
+
+def main(**args):
+
     if args['odir'] is None:
         odir = './'
     else:
         odir = args['odir']
 
-    if args['skipdone'] and oname in os.listdir(odir):
-        pass
+    if args['batch'] is not None:
+        pairs, missing = pair_micrographs(sorted(glob.glob(args['batch'])),
+                                          args['micdir'], args['suffix'])
+        for star in missing:
+            print('No micrograph found for %s' % star)
+        pairs, clashes = unique_outputs(pairs)
+        for (mic, star), (first, _) in clashes:
+            print('Skipping %s: its output %s is already that of %s' %
+                  (star, output_name(mic), first))
+    else:
+        if args['oname'] is None:
+            oname = output_name(args['input'])
+        else:
+            oname = args['oname']
+        sources = [args['input'], args['star']]
+        pairs = [sources]
+
+    index = OutputIndex(odir,
+                        params=dict(height=args['height'],
+                                    binnum=args['binnum'],
+                                    level=args['level'],
+                                    render=args['render'],
+                                    compress=args['compress'],
+                                    plotlyjs=args['plotlyjs'],
+                                    tiles=args['tiles'],
+                                    continuous=args['continuous']))
+    cache = get_cache(args['cache'], args['cache_size'])
+    options = (args['height'], args['binnum'], args['level'],
+               args['render'], args['compress'], args['plotlyjs'],
+               args['tiles'], args['continuous'], cache)
+
+    if args['batch'] is None:
+        if args['skipdone'] and index.is_done(sources, oname):
+            return
+        # The index of the directory only changes with a new page.
+        reindex = oname not in index.existing
+        render_overlay(args['input'], args['star'], odir, oname, *options)
+        index.record(sources, oname)
+        summary = None
     else:
-        img = mrcfile.read(args['input'])
-        bin_num = args['binnum']
-        img_h = args['height']
-        df = starfile.read(args['star'])
-        level = args['level']
-        fig = plot_overlay_picks(df, img, img_h, bin_num, level)
-
-        # fig.show(config={'responsive': False})
-        # BELOW: save as html
-        fig.write_html(os.path.join(odir, oname))
+        reindex = True
+        todo = [(mic, star) for mic, star in pairs
+                if not (args['skipdone'] and index.is_done(
+                    [mic, star], output_name(mic)))]
+        if args['plotlyjs'] == 'directory':
+            # Written once before the workers share it.
+            bundle(odir)
+        mics = {star: mic for mic, star in todo}
+        done = []
+
+        # Recorded as they complete and saved every SAVE_EVERY outputs,
+        # so an interrupted batch keeps what it has done for --skipdone.
+        def record(r):
+            if r['ok']:
+                mic = mics[r['label']]
+                index.record([mic, r['label']], output_name(mic))
+                done.append(r['label'])
+                if len(done) % SAVE_EVERY == 0:
+                    index.save()
+
+        summary = run_batch(render_overlay,
+                            ((mic, star, odir, output_name(mic)) + options
+                             for mic, star in todo),
+                            workers=args['threads'],
+                            skipped=len(pairs) - len(todo),
+                            label=lambda task: task[1],
+                            callback=record)
+        print_timings(summary)
+    index.save()
+    if args['plotlyjs'] == 'directory' and reindex:
+        # From the listing of the OutputIndex, not another one.
+        write_index(odir, pages=index.existing)
+    return summary
 
 
 if __name__ == '__main__':
@@ -2,10 +2,11 @@
 
 import os
 import glob
-import mrcfile
 import argparse
-import numpy as np
 import matplotlib.pyplot as plt
+from utils.batch import run_batch, succeeded
+from utils.manifest import OutputIndex
+from utils.projection import project_volume
 
 
 def setupParserOptions():
@@ -21,6 +22,24 @@ def setupParserOptions():
                     default=False,
                     action="store_true",
                     help='Skip the files already converted.')
+    ap.add_argument('--mip',
+                    default=False,
+                    action="store_true",
+                    help='Also plot maximum intensity projections.')
+    ap.add_argument('--slab',
+                    type=int,
+                    default=32,
+                    help='Number of z sections read at a time. Default is 32.')
+    ap.add_argument('--threads',
+                    type=int,
+                    default=None,
+                    help='Number of processes, one volume each.\
+             Default is None, using os.cpu_count().')
+    ap.add_argument('--slab_threads',
+                    type=int,
+                    default=None,
+                    help='Number of threads projecting slabs of a volume.\
+             Default is None, sharing os.cpu_count() between processes.')
     args = vars(ap.parse_args())
     return args
 
@@ -29,35 +48,49 @@ def is_mrc(filename):
     return filename.endswith(('.mrc'))
 
 
-def is_done(filename, odir):
-    oname = os.path.splitext(os.path.basename(filename))[0] + '.png'
-    return oname in os.listdir(odir)
+def output_name(filename):
+    return os.path.basename(filename).split('.')[0] + '.png'
 
 
-def project_3d(mrc, odir):
-    a = mrcfile.open(mrc, permissive=True).data
-    x = np.sum(a, axis=0)
-    y = np.sum(a, axis=1)
-    z = np.sum(a, axis=2)
+def project_3d(mrc, odir, mip=False, slab=32, threads=None):
+    proj = project_volume(mrc, slab=slab, workers=threads, mip=mip)
+    rows = [('x', 'y', 'z'), ('mx', 'my', 'mz')] if mip else [('x', 'y', 'z')]
 
-    fig, (ax1, ax2, ax3) = plt.subplots(1, 3, sharex=True, sharey=True)
-    ax1.imshow(x, cmap='gray')
-    ax2.imshow(y, cmap='gray')
-    ax3.imshow(z, cmap='gray')
+    fig, axes = plt.subplots(len(rows),
+                             3,
+                             sharex=True,
+                             sharey=True,
+                             squeeze=False)
+    for row, keys in zip(axes, rows):
+        for ax, k in zip(row, keys):
+            ax.imshow(proj[k], cmap='gray')
 
-    oname = os.path.basename(mrc).split('.')[0] + '.png'
-    fig.set_figheight(3)
+    oname = output_name(mrc)
+    fig.set_figheight(3 * len(rows))
     fig.set_figwidth(9)
     fig.savefig(os.path.join(odir, oname))
+    plt.close(fig)
 
 
 def main(**args):
-    for f in glob.glob(args['input']):
-        if is_mrc(f):
-            if args['skipdone'] and is_done(f, args['odir']):
-                pass
-            else:
-                project_3d(f, args['odir'])
+    index = OutputIndex(args['odir'], params=dict(mip=args['mip']))
+    files = [f for f in glob.glob(args['input']) if is_mrc(f)]
+    todo = [
+        f for f in files
+        if not (args['skipdone'] and index.is_done(f, output_name(f)))
+    ]
+    ncpu = os.cpu_count() or 1
+    procs = min(args['threads'] or ncpu, len(todo) or 1)
+    slab_threads = args['slab_threads'] or max(1, ncpu // procs)
+    summary = run_batch(project_3d,
+                        ((f, args['odir'], args['mip'], args['slab'],
+                          slab_threads) for f in todo),
+                        workers=procs,
+                        skipped=len(files) - len(todo))
+    for f in succeeded(summary):
+        index.record(f, output_name(f))
+    index.save()
+    return summary
 
 
 if __name__ == '__main__':
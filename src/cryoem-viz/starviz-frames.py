@@ -1,8 +1,11 @@
 import os
 import glob
-import starfile
 import argparse
 import plotly.graph_objects as go
+from utils.star import read_star_files
+from utils.html import PLOTLYJS_MODES, write_figure, write_index
+from utils.plotting import (RENDER_MODES, WEBGL_THRESHOLD, scatter_type,
+                            use_webgl)
 
 
 def setupParserOptions():
@@ -29,46 +32,97 @@ def setupParserOptions():
         '--plotz', help='Color map to plot for scatter plot. e.g. rlnAngleRot')
     ap.add_argument('--subset',
                     default=1.0,
-                    help='Take a subset (0 to 1) of the particles.\
+                    help='Take a subset of the particles, a fraction\
+                         (0 to 1) or a number of particles.\
                          Default is 1, which uses the full dataset.')
+    ap.add_argument('--seed',
+                    type=int,
+                    default=None,
+                    help='Random seed of --subset, for a reproducible\
+                         subset. Default is None.')
+    ap.add_argument('--stratify',
+                    default=None,
+                    help='With --subset, take the same fraction of the\
+                         particles of each value of this column\
+                         (e.g.: rlnMicrographName or rlnClassNumber).')
     ap.add_argument('--fixedratio',
                     default=True,
                     action="store_true",
                     help='x y ratio is fixed to be 1. Only useful for scatter.\
                          Default is true.')
+    ap.add_argument('--render',
+                    default='auto',
+                    choices=RENDER_MODES,
+                    help='Draw the scatter points with svg or webgl.\
+                         Default is auto, webgl above %d points.' %
+                    WEBGL_THRESHOLD)
+    ap.add_argument('--compress',
+                    default=False,
+                    action="store_true",
+                    help='Write the plot data as float32/uint8 binary\
+                         arrays deflated with zlib, decoded in the browser.\
+                         Smaller html, needs a recent browser.')
+    ap.add_argument('--plotlyjs',
+                    default='embed',
+                    choices=PLOTLYJS_MODES,
+                    help='How the pages load plotly.js: embed it in every\
+                         html, write it once as plotly-<version>.min.js\
+                         into the output directory (the pages then work\
+                         offline next to it, and an index.html linking them\
+                         is written), or load it from the cdn. Default is\
+                         embed.')
+    ap.add_argument('--threads',
+                    type=int,
+                    default=None,
+                    help='Number of processes reading star files.\
+             Default is None, using os.cpu_count().')
     args = vars(ap.parse_args())
     return args
 
 
-def readstarfile(input, subset):
-    dfs = []
-    for f in sorted(glob.glob(input)):
-        df = starfile.read(f)['particles']
-        if subset < 1.0:
-            df = df.sample(frac=subset)
-        dfs.append(df.select_dtypes(include='number'))
-    return dfs
+def readstarfile(input,
+                 subset,
+                 columns=None,
+                 threads=None,
+                 stratify=None,
+                 seed=None):
+    files = sorted(glob.glob(input))
+    df = read_star_files(files,
+                         'particles',
+                         columns=columns,
+                         subset=subset,
+                         stratify=stratify,
+                         seed=seed,
+                         workers=threads)
+    df = df.select_dtypes(include='number')
+    frames = dict(tuple(df.groupby('frame', sort=True)))
+    empty = df.iloc[:0]
+    return [
+        frames.get(k, empty).drop(columns='frame') for k in range(len(files))
+    ]
 
 
-def plot_scatter_frames(dfs, plot_x, plot_y, plot_z, fixedratio):
+def plot_scatter_frames(dfs, plot_x, plot_y, plot_z, fixedratio,
+                        render='auto'):
+    n = max((len(df) for df in dfs), default=0)
+    Scatter = scatter_type(n, render)
 
     fig = go.Figure(frames=[
-        go.Frame(data=go.Scatter(
+        go.Frame(data=Scatter(
             x=df[plot_x],
             y=df[plot_y],
             mode='markers',
             marker=dict(
                 color=df[plot_z], colorscale='Viridis', size=5,
                 showscale=True),
-            text=['{:0.3f}'.format(i) for i in df[plot_z]],
-            hovertemplate=plot_z + ': %{text}',
+            hovertemplate=plot_z + ': %{marker.color:.3f}',
         ),
                  name=str(k)) for k, df in enumerate(dfs)
     ])
 
     # Add data to be displayed before animation starts
     fig.add_trace(
-        go.Scatter(
+        Scatter(
             x=dfs[0][plot_x],
             y=dfs[0][plot_y],
             mode='markers',
@@ -76,15 +130,15 @@ def plot_scatter_frames(dfs, plot_x, plot_y, plot_z, fixedratio):
                         colorscale='Viridis',
                         size=5,
                         showscale=True),
-            text=['{:0.3f}'.format(i) for i in dfs[0][plot_z]],
-            hovertemplate=plot_z + ': %{text}',
+            hovertemplate=plot_z + ': %{marker.color:.3f}',
             name='',
         ))
 
     def frame_args(duration):
         return {
             "frame": {
-                "duration": duration
+                "duration": duration,
+                "redraw": use_webgl(n, render),  # needed by WebGL frames
             },
             "mode": "immediate",
             "fromcurrent": True,
@@ -171,10 +225,13 @@ def plot_scatter_frames(dfs, plot_x, plot_y, plot_z, fixedratio):
 
 
 def main(**args):
-    df = readstarfile(args['input'], float(args['subset']))
+    df = readstarfile(args['input'], float(args['subset']),
+                      [args['plotx'], args['ploty'], args['plotz']],
+                      args['threads'], args['stratify'], args['seed'])
     if args['plot'] == 'scatter':
         fig = plot_scatter_frames(df, args['plotx'], args['ploty'],
-                                  args['plotz'], args['fixedratio'])
+                                  args['plotz'], args['fixedratio'],
+                                  args['render'])
     else:
         pass
 
@@ -188,7 +245,10 @@ def main(**args):
     else:
         odir = args['odir']
 
-    fig.write_html(os.path.join(odir, oname))
+    write_figure(fig, os.path.join(odir, oname), args['compress'],
+                 args['plotlyjs'])
+    if args['plotlyjs'] == 'directory':
+        write_index(odir)
 
 
 if __name__ == '__main__':
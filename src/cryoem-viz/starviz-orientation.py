@@ -1,9 +1,13 @@
 import os
-import starfile
 import argparse
 import plotly.graph_objects as go
-from scipy.spatial.transform import Rotation as R
 import numpy as np
+from utils.star import sample_star
+from utils.binning import sphere_grid, sphere_cells, cell_means
+from utils.html import PLOTLYJS_MODES, write_figure, write_index
+from utils.plotting import color_buttons, typed_array
+
+HOVER = ': %{marker.color:.3f}'
 
 
 def setupParserOptions():
@@ -25,18 +29,72 @@ def setupParserOptions():
                     help='Marker size for plotting.')
     ap.add_argument('--subset',
                     default=1.0,
-                    help='Take a subset (0 to 1) of the particles.\
+                    help='Take a subset of the particles, a fraction\
+                         (0 to 1) or a number of particles.\
                          Default is 1, which uses the full dataset.')
+    ap.add_argument('--seed',
+                    type=int,
+                    default=None,
+                    help='Random seed of --subset, for a reproducible\
+                         subset. Default is None.')
+    ap.add_argument('--stratify',
+                    default=None,
+                    help='With --subset, take the same fraction of the\
+                         particles of each value of this column\
+                         (e.g.: rlnMicrographName or rlnClassNumber).')
+    ap.add_argument('--multitrace',
+                    default=False,
+                    action="store_true",
+                    help='Write one scatter trace per color column, as\
+                         older versions did, instead of one trace\
+                         recolored by the dropdown. Much larger html.')
+    ap.add_argument('--binned',
+                    default=False,
+                    action="store_true",
+                    help='Draw the particle count and the mean of each\
+                         column in equal-area cells of the sphere instead\
+                         of every particle. The html size does not depend\
+                         on the number of particles.')
+    ap.add_argument('--rings',
+                    type=int,
+                    default=30,
+                    help='Bands of latitude of the --binned grid, about\
+                         180/rings degrees per cell. Default is 30.')
+    ap.add_argument('--fold',
+                    default=False,
+                    action="store_true",
+                    help='Show the particles viewed from below the plotted\
+                         half-sphere at the opposite direction, their\
+                         mirror view. Mirror views are then counted\
+                         together, also in the --binned cells. By default\
+                         they are out of view.')
+    ap.add_argument('--compress',
+                    default=False,
+                    action="store_true",
+                    help='Write the plot data as float32/uint8 binary\
+                         arrays deflated with zlib, decoded in the browser.\
+                         Smaller html, needs a recent browser.')
+    ap.add_argument('--plotlyjs',
+                    default='embed',
+                    choices=PLOTLYJS_MODES,
+                    help='How the pages load plotly.js: embed it in every\
+                         html, write it once as plotly-<version>.min.js\
+                         into the output directory (the pages then work\
+                         offline next to it, and an index.html linking them\
+                         is written), or load it from the cdn. Default is\
+                         embed.')
 
     args = vars(ap.parse_args())
     return args
 
 
-def readstarfile(input, subset):
-    df = starfile.read(input)['particles']
-    if subset < 1.0:
-        df = df.sample(frac=subset)
-    return df.select_dtypes(include='number')
+def readstarfile(input, subset, stratify=None, seed=None):
+    return sample_star(input,
+                       'particles',
+                       subset,
+                       stratify=stratify,
+                       seed=seed,
+                       numeric=True)
 
 
 def prep_sphere(r=0.99):
@@ -48,34 +106,113 @@ def prep_sphere(r=0.99):
     return (X, Y, Z)
 
 
-def prep_particles(df):
-    v_0 = np.array([[0., 1., 0.]])
-    xyz_0 = np.tile(v_0, len(df)).reshape(-1, 3)
-
-    rots = np.stack([
-        df['rlnAngleRot'].values, df['rlnAngleTilt'].values,
-        df['rlnAnglePsi'].values
-    ],
-                    axis=1)
-    r = R.from_euler('zyz', rots, degrees=True)
-    xyz = r.apply(xyz_0)
-    x = xyz[:, 0]
-    y = xyz[:, 1]
-    z = xyz[:, 2]
+def prep_particles(df, fold=False):
+    '''
+    Viewing direction of each particle, the unit vector of rlnAngleRot
+    and rlnAngleTilt; psi only turns the image in plane. fold is as in
+    view_angles.
+    '''
+    rot, tilt = np.radians(view_angles(df, fold))
+    sin_tilt = np.sin(tilt)
+    x = np.cos(rot) * sin_tilt
+    y = np.sin(rot) * sin_tilt
+    z = np.cos(tilt)
     return (x, y, z)
 
 
-def plot(df, x, y, z, X, Y, Z, marker_size):
+def view_angles(df, fold=False):
+    '''
+    rlnAngleRot and rlnAngleTilt in degrees. The plot shows the upper
+    half-sphere, directions of the lower half are cut off. With fold
+    they are turned to the opposite ones, whose projections are their
+    mirror images, so mirror views are merged.
+    '''
+    rot = df['rlnAngleRot'].to_numpy(dtype=np.float64)
+    tilt = df['rlnAngleTilt'].to_numpy(dtype=np.float64)
+    if not fold:
+        return rot, tilt
+    lower = tilt > 90
+    return np.where(lower, rot + 180, rot), np.where(lower, 180 - tilt, tilt)
+
+
+def prep_mesh(grid, cells, r=1.):
+    '''
+    Triangles of the cells of grid (see utils.binning.sphere_grid) on a
+    sphere of radius r. Returns x, y, z of the vertices, i, j, k of the
+    triangles and the cell of each triangle. Cells are split in
+    longitude so that the bands near the poles are round as well.
+    '''
+    zedges, ncells = grid
+    offset = np.concatenate([[0], np.cumsum(ncells)[:-1]])
+    rings = len(ncells)
+    xyz, ijk, face_cell = [], [], []
+    base = 0
+    for band, n in enumerate(ncells):
+        c = cells[(cells >= offset[band]) & (cells < offset[band] + n)]
+        if not len(c):
+            continue
+        s = -(-rings // n)
+        # Longitude of the s + 1 vertices of each cell.
+        phi = 2 * np.pi * ((c - offset[band])[:, None] * s +
+                           np.arange(s + 1)) / (n * s)
+        for z in zedges[band:band + 2]:
+            rho = np.sqrt(max(0., 1 - z * z))
+            xyz.append(
+                np.stack([rho * np.cos(phi), rho * np.sin(phi),
+                          np.full(phi.shape, z)], axis=-1) * r)
+        # Vertices are numbered row by row: the top ones of every cell,
+        # then the bottom ones.
+        top = base + np.arange(len(c))[:, None] * (s + 1) + np.arange(s)
+        bottom = top + len(c) * (s + 1)
+        ijk.append(
+            np.concatenate([
+                np.stack([top, bottom, bottom + 1], axis=-1),
+                np.stack([top, bottom + 1, top + 1], axis=-1)
+            ], axis=1).reshape(-1, 3))
+        face_cell.append(np.repeat(c, 2 * s))
+        base += 2 * len(c) * (s + 1)
+    if not ijk:
+        empty = np.zeros(0)
+        return (empty, ) * 3 + (empty.astype(int), ) * 4
+    xyz = np.concatenate([v.reshape(-1, 3) for v in xyz])
+    ijk = np.concatenate(ijk)
+    return (xyz[:, 0], xyz[:, 1], xyz[:, 2], ijk[:, 0], ijk[:, 1],
+            ijk[:, 2], np.concatenate(face_cell))
+
+
+def plot(df, x, y, z, X, Y, Z, marker_size, multitrace=False):
     fig = go.Figure()
 
-    for c in df.columns:
+    if multitrace:
+        for c in df.columns:
+            fig.add_trace(
+                go.Scatter3d(
+                    x=x,
+                    y=y,
+                    z=z,
+                    mode='markers',
+                    visible=False,
+                    marker=dict(
+                        color=df[c],
+                        colorscale='Viridis',
+                        size=marker_size,
+                        showscale=True,
+                        opacity=0.8,
+                    ),
+                    hovertemplate=c + HOVER,
+                    name='',
+                ))
+
+        fig.data[0].visible = True
+    else:
+        # One trace, recolored by the buttons.
+        c = df.columns[0]
         fig.add_trace(
             go.Scatter3d(
                 x=x,
                 y=y,
                 z=z,
                 mode='markers',
-                visible=False,
                 marker=dict(
                     color=df[c],
                     colorscale='Viridis',
@@ -83,13 +220,29 @@ def plot(df, x, y, z, X, Y, Z, marker_size):
                     showscale=True,
                     opacity=0.8,
                 ),
-                text=['{:0.3f}'.format(i) for i in df[c]],
-                hovertemplate=c + ': %{text}',
+                hovertemplate=c + HOVER,
                 name='',
             ))
 
-    fig.data[0].visible = True
+    add_sphere(fig, X, Y, Z)
+
+    if multitrace:
+        buttons = []
+        for i in range(len(fig.data) - 1):
+            button = dict(method="update",
+                          args=[{
+                              "visible": [False] * len(fig.data) + [True]
+                          }],
+                          label=df.columns[i])
+            button["args"][0]["visible"][i] = True
+            buttons.append(button)
+    else:
+        buttons = color_buttons(df, df.columns, hovertemplate=HOVER)
+
+    return layout(fig, buttons)
+
 
+def add_sphere(fig, X, Y, Z):
     fig.add_trace(
         go.Surface(x=X,
                    y=Y,
@@ -102,17 +255,61 @@ def plot(df, x, y, z, X, Y, Z, marker_size):
                    hoverinfo='skip',
                    name=''))
 
-    button_layer_1_height = 1.10
 
-    buttons = []
-    for i in range(len(fig.data) - 1):
-        button = dict(method="update",
-                      args=[{
-                          "visible": [False] * len(fig.data) + [True]
-                      }],
-                      label=df.columns[i])
-        button["args"][0]["visible"][i] = True
-        buttons.append(button)
+def plot_binned(df, X, Y, Z, rings=30, fold=False):
+    '''
+    The particle count and the mean of each column of df in the
+    equal-area cells of utils.binning.sphere_grid, drawn as one mesh
+    colored by cell, recolored by the dropdown. Empty cells are left
+    out, showing the sphere behind. fold is as in view_angles.
+    '''
+    grid = sphere_grid(rings)
+    total = grid[1].sum()
+    cell = sphere_cells(*view_angles(df, fold), grid)
+    counts, means = cell_means(cell, total,
+                               df.to_numpy(dtype=np.float64,
+                                           na_value=np.nan))
+    x, y, z, i, j, k, face_cell = prep_mesh(grid, np.nonzero(counts)[0])
+
+    # Colors and hover texts are per triangle.
+    def restyle(label, values, text):
+        return {
+            'intensity': [typed_array(values[face_cell])],
+            'text': [np.asarray(text)[face_cell].tolist()],
+            'hovertemplate': label + ': %{text}<extra></extra>'
+        }
+
+    styles = [('Count', restyle('Count', counts, counts.astype(str)))]
+    for col, column in enumerate(df.columns):
+        text = ['%.4g (%d)' % (m, n) for m, n in zip(means[:, col], counts)]
+        styles.append((column, restyle(column, means[:, col], text)))
+
+    fig = go.Figure()
+    fig.add_trace(
+        go.Mesh3d(x=x,
+                  y=y,
+                  z=z,
+                  i=i,
+                  j=j,
+                  k=k,
+                  intensity=counts[face_cell],
+                  intensitymode='cell',
+                  text=styles[0][1]['text'][0],
+                  colorscale='Viridis',
+                  showscale=True,
+                  flatshading=True,
+                  hovertemplate=styles[0][1]['hovertemplate'],
+                  name=''))
+    add_sphere(fig, X, Y, Z)
+    buttons = [
+        dict(method='restyle', args=[args, [0]], label=label)
+        for label, args in styles
+    ]
+    return layout(fig, buttons)
+
+
+def layout(fig, buttons):
+    button_layer_1_height = 1.10
 
     updatemenus = [
         dict(buttons=buttons,
@@ -167,11 +364,23 @@ def plot(df, x, y, z, X, Y, Z, marker_size):
 
 
 def main(**args):
-    df = readstarfile(args['input'], float(args['subset']))
+    df = readstarfile(args['input'], float(args['subset']),
+                      args['stratify'], args['seed'])
     X, Y, Z = prep_sphere(r=0.99)
-    x, y, z = prep_particles(df)
+    if args['binned']:
+        fig = plot_binned(df, X, Y, Z, args['rings'], args['fold'])
+    else:
+        x, y, z = prep_particles(df, args['fold'])
 
-    fig = plot(df, x=x, y=y, z=z, X=X, Y=Y, Z=Z, marker_size=args['size'])
+        fig = plot(df,
+                   x=x,
+                   y=y,
+                   z=z,
+                   X=X,
+                   Y=Y,
+                   Z=Z,
+                   marker_size=args['size'],
+                   multitrace=args['multitrace'])
 
     if args['oname'] is None:
         oname = os.path.splitext(os.path.basename(
@@ -183,7 +392,10 @@ def main(**args):
     else:
         odir = args['odir']
 
-    fig.write_html(os.path.join(odir, oname))
+    write_figure(fig, os.path.join(odir, oname), args['compress'],
+                 args['plotlyjs'])
+    if args['plotlyjs'] == 'directory':
+        write_index(odir)
 
 
 if __name__ == '__main__':
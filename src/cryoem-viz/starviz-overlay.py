@@ -1,9 +1,15 @@
-import starfile
-import mrcfile
 import os
 import plotly.express as px
-import plotly.graph_objects as go
 from utils.utils import downsample
+from utils.cache import get_cache, load_downsampled
+from utils.batch import run_batch
+from utils.pipeline import run_pipeline
+from utils import browser, tiles
+from utils.star import sample_star
+from utils.html import (PLOTLYJS_MODES, bundle, figure_html, write_figure,
+                        write_index, write_page)
+from utils.plotting import (RENDER_MODES, WEBGL_THRESHOLD, color_buttons,
+                            scatter_type)
 import argparse
 
 
@@ -18,59 +24,171 @@ def setupParserOptions():
                     help='Provide the path to the output directory.\
              Default is current directory.')
     ap.add_argument('--height',
+                    type=int,
                     default=600,
                     help="Height of the scaled image. Default is 600.")
     ap.add_argument('--subset',
                     default=1.0,
-                    help='Take a subset (0 to 1) of the particles.\
+                    help='Take a subset of the particles, a fraction\
+                         (0 to 1) or a number of particles.\
                          Default is 1, which uses the full dataset.')
+    ap.add_argument('--seed',
+                    type=int,
+                    default=None,
+                    help='Random seed of --subset, for a reproducible\
+                         subset. Default is None.')
+    ap.add_argument('--stratify',
+                    default=None,
+                    help='With --subset, take the same fraction of the\
+                         particles of each value of this column\
+                         (e.g.: rlnMicrographName or rlnClassNumber).')
+    ap.add_argument('--browser',
+                    default=False,
+                    action="store_true",
+                    help='Write one browser.html page for all micrographs,\
+             with their images and particle tables as small files\
+             loaded on selection, instead of one html per micrograph.')
+    ap.add_argument('--threads',
+                    type=int,
+                    default=None,
+                    help='Number of processes rendering micrographs.\
+             Default is None, using os.cpu_count().')
+    ap.add_argument('--pipeline',
+                    default=False,
+                    action="store_true",
+                    help='Read and downsample the micrographs ahead in\
+             --readers threads, render them in --threads processes\
+             and write the html in another thread, so reading,\
+             rendering and writing overlap. Not with --browser or\
+             --tiles.')
+    ap.add_argument('--readers',
+                    type=int,
+                    default=2,
+                    help='Number of threads reading and downsampling\
+             micrographs with --pipeline. Default is 2.')
+    ap.add_argument('--render',
+                    default='auto',
+                    choices=RENDER_MODES,
+                    help='Draw the scatter points with svg or webgl.\
+             Default is auto, webgl above %d points.' % WEBGL_THRESHOLD)
+    ap.add_argument('--multitrace',
+                    default=False,
+                    action="store_true",
+                    help='Write one scatter trace per color column, as\
+             older versions did, instead of one trace recolored by\
+             the dropdown. Much larger html.')
+    ap.add_argument('--compress',
+                    default=False,
+                    action="store_true",
+                    help='Write the plot data as float32/uint8 binary\
+             arrays deflated with zlib, decoded in the browser.\
+             Smaller html, needs a recent browser.')
+    ap.add_argument('--plotlyjs',
+                    default='embed',
+                    choices=PLOTLYJS_MODES,
+                    help='How the pages load plotly.js: embed it in every\
+             html, write it once as plotly-<version>.min.js\
+             into the output directory (the pages then work\
+             offline next to it, and an index.html linking them\
+             is written), or load it from the cdn. Default is\
+             embed.')
+    ap.add_argument('--tiles',
+                    default=False,
+                    action="store_true",
+                    help='Write a tile pyramid of each full size micrograph\
+             next to its html, and load only the tiles needed at the\
+             current zoom instead of embedding the image at --height.')
+    ap.add_argument('--cache',
+                    default=None,
+                    help='Directory of the downsampled image cache.\
+             Default is $CRYOEM_VIZ_CACHE, no caching if unset.')
+    ap.add_argument('--cache_size',
+                    type=float,
+                    default=10.,
+                    help='Size limit of the cache in GB. Default is 10.')
 
     args = vars(ap.parse_args())
     return args
 
 
-def readstarfile(input, subset):
-    df = starfile.read(input)['particles']
-    if subset < 1.0:
-        df = df.sample(frac=subset).select_dtypes(include='number')
-    return df
+def readstarfile(input, subset, stratify=None, seed=None):
+    return sample_star(input,
+                       'particles',
+                       subset,
+                       stratify=stratify,
+                       seed=seed)
 
 
-def starviz_overlay(df, img, img_h):
+def starviz_overlay(df,
+                    img,
+                    img_h,
+                    factor=None,
+                    render='auto',
+                    multitrace=False,
+                    pyramid=None):
+    '''
+    If factor is given, img is already downsampled to img_h
+    by that factor. With a tile pyramid (see utils.tiles) img is not
+    used and the figure is drawn without an image.
+    '''
+
+    if factor is None:
+        factor = img_h / img.shape[0]
+        img = downsample(img, img_h)
+
+    if pyramid is None:
+        fig = px.imshow(img, binary_string=True)
+    else:
+        fig = tiles.figure(pyramid, factor)
+    Scatter = scatter_type(len(df), render)
+    x = df['rlnCoordinateX'] * factor
+    y = df['rlnCoordinateY'] * factor
+    colors = df.select_dtypes(include='number').columns
 
-    factor = img_h / img.shape[0]
-    img = downsample(img, img_h)
+    if multitrace:
+        for z in colors:
+            fig.add_trace(
+                Scatter(
+                    x=x,
+                    y=y,
+                    mode='markers',
+                    visible=False,
+                    marker=dict(color=df[z],
+                                colorscale='Viridis',
+                                size=5,
+                                showscale=True),
+                    name='',
+                ))
 
-    fig = px.imshow(img, binary_string=True)
+        fig.data[1].visible = True
 
-    for z in df.columns:
+        # Trace 0 is the micrograph, always visible.
+        buttons = []
+        for i in range(len(fig.data) - 1):
+            button = dict(method="update",
+                          args=[{
+                              "visible": [True] + [False] * (len(fig.data) - 1)
+                          }],
+                          label=colors[i])
+            button["args"][0]["visible"][i + 1] = True
+            buttons.append(button)
+    else:
+        # One trace, recolored by the buttons.
         fig.add_trace(
-            go.Scatter(
-                x=df['rlnCoordinateX'] * factor,
-                y=df['rlnCoordinateX'] * factor,
+            Scatter(
+                x=x,
+                y=y,
                 mode='markers',
-                visible=False,
-                marker=dict(color=df[z],
+                marker=dict(color=df[colors[0]],
                             colorscale='Viridis',
                             size=5,
                             showscale=True),
                 name='',
             ))
-
-    fig.data[0].visible = True
+        buttons = color_buttons(df, colors, trace=1)
 
     button_layer_1_height = 1.10
 
-    buttons = []
-    for i in range(len(fig.data)):
-        button = dict(method="update",
-                      args=[{
-                          "visible": [True] + [False] * len(fig.data)
-                      }],
-                      label=df.columns[i + 1])
-        button["args"][0]["visible"][i + 1] = True
-        buttons.append(button)
-
     updatemenus = [
         dict(buttons=buttons,
              direction="down",
@@ -111,23 +229,132 @@ def starviz_overlay(df, img, img_h):
     return fig
 
 
+def overlay_name(mic):
+    return 'ls-' + os.path.basename(mic).split('.')[0] + '-overlay.html'
+
+
+def render_micrograph(mic,
+                      df,
+                      img_h,
+                      odir,
+                      cache=None,
+                      render='auto',
+                      multitrace=False,
+                      compress=False,
+                      plotlyjs='embed',
+                      tiled=False):
+    oname = overlay_name(mic)
+    pyramid, post_script = None, None
+    if tiled:
+        img = None
+        pyramid, path = tiles.write_micrograph_pyramid(mic, odir, oname)
+        shape = (pyramid['height'], pyramid['width'])
+    else:
+        img, shape = load_downsampled(mic, img_h, cache)
+    factor = img_h / shape[0]
+    fig = starviz_overlay(df,
+                          img,
+                          img_h,
+                          factor=factor,
+                          render=render,
+                          multitrace=multitrace,
+                          pyramid=pyramid)
+    if pyramid is not None:
+        post_script = tiles.viewer(pyramid, path, factor)
+    write_figure(fig, os.path.join(odir, oname), compress, plotlyjs,
+                 post_script)
+
+
+def read_stage(task):
+    '''
+    Reader of the pipeline: the micrograph of a task of render_micrograph
+    downsampled, through the cache. Runs in a thread, reading and the FFT
+    release the GIL, so only the small image goes to the workers.
+    '''
+    mic, _, img_h, _, cache = task[:5]
+    return load_downsampled(mic, img_h, cache)
+
+
+def render_stage(task, data):
+    '''Worker of the pipeline: the html page of a task, not written.'''
+    _, df, img_h, _, _, render, multitrace, compress, plotlyjs = task
+    img, shape = data
+    fig = starviz_overlay(df,
+                          img,
+                          img_h,
+                          factor=img_h / shape[0],
+                          render=render,
+                          multitrace=multitrace)
+    return figure_html(fig, compress, plotlyjs)
+
+
+def write_stage(task, page):
+    '''Writer of the pipeline.'''
+    mic, odir, plotlyjs = task[0], task[3], task[8]
+    write_page(page, os.path.join(odir, overlay_name(mic)), plotlyjs)
+
+
+def browse_micrograph(mic, stem, df, img_h, odir, cache=None, columns=()):
+    img, shape = load_downsampled(mic, img_h, cache)
+    return browser.write_micrograph(odir, stem, mic, img, df,
+                                    img_h / shape[0], columns)
+
+
 def main(**args):
     if args['odir'] is None:
         odir = './'
     else:
         odir = args['odir']
 
+    if args['pipeline'] and (args['browser'] or args['tiles']):
+        raise ValueError('--pipeline writes neither --browser nor --tiles.')
+
     img_h = args['height']
+    cache = get_cache(args['cache'], args['cache_size'])
 
-    df = readstarfile(args['input'], args['subset'])
+    df = readstarfile(args['input'], float(args['subset']),
+                      args['stratify'], args['seed'])
     dfs = df.groupby('rlnMicrographName')
 
-    for mic, df_temp in dfs:
-        img = mrcfile.read(mic)
-        img = downsample(img, img_h)
-        oname = 'ls-' + os.path.basename(mic).split('.')[0] + '-overlay.html'
-        fig = starviz_overlay(df_temp, img, img_h)
-        fig.write_html(os.path.join(odir, oname))
+    if args['browser']:
+        colors = list(df.select_dtypes(include='number').columns)
+        browser.prepare(odir)
+        mics = [mic for mic, _ in dfs]
+        summary = run_batch(browse_micrograph,
+                            ((mic, stem, df_temp, img_h, odir, cache, colors)
+                             for stem, (mic, df_temp) in zip(
+                                 browser.stems(mics), dfs)),
+                            workers=args['threads'],
+                            values=True)
+        order = {mic: i for i, mic in enumerate(mics)}
+        entries = [r['value'] for r in summary['records'] if r['ok']]
+        entries.sort(key=lambda e: order[e['name']])
+        browser.write_browser(odir, entries, colors, args['render'])
+        return summary
+
+    if args['plotlyjs'] == 'directory':
+        # Written once before the workers share it.
+        bundle(odir)
+    if args['pipeline']:
+        summary = run_pipeline(read_stage,
+                               render_stage,
+                               write_stage,
+                               ((mic, df_temp, img_h, odir, cache,
+                                 args['render'], args['multitrace'],
+                                 args['compress'], args['plotlyjs'])
+                                for mic, df_temp in dfs),
+                               workers=args['threads'],
+                               readers=args['readers'])
+    else:
+        summary = run_batch(render_micrograph,
+                            ((mic, df_temp, img_h, odir, cache,
+                              args['render'], args['multitrace'],
+                              args['compress'], args['plotlyjs'],
+                              args['tiles']) for mic, df_temp in dfs),
+                            workers=args['threads'])
+    if args['plotlyjs'] == 'directory':
+        write_index(odir)
+    return summary
 
 
 if __name__ == '__main__':
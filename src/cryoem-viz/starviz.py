@@ -1,7 +1,12 @@
 import os
-import starfile
 import argparse
+import numpy as np
 import plotly.graph_objects as go
+from utils.star import sample_star
+from utils.html import PLOTLYJS_MODES, write_figure, write_index
+from utils.binning import densest, grid2d, histograms
+from utils.plotting import (RENDER_MODES, WEBGL_THRESHOLD, color_buttons,
+                            scatter_type)
 
 
 def setupParserOptions():
@@ -23,67 +28,161 @@ def setupParserOptions():
              Support `micrograph` and `particles` for now.')
     ap.add_argument(
         '--plot',
-        help='Type of the plot. Support `scatter` and `histogram` for now.')
+        help='Type of the plot. Support `scatter`, `density` and\
+             `histogram` for now.')
     ap.add_argument('--plotx',
                     help='x axis for scatter plot. e.g. rlnCoordinateX')
     ap.add_argument('--ploty',
                     help='y axis for scatter plot. e.g. rlnCoordinateY')
     ap.add_argument('--subset',
                     default=1.0,
-                    help='Take a subset (0 to 1) of the particles.\
+                    help='Take a subset of the particles, a fraction\
+                         (0 to 1) or a number of particles.\
                          Default is 1, which uses the full dataset.')
+    ap.add_argument('--seed',
+                    type=int,
+                    default=None,
+                    help='Random seed of --subset, for a reproducible\
+                         subset. Default is None.')
+    ap.add_argument('--stratify',
+                    default=None,
+                    help='With --subset, take the same fraction of the\
+                         particles of each value of this column\
+                         (e.g.: rlnMicrographName or rlnClassNumber).')
     ap.add_argument('--fixedratio',
                     default=True,
                     action="store_true",
                     help='x y ratio is fixed to be 1. Only useful for scatter.\
                          Default is true.')
+    ap.add_argument('--render',
+                    default='auto',
+                    choices=RENDER_MODES,
+                    help='Draw the scatter points with svg or webgl.\
+                         Default is auto, webgl above %d points.' %
+                    WEBGL_THRESHOLD)
+    ap.add_argument('--multitrace',
+                    default=False,
+                    action="store_true",
+                    help='Write one scatter trace per color column, as\
+                         older versions did, instead of one trace\
+                         recolored by the dropdown. Much larger html.')
+    ap.add_argument('--compress',
+                    default=False,
+                    action="store_true",
+                    help='Write the plot data as float32/uint8 binary\
+                         arrays deflated with zlib, decoded in the browser.\
+                         Smaller html, needs a recent browser.')
+    ap.add_argument('--plotlyjs',
+                    default='embed',
+                    choices=PLOTLYJS_MODES,
+                    help='How the pages load plotly.js: embed it in every\
+                         html, write it once as plotly-<version>.min.js\
+                         into the output directory (the pages then work\
+                         offline next to it, and an index.html linking them\
+                         is written), or load it from the cdn. Default is\
+                         embed.')
+    ap.add_argument('--columns',
+                    default=None,
+                    help='Only read and plot these columns, separated by\
+                         comma (e.g.: rlnDefocusU,rlnCtfFigureOfMerit).\
+                         Default is all numeric columns.')
+    ap.add_argument('--plotz',
+                    default=None,
+                    help='Column colored by its mean or max per pixel in\
+                         the density plot. Default is None, the number\
+                         of particles.')
+    ap.add_argument('--reduce',
+                    default='mean',
+                    choices=['mean', 'max'],
+                    help='Reduction of --plotz per pixel. Default is mean.')
+    ap.add_argument('--gridsize',
+                    type=int,
+                    default=500,
+                    help='Pixels along each axis of the density plot.\
+                         Default is 500.')
+    ap.add_argument('--drilldown',
+                    type=int,
+                    default=0,
+                    help='Also plot up to this many particles of the\
+                         densest pixels of the density plot as points.\
+                         Default is 0.')
+    ap.add_argument('--aggregate',
+                    default=False,
+                    action="store_true",
+                    help='Bin the histograms here and write only the bin\
+                         counts, so the html size does not grow with the\
+                         number of particles. Only useful for histogram.')
+    ap.add_argument('--bins',
+                    default='auto',
+                    help='Number of bins of each histogram with\
+                         --aggregate. Default is auto.')
     args = vars(ap.parse_args())
     return args
 
 
-def readstarfile(input, type, subset):
-    if type == 'micrographs':
-        df = starfile.read(input)['micrographs']
-    if type == 'particles':
-        df = starfile.read(input)['particles']
-    if subset < 1.0:
-        df = df.sample(frac=subset).select_dtypes(include='number')
-    else:
-        df = df.select_dtypes(include='number')
-    return df
+def readstarfile(input, type, subset, columns=None, stratify=None,
+                 seed=None):
+    return sample_star(input,
+                       type,
+                       subset,
+                       stratify=stratify,
+                       seed=seed,
+                       columns=columns,
+                       numeric=True)
 
 
-def plot_scatter(df, plot_x, plot_y, fixedratio):
+def plot_scatter(df,
+                 plot_x,
+                 plot_y,
+                 fixedratio,
+                 render='auto',
+                 multitrace=False):
     fig = go.Figure()
+    Scatter = scatter_type(len(df), render)
+
+    if multitrace:
+        for z in df.columns:
+            fig.add_trace(
+                Scatter(
+                    x=df[plot_x],
+                    y=df[plot_y],
+                    mode='markers',
+                    visible=False,
+                    marker=dict(color=df[z],
+                                colorscale='Viridis',
+                                size=5,
+                                showscale=True),
+                    name='',
+                ))
 
-    for z in df.columns:
+        fig.data[0].visible = True
+
+        buttons = []
+        for i in range(len(fig.data)):
+            button = dict(method="update",
+                          args=[{
+                              "visible": [False] * len(fig.data)
+                          }],
+                          label=df.columns[i])
+            button["args"][0]["visible"][i] = True
+            buttons.append(button)
+    else:
+        # One trace, recolored by the buttons.
         fig.add_trace(
-            go.Scatter(
+            Scatter(
                 x=df[plot_x],
                 y=df[plot_y],
                 mode='markers',
-                visible=False,
-                marker=dict(color=df[z],
+                marker=dict(color=df[df.columns[0]],
                             colorscale='Viridis',
                             size=5,
                             showscale=True),
                 name='',
             ))
-
-    fig.data[0].visible = True
+        buttons = color_buttons(df, df.columns)
 
     button_layer_1_height = 1.10
 
-    buttons = []
-    for i in range(len(fig.data)):
-        button = dict(method="update",
-                      args=[{
-                          "visible": [False] * len(fig.data)
-                      }],
-                      label=df.columns[i])
-        button["args"][0]["visible"][i] = True
-        buttons.append(button)
-
     updatemenus = [
         dict(buttons=buttons,
              direction="down",
@@ -125,18 +224,100 @@ def plot_scatter(df, plot_x, plot_y, fixedratio):
     return fig
 
 
-def plot_histogram(df):
+def plot_density(df,
+                 plot_x,
+                 plot_y,
+                 fixedratio,
+                 plot_z=None,
+                 reduce='mean',
+                 gridsize=500,
+                 drilldown=0,
+                 render='auto'):
+    '''
+    Particles binned into a gridsize by gridsize heatmap, colored by the
+    number of particles per pixel or with plot_z by its mean or max.
+    drilldown adds up to that many particles of the densest pixels as
+    points. The html size does not depend on the number of particles.
+    '''
+    values = None if plot_z is None else df[plot_z]
+    xedges, yedges, counts, reduced, pixel = grid2d(df[plot_x], df[plot_y],
+                                                    gridsize, values, reduce)
+    if reduced is None:
+        z = np.where(counts > 0, counts, np.nan)
+        label = 'Particles'
+    else:
+        z = reduced
+        label = '%s of %s' % (reduce, plot_z)
     fig = go.Figure()
+    fig.add_trace(
+        go.Heatmap(
+            x=(xedges[:-1] + xedges[1:]) / 2,
+            y=(yedges[:-1] + yedges[1:]) / 2,
+            # Heatmap rows are y.
+            z=z.T,
+            customdata=counts.T,
+            colorscale='Viridis',
+            colorbar=dict(title=label),
+            hovertemplate=label + ': %{z:.3f}<br>Particles: %{customdata}',
+            name='',
+        ))
 
-    for z in df.columns:
+    if drilldown:
+        points = df.iloc[densest(pixel, counts, drilldown)]
+        Scatter = scatter_type(len(points), render)
         fig.add_trace(
-            go.Histogram(
-                x=df[z],
-                name='',
-                showlegend=False,
-                visible=False,
+            Scatter(
+                x=points[plot_x],
+                y=points[plot_y],
+                mode='markers',
+                marker=dict(color='red', size=3),
+                name='Densest %d' % len(points),
+                visible='legendonly',
             ))
 
+    fig.update_layout(
+        xaxis_title=plot_x,
+        yaxis_title=plot_y,
+        height=700,
+        autosize=False,
+        margin=dict(t=50, b=0, l=0, r=0),
+    )
+
+    if fixedratio:
+        fig.update_yaxes(
+            scaleanchor="x",
+            scaleratio=1,
+        )
+
+    return fig
+
+
+def plot_histogram(df, aggregate=False, bins='auto'):
+    fig = go.Figure()
+
+    if aggregate:
+        # Bin counts computed here, one bar per bin.
+        for edges, counts in histograms(df, bins):
+            fig.add_trace(
+                go.Bar(
+                    x=(edges[:-1] + edges[1:]) / 2,
+                    y=counts,
+                    width=np.diff(edges),
+                    name='',
+                    showlegend=False,
+                    visible=False,
+                ))
+        fig.update_layout(bargap=0)
+    else:
+        for z in df.columns:
+            fig.add_trace(
+                go.Histogram(
+                    x=df[z],
+                    name='',
+                    showlegend=False,
+                    visible=False,
+                ))
+
     fig.data[0].visible = True
 
     button_layer_1_height = 1.18
@@ -184,12 +365,30 @@ def plot_histogram(df):
 
 
 def main(**args):
-    df = readstarfile(args['input'], args['type'], float(args['subset']))
+    columns = None
+    if args['columns'] is not None:
+        columns = [c.strip() for c in args['columns'].split(',')]
+        if args['plot'] == 'scatter':
+            columns += [args['plotx'], args['ploty']]
+    if args['plot'] == 'density':
+        # Only the plotted columns are read.
+        columns = [args['plotx'], args['ploty']]
+        if args['plotz'] is not None:
+            columns.append(args['plotz'])
+    df = readstarfile(args['input'], args['type'], float(args['subset']),
+                      columns, args['stratify'], args['seed'])
     if args['plot'] == 'scatter':
         fig = plot_scatter(df, args['plotx'], args['ploty'],
-                           args['fixedratio'])
+                           args['fixedratio'], args['render'],
+                           args['multitrace'])
+    elif args['plot'] == 'density':
+        fig = plot_density(df, args['plotx'], args['ploty'],
+                           args['fixedratio'], args['plotz'], args['reduce'],
+                           args['gridsize'], args['drilldown'],
+                           args['render'])
     elif args['plot'] == 'histogram':
-        fig = plot_histogram(df)
+        bins = args['bins'] if args['bins'] == 'auto' else int(args['bins'])
+        fig = plot_histogram(df, args['aggregate'], bins)
 
     if args['oname'] is None:
         oname = os.path.splitext(os.path.basename(
@@ -201,7 +400,10 @@ def main(**args):
     else:
         odir = args['odir']
 
-    fig.write_html(os.path.join(odir, oname))
+    write_figure(fig, os.path.join(odir, oname), args['compress'],
+                 args['plotlyjs'])
+    if args['plotlyjs'] == 'directory':
+        write_index(odir)
 
 
 if __name__ == '__main__':
@@ -3,8 +3,19 @@
 Similar to relion star handler, operate on star file.
 '''
 
-import starfile
+import os
+import sys
 import argparse
+import numpy as np
+import pandas as pd
+from functools import partial
+
+sys.path.insert(0,
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.star import (read_block, read_star, sample_star,  # noqa: E402
+                        scan_star, stream_select, write_star)
+from utils.sampling import is_subset  # noqa: E402
+from utils.selection import compile_selection  # noqa: E402
 
 
 def setupParserOptions():
@@ -14,7 +25,8 @@ def setupParserOptions():
                     help="Provide the path to the input star file.")
     ap.add_argument('-o',
                     '--output',
-                    help='Provide the path/name of the output star file.')
+                    help='Provide the path/name of the output star file.\
+                         A name ending with .gz is compressed.')
     ap.add_argument('--blockheader',
                     default=None,
                     help='Provide the block header you want to operate on.\
@@ -46,51 +58,168 @@ def setupParserOptions():
                          Can be a num.')
     ap.add_argument('--subset',
                     default=1.0,
-                    help='Take a subset (0 to 1) of the samples.\
+                    help='Take a subset of the samples, a fraction\
+                         (0 to 1) or a number of samples.\
                          Default is 1, which uses all samples in the file.')
+    ap.add_argument('--seed',
+                    type=int,
+                    default=None,
+                    help='Random seed of --subset, for a reproducible\
+                         subset. Default is None.')
+    ap.add_argument('--stratify',
+                    default=None,
+                    help='With --subset, take the same fraction of the\
+                         samples of each value of this column\
+                         (e.g.: rlnMicrographName or rlnClassNumber).')
+    ap.add_argument('--expr',
+                    default=None,
+                    help='Select entries matching an expression, e.g.\
+                         "rlnDefocusU > 10000 & rlnClassNumber in (1,3)".\
+                         Written to --output.')
+    ap.add_argument('--selection',
+                    nargs=2,
+                    action='append',
+                    metavar=('EXPR', 'OUTPUT'),
+                    default=None,
+                    help='Write the entries matching EXPR to OUTPUT.\
+                         Can be given several times, all selections are\
+                         made from one read of the input.')
+    ap.add_argument('--stream',
+                    default=False,
+                    action="store_true",
+                    help='Filter the block chunk by chunk in a single pass,\
+                         copying the other blocks verbatim.\
+                         Memory use does not grow with the file size.')
+    ap.add_argument('--chunksize',
+                    type=int,
+                    default=100000,
+                    help='Rows per chunk with --stream. Default is 100000.')
     args = vars(ap.parse_args())
     return args
 
 
-def readstarfile(input, blockheader, subset):
-    df = starfile.read(input)
+def pick_block(blocks, blockheader):
+    '''
+    Name of the block to operate on: blockheader, else the first loop
+    block, None if there is none.
+    '''
     if blockheader is not None:
-        df = df[blockheader]
-    if subset < 1.0:
-        df = df.sample(frac=subset)
-    return df
+        return blockheader
+    return next((name for name, b in blocks.items()
+                 if isinstance(b, pd.DataFrame)), None)
 
 
-def select(df, key, equals_to, smaller_than, bigger_than):
+def readstarfile(input, blockheader, subset, stratify=None, seed=None):
+    '''
+    All blocks of input, and the name of the block to operate on (see
+    pick_block). With a subset only the sampled rows of that block are
+    parsed.
+    '''
+    if not is_subset(subset):
+        blocks = read_star(input)
+        return blocks, pick_block(blocks, blockheader)
+    found = scan_star(input)
+    target = blockheader
+    if target is None:
+        target = next(b['name'] for b in found if b['kind'] == 'loop')
+    df = sample_star(input, target, subset, stratify, seed)
+    blocks = {
+        b['name']: df if b['name'] == target else read_block(
+            input, b['name'])
+        for b in found
+    }
+    return blocks, target
+
+
+def select_mask(df, key, equals_to, smaller_than, bigger_than):
+    mask = np.ones(len(df), dtype=bool)
     if smaller_than is not None:
-        df = df[df[key] < smaller_than]
+        mask &= (df[key] < smaller_than).to_numpy()
     if bigger_than is not None:
-        df = df[df[key] > bigger_than]
+        mask &= (df[key] > bigger_than).to_numpy()
     if equals_to is not None:
         try:
             e = float(equals_to)  # if equals to is a number
-            df = df[df[key] == e]
+            mask &= (df[key] == e).to_numpy()
         except ValueError:
             e_list = [e.strip() for e in equals_to.split(',')]
-            df = df[df[key].astype(str).isin(e_list)]
-    return df
+            mask &= df[key].astype(str).isin(e_list).to_numpy()
+    return mask
 
 
-def writestarfile(df, input, blockheader, output):
-    old_df = starfile.read(input)
-    if blockheader is not None:
-        old_df[blockheader] = df
+def select(df, key, equals_to, smaller_than, bigger_than):
+    return df[select_mask(df, key, equals_to, smaller_than, bigger_than)]
+
+
+def select_all(df):
+    return np.ones(len(df), dtype=bool)
+
+
+def selectors(args):
+    '''(selector, columns, output) of every requested selection.'''
+    sels = []
+    if args['select']:
+        sels.append((partial(select_mask,
+                             key=args['key'],
+                             equals_to=args['equals_to'],
+                             smaller_than=args['smaller_than'],
+                             bigger_than=args['bigger_than']), [args['key']],
+                     args['output']))
+    elif args['expr'] is not None:
+        sel = compile_selection(args['expr'])
+        sels.append((sel, sel.columns, args['output']))
+    elif not args['selection']:
+        sels.append((select_all, [], args['output']))
+    for expr, output in args['selection'] or []:
+        sel = compile_selection(expr)
+        sels.append((sel, sel.columns, output))
+    return sels
+
+
+def writestarfile(df, input, block, output, blocks=None):
+    '''
+    Write the blocks of input (or blocks) to output, with df in place of
+    the block named block, or df alone if block is None.
+    '''
+    old_df = dict(read_star(input) if blocks is None else blocks)
+    if block is not None:
+        old_df[block] = df
     else:
         old_df = df
-    starfile.write(old_df, output, overwrite=True)
+    write_star(old_df, output)
 
 
 def main(**args):
-    df = readstarfile(args['input'], args['blockheader'], args['subset'])
-    if args['select']:
-        df = select(df, args['key'], args['equals_to'], args['smaller_than'],
-                    args['bigger_than'])
-    writestarfile(df, args['input'], args['blockheader'], args['output'])
+    sels = selectors(args)
+    if args['stream']:
+        if args['stratify'] is not None:
+            raise ValueError('--stratify needs the whole block, it cannot '
+                             'be used with --stream')
+        columns = []
+        for _, cols, _ in sels:
+            columns += [c for c in cols if c not in columns]
+        stream_select(args['input'], [o for _, _, o in sels],
+                      [sel for sel, _, _ in sels],
+                      block=args['blockheader'],
+                      columns=columns,
+                      subset=float(args['subset']),
+                      seed=args['seed'],
+                      chunksize=args['chunksize'])
+        return
+
+    blocks, name = readstarfile(args['input'], args['blockheader'],
+                                float(args['subset']), args['stratify'],
+                                args['seed'])
+    for sel, _, output in sels:
+        if sel is select_all:
+            # Nothing selected, the blocks are written as read.
+            write_star(blocks, output)
+            continue
+        if name is None:
+            raise ValueError('%s has no loop block to select from' %
+                             args['input'])
+        df = blocks[name]
+        writestarfile(df[sel(df)], args['input'], name, output, blocks)
 
 
 if __name__ == '__main__':
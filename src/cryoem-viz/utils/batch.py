@@ -0,0 +1,149 @@
+'''
+Shared batch runner for the file conversion tools.
+Tasks are argument tuples for a top-level function (so they can be sent
+to worker processes); the first element is used as the label of the task,
+usually the input file name, and only the label is kept in the summary.
+Errors are captured per task and reported in the summary instead of
+stopping the batch.
+'''
+
+import os
+import time
+import itertools
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+def _run_chunk(func, chunk, values=False):
+    # Only the outcome goes back to the parent, not the task.
+    results = []
+    for task in chunk:
+        t0 = time.perf_counter()
+        value, error, tb = None, None, None
+        try:
+            value = func(*task)
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+            tb = traceback.format_exc()
+        result = dict(ok=error is None,
+                      error=error,
+                      traceback=tb,
+                      seconds=time.perf_counter() - t0)
+        if values:
+            result['value'] = value
+        results.append(result)
+    return results
+
+
+def _chunks(tasks, chunksize):
+    tasks = iter(tasks)
+    while True:
+        chunk = list(itertools.islice(tasks, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_batch(func,
+              tasks,
+              workers=None,
+              chunksize=None,
+              max_inflight=None,
+              skipped=0,
+              verbose=True,
+              label=None,
+              values=False,
+              callback=None):
+    '''
+    Run func(*task) for every task in a process pool.
+    workers is the number of processes (default os.cpu_count()); with 1
+    the tasks run in the calling process. tasks may be a generator: it is
+    consumed in chunks of chunksize as the workers need them, and at most
+    max_inflight chunks (default 2 * workers) are queued at a time, which
+    bounds the memory held by pending work.
+    Each task is recorded by label(task), default task[0], and with
+    values by the return value of func as well. callback(record) is
+    called in this process as each record arrives.
+    skipped is only reported, it counts tasks the caller filtered out.
+    Returns a summary dict, see print_summary.
+    '''
+    label = label or (lambda task: task[0])
+    workers = workers or os.cpu_count() or 1
+    if hasattr(tasks, '__len__'):
+        workers = max(1, min(workers, len(tasks) or 1))
+        if chunksize is None:
+            chunksize = max(1, min(16, len(tasks) // (workers * 8)))
+    chunksize = chunksize or 1
+    max_inflight = max_inflight or 2 * workers
+
+    t0 = time.perf_counter()
+    records = []
+
+    def collect(labels, results):
+        for name, record in zip(labels, results):
+            record['label'] = name
+            records.append(record)
+            if callback is not None:
+                callback(record)
+
+    if workers == 1:
+        for chunk in _chunks(tasks, chunksize):
+            collect([label(t) for t in chunk],
+                    _run_chunk(func, chunk, values))
+    else:
+        if verbose:
+            print('Processing in %d parallel processes....' % workers)
+        with ProcessPoolExecutor(workers) as pool:
+            pending = {}
+            for chunk in _chunks(tasks, chunksize):
+                f = pool.submit(_run_chunk, func, chunk, values)
+                pending[f] = [label(t) for t in chunk]
+                del chunk
+                if len(pending) >= max_inflight:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        collect(pending.pop(f), f.result())
+            for f in list(pending):
+                collect(pending.pop(f), f.result())
+
+    summary = dict(records=records,
+                   elapsed=time.perf_counter() - t0,
+                   skipped=skipped)
+    if verbose:
+        print_summary(summary)
+    return summary
+
+
+def succeeded(summary):
+    return [r['label'] for r in summary['records'] if r['ok']]
+
+
+def failed(summary):
+    return [r for r in summary['records'] if not r['ok']]
+
+
+def print_summary(summary):
+    records = summary['records']
+    skipped = summary['skipped']
+    elapsed = summary['elapsed']
+    bad = failed(summary)
+    rate = len(records) / elapsed if elapsed > 0 else 0.
+    msg = 'Processed %d files in %.1f s (%.2f files/s): %d done, %d failed' % (
+        len(records), elapsed, rate, len(records) - len(bad), len(bad))
+    if skipped:
+        msg += ', %d skipped' % skipped
+    print(msg + '.')
+    for r in bad:
+        print('  FAILED %s: %s' % (r['label'], r['error']))
+
+
+def print_timings(summary, slowest=10):
+    '''Per-file seconds: their distribution and the slowest files.'''
+    records = sorted(summary['records'], key=lambda r: -r['seconds'])
+    if not records:
+        return
+    t = [r['seconds'] for r in records]
+    print('Seconds per file: mean %.2f, median %.2f, max %.2f.' %
+          (sum(t) / len(t), t[len(t) // 2], t[0]))
+    for r in records[:slowest]:
+        print('  %8.2f s  %s' % (r['seconds'], r['label']))
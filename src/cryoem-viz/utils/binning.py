@@ -0,0 +1,217 @@
+'''
+Histograms of particle tables binned here instead of in the browser, so
+a plot carries bin counts rather than every value and its size does not
+depend on the number of particles. Orientations are binned on an
+equal-area grid of the sphere (sphere_grid) the same way.
+'''
+
+import warnings
+import numpy as np
+
+MAX_BINS = 1000
+# Rows binned at a time, bounding the memory of the index arrays.
+CHUNK = 1 << 20
+# Rows the quartiles of the 'auto' bin width are estimated from.
+SAMPLE = 100000
+
+
+def _auto_bins(a, lo, hi):
+    '''
+    Bin counts per column of a, as numpy's 'auto' (the larger of the
+    Freedman-Diaconis and Sturges counts), capped at MAX_BINS.
+    '''
+    n = np.sum(np.isfinite(a), axis=0)
+    sturges = np.log2(np.maximum(n, 1)) + 1
+    # The quartiles of every few rows are as good for the bin width.
+    step = max(1, len(a) // SAMPLE)
+    with warnings.catch_warnings():
+        # Columns without values get the Sturges count.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        q75, q25 = np.nanpercentile(a[::step], [75, 25], axis=0)
+    width = 2 * (q75 - q25) / np.cbrt(np.maximum(n, 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fd = np.where(width > 0, (hi - lo) / width, 0)
+    return np.clip(np.ceil(np.maximum(fd, sturges)), 1,
+                   MAX_BINS).astype(int)
+
+
+def bin_edges(a, bins='auto'):
+    '''
+    Edges of the bins of each column of the 2d array a, a list of arrays.
+    bins is a number of bins or 'auto'. With 'auto', integer columns with
+    few values (e.g. rlnClassNumber) get one bin per integer.
+    '''
+    with np.errstate(invalid='ignore'):
+        lo = np.nanmin(a, axis=0)
+        hi = np.nanmax(a, axis=0)
+    lo = np.where(np.isfinite(lo), lo, 0.)
+    hi = np.where(np.isfinite(hi), hi, 1.)
+    if bins == 'auto':
+        nbins = _auto_bins(a, lo, hi)
+        with np.errstate(invalid='ignore'):
+            integer = np.all((a == np.round(a)) | np.isnan(a), axis=0)
+        unit = integer & (hi - lo < MAX_BINS)
+    else:
+        nbins = np.full(a.shape[1], int(bins))
+        unit = np.zeros(a.shape[1], dtype=bool)
+    edges = []
+    for i in range(a.shape[1]):
+        if unit[i]:
+            edges.append(np.arange(lo[i] - 0.5, hi[i] + 1))
+        elif hi[i] > lo[i]:
+            edges.append(np.linspace(lo[i], hi[i], nbins[i] + 1))
+        else:
+            # A constant column, spread over a unit range as np.histogram
+            # does, in one bin unless a number of bins is given.
+            n = 1 if bins == 'auto' else nbins[i]
+            edges.append(np.linspace(lo[i] - 0.5, lo[i] + 0.5, n + 1))
+    return edges
+
+
+def histograms(df, bins='auto'):
+    '''
+    (edges, counts) of each column of df, with bins as in bin_edges.
+    All columns are binned together: each value is mapped to an index
+    into one array of the bins of all columns and counted by a single
+    bincount per chunk of rows.
+    '''
+    a = df.to_numpy(dtype=np.float64, na_value=np.nan)
+    edges = bin_edges(a, bins)
+    nbins = np.array([len(e) - 1 for e in edges])
+    offset = np.concatenate([[0], np.cumsum(nbins)[:-1]])
+    lo = np.array([e[0] for e in edges])
+    scale = nbins / np.array([e[-1] - e[0] for e in edges])
+    # All edges in one array, those of column i start at first[i].
+    flat = np.concatenate(edges)
+    first = offset + np.arange(len(edges))
+    total = nbins.sum()
+    counts = np.zeros(total + 1, dtype=np.int64)
+    for start in range(0, len(a), CHUNK):
+        chunk = a[start:start + CHUNK]
+        missing = np.isnan(chunk)
+        f = np.where(missing, 0, (chunk - lo) * scale)
+        # The upper edge belongs to the last bin, as in np.histogram.
+        np.clip(f, 0, nbins - 1, out=f)
+        idx = f.astype(np.intp)
+        # As np.histogram, move values the rounding put in the bin next
+        # to theirs, so values on an edge count in the bin above it.
+        idx -= chunk < flat[idx + first]
+        idx += (chunk >= flat[idx + first + 1]) & (idx < nbins - 1)
+        idx += offset
+        # Missing values are counted in a last, dropped bin.
+        idx[missing] = total
+        counts += np.bincount(idx.ravel(), minlength=total + 1)
+    return [(e, counts[o:o + n]) for e, o, n in zip(edges, offset, nbins)]
+
+
+def grid2d(x, y, gridsize, values=None, reduce='mean'):
+    '''
+    (xedges, yedges, counts, reduced, pixel) of points x, y binned into
+    a gridsize by gridsize grid spanning their range. counts and reduced
+    are indexed [ix, iy]; reduced is the mean or max of values in each
+    pixel (nan where empty), None without values. pixel is the flat
+    index of the pixel of each point, -1 for points with missing x or y.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = bin_edges(np.column_stack([x, y]), gridsize)
+    xedges, yedges = edges
+    ix, iy = (
+        np.clip((a - e[0]) * (gridsize / (e[-1] - e[0])), 0, gridsize - 1)
+        for a, e in ((x, xedges), (y, yedges)))
+    valid = np.isfinite(ix) & np.isfinite(iy)
+    pixel = np.full(len(x), -1, dtype=np.intp)
+    pixel[valid] = (ix[valid].astype(np.intp) * gridsize +
+                    iy[valid].astype(np.intp))
+    shape = (gridsize, gridsize)
+    counts = np.bincount(pixel[valid], minlength=gridsize**2)
+    reduced = None
+    if values is not None:
+        values = np.asarray(values, dtype=np.float64)
+        keep = valid & np.isfinite(values)
+        if reduce == 'mean':
+            n = np.bincount(pixel[keep], minlength=gridsize**2)
+            total = np.bincount(pixel[keep], values[keep],
+                                minlength=gridsize**2)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                reduced = total / n
+        elif reduce == 'max':
+            reduced = np.full(gridsize**2, -np.inf)
+            np.maximum.at(reduced, pixel[keep], values[keep])
+            reduced[np.isneginf(reduced)] = np.nan
+        else:
+            raise ValueError('Unknown reduction %s. Available: mean, max' %
+                             reduce)
+        reduced = reduced.reshape(shape)
+    return xedges, yedges, counts.reshape(shape), reduced, pixel
+
+
+def densest(pixel, counts, n, rng=None):
+    '''
+    Positions of at most n points, taken from the pixels with the most
+    points, in increasing order (the order of the table, not of density).
+    pixel and counts are as from grid2d.
+    '''
+    flat = counts.ravel()
+    order = np.argsort(flat)[::-1]
+    # Enough of the densest pixels to hold n points.
+    k = np.searchsorted(np.cumsum(flat[order]), n) + 1
+    pos = np.nonzero(np.isin(pixel, order[:k]))[0]
+    if len(pos) > n:
+        rng = np.random.default_rng(rng)
+        pos = np.sort(rng.choice(pos, n, replace=False))
+    return pos
+
+
+def sphere_grid(rings):
+    '''
+    Equal-area grid of the unit sphere, as in HEALPix but without healpy:
+    rings bands of latitude, each cut in longitude into about square
+    cells, fewer towards the poles. Returns (zedges, ncells), the z of
+    the band edges from the north pole down and the number of cells of
+    each band. The band heights make all cells of area 4 pi / total.
+    '''
+    theta = (np.arange(rings) + 0.5) * np.pi / rings
+    ncells = np.maximum(1, np.round(2 * rings * np.sin(theta))).astype(int)
+    zedges = 1 - 2 * np.concatenate([[0], np.cumsum(ncells)]) / ncells.sum()
+    return zedges, ncells
+
+
+def sphere_cells(rot, tilt, grid):
+    '''
+    Flat index into the cells of grid (from sphere_grid) of the view
+    direction of each rot, tilt pair in degrees, -1 where either is
+    missing. Cells are numbered band by band, west to east from rot 0.
+    '''
+    zedges, ncells = grid
+    rot = np.asarray(rot, dtype=np.float64)
+    tilt = np.asarray(tilt, dtype=np.float64)
+    z = np.cos(np.radians(tilt))
+    band = np.searchsorted(-zedges, -z, side='right') - 1
+    np.clip(band, 0, len(ncells) - 1, out=band)
+    n = ncells[band]
+    with np.errstate(invalid='ignore'):
+        cell = np.minimum((np.mod(rot, 360.) / 360. * n).astype(np.intp),
+                          n - 1)
+    offset = np.concatenate([[0], np.cumsum(ncells)[:-1]])
+    cell += offset[band]
+    cell[~(np.isfinite(rot) & np.isfinite(tilt))] = -1
+    return cell
+
+
+def cell_means(cell, total, a):
+    '''
+    (counts, means) of the points in each of total cells, cell as from
+    sphere_cells. means has the mean of each column of the 2d array a
+    per cell, nan where the cell has no values of the column.
+    '''
+    valid = cell >= 0
+    counts = np.bincount(cell[valid], minlength=total)
+    means = np.full((total, a.shape[1]), np.nan)
+    for i in range(a.shape[1]):
+        keep = valid & np.isfinite(a[:, i])
+        n = np.bincount(cell[keep], minlength=total)
+        sums = np.bincount(cell[keep], a[keep, i], minlength=total)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[:, i] = sums / n
+    return counts, means
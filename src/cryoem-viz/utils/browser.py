@@ -0,0 +1,271 @@
+'''
+One page browsing the micrographs of a particle file, instead of one
+standalone html per micrograph.
+
+The output directory holds
+  browser.html             the page, with the list of micrographs
+  plotly-<version>.min.js  shared by the page
+  images/<stem>.png        the downsampled micrograph
+  coords/<stem>.js         its particles, a float32 column table
+The page loads the image and the table of a micrograph only when it is
+selected. Tables are base64 in a small script rather than raw binary
+files, so the page also works opened from disk (file://), where fetch
+is not allowed.
+'''
+
+import os
+import html
+import json
+import base64
+import numpy as np
+from urllib.parse import quote
+from utils.html import bundle, bundle_name
+from utils.plotting import RENDER_MODES, WEBGL_THRESHOLD
+from utils.utils import to_image
+
+PAGE = 'browser.html'
+IMAGES = 'images'
+COORDS = 'coords'
+
+TEMPLATE = '''<!doctype html>
+<html>
+<head>
+<meta charset="utf-8" />
+<title>@TITLE@</title>
+<script charset="utf-8" src="@PLOTLYJS@"></script>
+<style>
+body {margin: 0; font-family: sans-serif; font-size: 13px;
+      display: flex; height: 100vh;}
+#side {width: 280px; display: flex; flex-direction: column;
+       border-right: 1px solid #ccc;}
+#controls {padding: 8px; border-bottom: 1px solid #ccc;}
+#controls input[type=range] {width: 100%;}
+#list {flex: 1; overflow-y: auto; margin: 0; padding: 0;
+       list-style: none;}
+#list li {display: flex; align-items: center; padding: 2px 8px;
+          cursor: pointer; white-space: nowrap;}
+#list li.active {background: #def;}
+#list img {height: 48px; width: 48px; object-fit: cover;
+           margin-right: 6px; background: #eee;}
+#main {flex: 1; display: flex; flex-direction: column;}
+#plot {flex: 1;}
+</style>
+</head>
+<body>
+<div id="side">
+  <div id="controls">
+    <div><button id="prev">&lt;</button> <span id="pos"></span>
+      <button id="next">&gt;</button></div>
+    <input id="slider" type="range" min="0" value="0" />
+    Color <select id="color"></select>
+  </div>
+  <ul id="list"></ul>
+</div>
+<div id="main">
+  <div id="name" style="padding: 6px 8px;"></div>
+  <div id="plot"></div>
+</div>
+<script>
+var MICS = @MICS@;
+var COLUMNS = @COLUMNS@;
+var RENDER = @RENDER@;
+var WEBGL_THRESHOLD = @THRESHOLD@;
+var current = -1, table = null, pending = {};
+
+// Called by coords/<stem>.js.
+function cryoemVizCoords(stem, data) {
+    var raw = atob(data);
+    var bytes = new Uint8Array(raw.length);
+    for (var i = 0; i < raw.length; i++) bytes[i] = raw.charCodeAt(i);
+    var cb = pending[stem];
+    delete pending[stem];
+    if (cb) cb(new Float32Array(bytes.buffer));
+}
+
+function load(m) {
+    return new Promise(function (resolve, reject) {
+        pending[m.stem] = resolve;
+        var s = document.createElement('script');
+        s.src = 'coords/' + encodeURIComponent(m.stem) + '.js';
+        s.onload = function () { s.remove(); };
+        s.onerror = function () { s.remove(); reject(s.src); };
+        document.head.appendChild(s);
+    });
+}
+
+function column(m, data, k) {
+    return data.subarray(k * m.n, (k + 1) * m.n);
+}
+
+function webgl(n) {
+    return RENDER == 'webgl' || (RENDER == 'auto' && n > WEBGL_THRESHOLD);
+}
+
+function draw(m, data) {
+    var c = document.getElementById('color').value;
+    var k = COLUMNS.indexOf(c);
+    var trace = {
+        type: webgl(m.n) ? 'scattergl' : 'scatter',
+        mode: 'markers',
+        x: column(m, data, 0),
+        y: column(m, data, 1),
+        marker: {color: column(m, data, k + 2), colorscale: 'Viridis',
+                 size: 5, showscale: true},
+        hovertemplate: c + ': %{marker.color:.3f}',
+        name: ''
+    };
+    var layout = {
+        xaxis: {range: [0, m.width], title: {text: 'rlnCoordinateX'},
+                showgrid: false, zeroline: false},
+        yaxis: {range: [m.height, 0], title: {text: 'rlnCoordinateY'},
+                showgrid: false, zeroline: false,
+                scaleanchor: 'x', scaleratio: 1},
+        images: [{source: 'images/' + encodeURIComponent(m.stem) + '.png',
+                  xref: 'x', yref: 'y', x: 0, y: 0,
+                  sizex: m.width, sizey: m.height, sizing: 'stretch',
+                  xanchor: 'left', yanchor: 'top', layer: 'below'}],
+        margin: {t: 10, b: 40, l: 50, r: 10}
+    };
+    Plotly.react('plot', [trace], layout, {responsive: true});
+}
+
+function show(i) {
+    i = Math.max(0, Math.min(MICS.length - 1, i));
+    if (i == current) return;
+    var items = document.getElementById('list').children;
+    if (current >= 0) items[current].classList.remove('active');
+    items[i].classList.add('active');
+    items[i].scrollIntoView({block: 'nearest'});
+    current = i;
+    var m = MICS[i];
+    document.getElementById('slider').value = i;
+    document.getElementById('pos').textContent =
+        (i + 1) + ' / ' + MICS.length;
+    document.getElementById('name').textContent =
+        m.name + ' (' + m.n + ' particles)';
+    load(m).then(function (data) {
+        if (current != i) return;
+        table = data;
+        draw(m, data);
+    }, function (src) {
+        document.getElementById('name').textContent = 'Cannot load ' + src;
+    });
+}
+
+(function () {
+    var select = document.getElementById('color');
+    COLUMNS.forEach(function (c) {
+        var o = document.createElement('option');
+        o.value = o.textContent = c;
+        select.appendChild(o);
+    });
+    select.onchange = function () {
+        if (table) draw(MICS[current], table);
+    };
+    var list = document.getElementById('list');
+    MICS.forEach(function (m, i) {
+        var li = document.createElement('li');
+        var img = document.createElement('img');
+        img.loading = 'lazy';
+        img.src = 'images/' + encodeURIComponent(m.stem) + '.png';
+        li.appendChild(img);
+        li.appendChild(document.createTextNode(m.stem + ' (' + m.n + ')'));
+        li.onclick = function () { show(i); };
+        list.appendChild(li);
+    });
+    var slider = document.getElementById('slider');
+    slider.max = MICS.length - 1;
+    slider.oninput = function () { show(+slider.value); };
+    document.getElementById('prev').onclick = function () {
+        show(current - 1);
+    };
+    document.getElementById('next').onclick = function () {
+        show(current + 1);
+    };
+    document.addEventListener('keydown', function (e) {
+        if (e.key == 'ArrowLeft' || e.key == 'ArrowUp') show(current - 1);
+        if (e.key == 'ArrowRight' || e.key == 'ArrowDown') show(current + 1);
+    });
+    if (MICS.length) show(0);
+})();
+</script>
+</body>
+</html>
+'''
+
+
+def stems(names):
+    '''
+    File stems of micrographs, the basename up to the first dot as in
+    the per-micrograph html names, made unique with a numeric suffix.
+    '''
+    seen = {}
+    out = []
+    for name in names:
+        stem = os.path.basename(name).split('.')[0]
+        if stem in seen:
+            seen[stem] += 1
+            stem = '%s-%d' % (stem, seen[stem])
+        else:
+            seen[stem] = 0
+        out.append(stem)
+    return out
+
+
+def write_coords(path, stem, table):
+    '''Write the 2d float table as a script handing it to the page.'''
+    data = np.ascontiguousarray(np.asarray(table, dtype='<f4').T)
+    with open(path, 'w', encoding='ascii') as f:
+        f.write('cryoemVizCoords(%s, "%s");\n' %
+                (json.dumps(stem),
+                 base64.b64encode(data.tobytes()).decode('ascii')))
+
+
+def write_micrograph(odir, stem, name, img, df, factor, columns):
+    '''
+    Write the image of one micrograph, downsampled by factor, and the
+    table of its particles: x and y in image pixels, then columns.
+    Returns its entry of the page.
+    '''
+    to_image(img).save(os.path.join(odir, IMAGES, stem + '.png'))
+    table = np.column_stack([
+        df['rlnCoordinateX'].to_numpy(dtype=float) * factor,
+        df['rlnCoordinateY'].to_numpy(dtype=float) * factor,
+    ] + [df[c].to_numpy(dtype=float) for c in columns])
+    write_coords(os.path.join(odir, COORDS, stem + '.js'), stem, table)
+    return dict(name=name,
+                stem=stem,
+                n=len(df),
+                width=img.shape[1],
+                height=img.shape[0])
+
+
+def prepare(odir):
+    '''Create the directories of a browser in odir.'''
+    for d in (IMAGES, COORDS):
+        os.makedirs(os.path.join(odir, d), exist_ok=True)
+    bundle(odir)
+
+
+def write_browser(odir, entries, columns, render='auto', title=None):
+    '''Write the page of the micrographs entries into odir.'''
+    if render not in RENDER_MODES:
+        raise ValueError('Unknown render mode %s. Available: %s' %
+                         (render, ', '.join(RENDER_MODES)))
+    title = title or os.path.basename(os.path.abspath(odir))
+    values = {
+        '@TITLE@': html.escape(title),
+        # No '</script>' may end the script early.
+        '@MICS@': json.dumps(entries).replace('</', '<\\/'),
+        '@COLUMNS@': json.dumps(list(columns)),
+        '@RENDER@': json.dumps(render),
+        '@THRESHOLD@': str(WEBGL_THRESHOLD),
+        '@PLOTLYJS@': quote(bundle_name()),
+    }
+    page = TEMPLATE
+    for key, value in values.items():
+        page = page.replace(key, value)
+    path = os.path.join(odir, PAGE)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(page)
+    return path
@@ -0,0 +1,145 @@
+'''
+On-disk cache of downsampled micrographs shared by every tool.
+Entries are .npy files named by a hash of (real path, inode, mtime, size,
+target height, FFT backend, ALGO_VERSION), so a changed or replaced source
+never hits a stale entry. The cache is bounded in size: the least recently
+used entries are evicted first. Writes are atomic, so several processes
+can share one cache directory.
+
+Each process keeps an estimate of the cache size, the size found by its
+last scan of the directory plus what it wrote since. The directory is
+only scanned again every RESCAN writes, or when the estimate exceeds the
+limit, so a batch does not walk the whole cache on every write.
+
+The cache directory is taken from --cache or the CRYOEM_VIZ_CACHE
+environment variable; without either nothing is cached.
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+
+from utils.utils import downsample
+from utils.mrcio import read_micrograph, mrc_shape
+
+# Bump when the output of utils.downsample changes.
+ALGO_VERSION = 1
+
+CACHE_ENV = 'CRYOEM_VIZ_CACHE'
+
+# Writes between two scans of the cache directory.
+RESCAN = 64
+# Eviction stops at this fraction of the limit, so the next writes do not
+# each evict again.
+LOW_WATER = 0.9
+
+# Size estimate of each cache root in this process: [bytes, writes].
+# Module level, as tasks bring their own copy of the RenderCache.
+_usage = {}
+
+
+class RenderCache:
+
+    def __init__(self, root, max_bytes=10 * 2**30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, path, height, backend='numpy'):
+        st = os.stat(path)
+        ident = [
+            os.path.realpath(path), st.st_ino, st.st_mtime_ns, st.st_size,
+            int(height), backend, ALGO_VERSION
+        ]
+        return hashlib.sha1(json.dumps(ident).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npy')
+
+    def get(self, key):
+        p = self._path(key)
+        try:
+            arr = np.load(p)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(p)  # mark as recently used
+        except OSError:
+            pass
+        return arr
+
+    def put(self, key, arr):
+        p = self._path(key)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        tmp = p + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp, p)
+        usage = _usage.get(self.root)
+        if usage is None or usage[1] >= RESCAN:
+            usage = _usage[self.root] = [self.size(), 0]
+        else:
+            usage[0] += os.path.getsize(p)
+            usage[1] += 1
+        if usage[0] > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        '''(mtime, size, path) of every entry.'''
+        out = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for e in os.scandir(sub.path):
+                if e.name.endswith('.npy'):
+                    try:
+                        st = e.stat()
+                    except FileNotFoundError:
+                        # Evicted by another worker since the listing.
+                        continue
+                    out.append((st.st_mtime, st.st_size, e.path))
+        return out
+
+    def size(self):
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        '''Remove the least recently used entries, down to LOW_WATER.'''
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        if total > self.max_bytes:
+            for _, size, p in sorted(entries):
+                if total <= LOW_WATER * self.max_bytes:
+                    break
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+                total -= size
+        _usage[self.root] = [total, 0]
+
+
+def get_cache(root=None, size_gb=10.):
+    '''RenderCache in root or $CRYOEM_VIZ_CACHE, None if neither is set.'''
+    root = root or os.environ.get(CACHE_ENV)
+    if not root:
+        return None
+    return RenderCache(root, max_bytes=int(float(size_gb) * 2**30))
+
+
+def load_downsampled(path, height, cache=None, backend='numpy'):
+    '''
+    Micrograph at path downsampled to height, through the cache if given.
+    Returns the image and the (m, n) shape of the full size micrograph.
+    '''
+    shape = mrc_shape(path)[-2:]
+    if cache is not None:
+        key = cache.key(path, height, backend)
+        img = cache.get(key)
+        if img is not None:
+            return img, shape
+    img = downsample(read_micrograph(path), height, backend=backend)
+    if cache is not None:
+        cache.put(key, img)
+    return img, shape
@@ -0,0 +1,148 @@
+'''
+FFT downsampling engine.
+
+A Downsampler is built for one input shape and one target height. It keeps
+the cropped spectrum as a preallocated scratch buffer and reuses the FFT
+plans of its backend across calls, so a stack of same-shaped micrographs
+is downsampled without any per-image setup.
+'''
+
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+_BACKENDS = {}
+
+
+def register_backend(name, rfft2, irfft2, threaded=False):
+    '''
+    Register an FFT backend.
+    rfft2(a, workers) and irfft2(a, s, workers) take and return arrays
+    the same way numpy.fft does, transforming the last two axes.
+    threaded tells whether the backend honours workers.
+    '''
+    _BACKENDS[name] = dict(rfft2=rfft2, irfft2=irfft2, threaded=threaded)
+
+
+def available_backends():
+    return sorted(_BACKENDS)
+
+
+register_backend('numpy',
+                 lambda a, workers: np.fft.rfft2(a),
+                 lambda a, s, workers: np.fft.irfft2(a, s=s))
+
+try:
+    import scipy.fft as _sfft
+except ImportError:
+    pass
+else:
+    # scipy.fft (pocketfft with a plan cache) can use several threads.
+    register_backend(
+        'scipy',
+        lambda a, workers: _sfft.rfft2(a, workers=workers),
+        lambda a, s, workers: _sfft.irfft2(
+            a, s=s, workers=workers, overwrite_x=True),
+        threaded=True)
+
+
+def output_shape(shape, height):
+    '''
+    Shape (height, width) of the downsampled image.
+    The width keeps the h/w ratio and is rounded down to an even number.
+    '''
+    m, n = shape[-2:]
+    ds_factor = m / height
+    width = int(n / ds_factor / 2) * 2
+    return height, width
+
+
+class Downsampler:
+    '''
+    Downsample 2d images of a fixed shape to a fixed height using
+    fourier cropping. Calling it on a (m, n) image returns a (h, w) image,
+    calling it on a (k, m, n) stack returns a (k, h, w) stack.
+    batch is the number of images transformed together, which bounds the
+    size of the full resolution spectrum kept in memory.
+    '''
+
+    def __init__(self, shape, height, backend='numpy', workers=None,
+                 batch=4):
+        if backend not in _BACKENDS:
+            raise ValueError('Unknown FFT backend %s. Available: %s' %
+                             (backend, ', '.join(available_backends())))
+        self.shape = tuple(shape[-2:])
+        self.height, self.width = output_shape(self.shape, height)
+        self.backend = backend
+        self.workers = workers
+        self.batch = max(1, int(batch))
+        self._fft = _BACKENDS[backend]
+        self._local = threading.local()
+
+        # Rows kept from the positive and negative frequency halves.
+        self._top = self.height // 2
+        self._bottom = -self.height // 2
+        self._cols = self.width // 2 + 1
+
+    def _scratch(self, k, dtype):
+        '''Cropped spectrum buffer, one per thread, grown on demand.'''
+        buf = getattr(self._local, 'buf', None)
+        if buf is None or buf.shape[0] < k or buf.dtype != dtype:
+            buf = np.empty((k, self.height, self._cols), dtype=dtype)
+            self._local.buf = buf
+        return buf[:k]
+
+    def _crop(self, F):
+        k = F.shape[0]
+        G = self._scratch(k, F.dtype)
+        G[:, :self._top] = F[:, :self._top, :self._cols]
+        G[:, self._top:] = F[:, self._bottom:, :self._cols]
+        return G
+
+    def __call__(self, imgs):
+        imgs = np.asarray(imgs)
+        if imgs.shape[-2:] != self.shape:
+            raise ValueError('Expected images of shape %s, got %s' %
+                             (self.shape, imgs.shape[-2:]))
+        single = imgs.ndim == 2
+        stack = imgs.reshape((-1, ) + self.shape)
+
+        out = None
+        s = (self.height, self.width)
+        for i in range(0, len(stack), self.batch):
+            F = self._fft['rfft2'](stack[i:i + self.batch], self.workers)
+            f = self._fft['irfft2'](self._crop(F), s, self.workers)
+            del F
+            if out is None:
+                out = np.empty((len(stack), ) + s, dtype=f.dtype)
+            out[i:i + len(f)] = f
+
+        if single:
+            return out[0]
+        return out.reshape(imgs.shape[:-2] + s)
+
+
+@lru_cache(maxsize=16)
+def get_downsampler(shape, height, backend='numpy', workers=None):
+    '''Shared Downsampler for a given input shape and target height.'''
+    return Downsampler(shape, height, backend=backend, workers=workers)
+
+
+def downsample_levels(img, heights, backend='numpy', workers=None):
+    '''
+    img downsampled to each of heights (see output_shape) from a single
+    forward transform, the spectrum being cropped once per height.
+    '''
+    if backend not in _BACKENDS:
+        raise ValueError('Unknown FFT backend %s. Available: %s' %
+                         (backend, ', '.join(available_backends())))
+    fft = _BACKENDS[backend]
+    img = np.asarray(img)
+    F = fft['rfft2'](img, workers)
+    out = []
+    for height in heights:
+        h, w = output_shape(img.shape, height)
+        G = np.concatenate([F[:h // 2, :w // 2 + 1], F[-h // 2:, :w // 2 + 1]])
+        out.append(fft['irfft2'](G, (h, w), workers))
+    return out
@@ -0,0 +1,312 @@
+'''
+Figures written to HTML with compact array payloads.
+
+plotly.py embeds trace arrays as base64 typed arrays of their numpy dtype,
+usually float64. to_html narrows every typed array to the smallest type
+that holds its values (uint8 ... int32 for integers, float32 when its
+rounding error is below PRECISION of the value range), and with
+compress=True deflates it as well. Compressed arrays are inflated in the
+page with DecompressionStream before the figure is drawn.
+'''
+
+import os
+import html
+import uuid
+import zlib
+import base64
+import numpy as np
+import plotly.io as pio
+from urllib.parse import quote
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
+
+# How pages get plotly.js: embedded, a bundle next to them, or cdn.
+PLOTLYJS_MODES = ('embed', 'directory', 'cdn')
+INDEX = 'index.html'
+
+# Largest float32 rounding error allowed, relative to the value range.
+PRECISION = 1e-6
+
+_INTEGER = (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32)
+
+_SHORT = {
+    'int8': 'i1',
+    'uint8': 'u1',
+    'int16': 'i2',
+    'uint16': 'u2',
+    'int32': 'i4',
+    'uint32': 'u4',
+    'float32': 'f4',
+    'float64': 'f8',
+}
+
+# Replaces {dtype, zdata} arrays by {dtype, bdata} plotly.js decodes.
+INFLATE = '''
+function inflate(fig) {
+    var pending = [];
+    (function walk(obj) {
+        if (Array.isArray(obj)) {
+            obj.forEach(walk);
+        } else if (obj !== null && typeof obj === 'object') {
+            if (typeof obj.zdata === 'string') {
+                var raw = atob(obj.zdata);
+                var bytes = new Uint8Array(raw.length);
+                for (var i = 0; i < raw.length; i++) {
+                    bytes[i] = raw.charCodeAt(i);
+                }
+                var stream = new Blob([bytes]).stream().pipeThrough(
+                    new DecompressionStream('deflate'));
+                pending.push(new Response(stream).arrayBuffer().then(
+                    function (buf) {
+                        obj.bdata = buf;
+                        delete obj.zdata;
+                    }));
+            } else {
+                Object.keys(obj).forEach(function (k) { walk(obj[k]); });
+            }
+        }
+    })(fig);
+    return Promise.all(pending).then(function () { return fig; });
+}
+'''
+
+TEMPLATE = '''<!doctype html>
+<html>
+<head>
+    <meta charset="utf-8" />
+    <style>html, body {{height: 100%;}}</style>
+</head>
+<body>
+    <div style="height:100%; width:100%;">
+        {plotlyjs}
+        <div id="{div_id}" class="plotly-graph-div"
+             style="height:{height}; width:{width};"></div>
+        <script type="text/javascript">
+{inflate}
+            inflate({figure}).then(function (fig) {{
+                return Plotly.newPlot("{div_id}", fig);
+            }}).then(function () {{
+{post_script}
+            }});
+        </script>
+    </div>
+</body>
+</html>
+'''
+
+
+def narrow(a):
+    '''a in the smallest dtype plotly.js has that keeps its values.'''
+    if a.dtype.kind == 'b':
+        return a.astype(np.uint8)
+    if a.dtype.kind not in 'iuf' or not a.size:
+        return a
+    finite = a[np.isfinite(a)] if a.dtype.kind == 'f' else a
+    if not finite.size:
+        return a.astype(np.float32)
+    lo, hi = finite.min(), finite.max()
+    if len(finite) == a.size and (finite == np.round(finite)).all():
+        for t in _INTEGER:
+            info = np.iinfo(t)
+            if lo >= info.min and hi <= info.max:
+                return a.astype(t)
+    if a.dtype == np.float32:
+        return a
+    with np.errstate(over='ignore'):
+        a32 = a.astype(np.float32)
+    err = np.abs(a32[np.isfinite(a)] - finite).max()
+    if err <= PRECISION * ((hi - lo) or abs(hi)):
+        return a32
+    return a.astype(np.float64)
+
+
+def encode(a, compress=False):
+    '''A numpy array as a typed array spec, deflated with compress.'''
+    a = np.asarray(a)
+    a = narrow(a.ravel()).reshape(a.shape)
+    spec = dict(dtype=_SHORT[a.dtype.name])
+    if a.ndim > 1:
+        spec['shape'] = ', '.join(map(str, a.shape))
+    data = np.ascontiguousarray(a, dtype=a.dtype.newbyteorder('<')).tobytes()
+    if compress:
+        packed = zlib.compress(data, 6)
+        if len(packed) < len(data):
+            spec['zdata'] = base64.b64encode(packed).decode('ascii')
+            return spec
+    spec['bdata'] = base64.b64encode(data).decode('ascii')
+    return spec
+
+
+def decode(spec):
+    '''The numpy array of a typed array spec.'''
+    a = np.frombuffer(base64.b64decode(spec['bdata']),
+                      dtype='<' + spec['dtype'])
+    if 'shape' in spec:
+        a = a.reshape([int(n) for n in str(spec['shape']).split(',')])
+    return a
+
+
+def _is_spec(obj):
+    return isinstance(obj, dict) and 'dtype' in obj and 'bdata' in obj
+
+
+def pack(obj, compress=False):
+    '''Re-encode every typed array spec in a figure dict, in place.'''
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if _is_spec(v):
+                obj[k] = encode(decode(v), compress)
+            else:
+                pack(v, compress)
+    elif isinstance(obj, list):
+        for i, v in enumerate(obj):
+            if _is_spec(v):
+                obj[i] = encode(decode(v), compress)
+            else:
+                pack(v, compress)
+    return obj
+
+
+def bundle_name():
+    '''
+    File name of the plotly.js bundle, plotly-<version>.min.js. The
+    version in the name makes pages written after a plotly upgrade load
+    a new bundle instead of a stale one.
+    '''
+    return 'plotly-%s.min.js' % get_plotlyjs_version()
+
+
+def bundle(odir):
+    '''
+    Write the bundle of bundle_name into odir once. The file is renamed
+    into place so processes writing pages in parallel never load a
+    partial bundle.
+    '''
+    js = os.path.join(odir, bundle_name())
+    if not os.path.exists(js):
+        tmp = js + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(get_plotlyjs())
+        os.replace(tmp, js)
+    return js
+
+
+def _plotlyjs(include_plotlyjs):
+    if include_plotlyjs == 'cdn':
+        return ('<script charset="utf-8" '
+                'src="https://cdn.plot.ly/plotly-%s.min.js"></script>' %
+                get_plotlyjs_version())
+    if include_plotlyjs == 'directory':
+        return ('<script charset="utf-8" src="%s"></script>' %
+                quote(bundle_name()))
+    if include_plotlyjs:
+        return ('<script type="text/javascript">%s</script>' %
+                get_plotlyjs())
+    return ''
+
+
+def _size(value):
+    return '%dpx' % value if value else '100%'
+
+
+def to_html(fig,
+            compress=False,
+            include_plotlyjs=True,
+            post_script=None,
+            config=None):
+    '''
+    The html page of fig with its arrays narrowed (see narrow) and,
+    with compress, deflated. Pages with compressed arrays need a browser
+    with DecompressionStream (Chrome 80, Firefox 113, Safari 16.4).
+    include_plotlyjs and post_script are as in fig.to_html.
+    '''
+    figure = pack(fig.to_dict(), compress)
+    layout = figure.get('layout', {})
+    figure['config'] = dict({'responsive': True}, **(config or {}))
+    div_id = str(uuid.uuid4())
+    return TEMPLATE.format(
+        plotlyjs=_plotlyjs(include_plotlyjs),
+        div_id=div_id,
+        height=_size(layout.get('height')),
+        width=_size(layout.get('width')),
+        inflate=INFLATE,
+        figure=pio.to_json(figure, validate=False),
+        post_script=(post_script or '').replace('{plot_id}', div_id))
+
+
+def _write(page, path, plotlyjs):
+    if plotlyjs == 'directory':
+        bundle(os.path.dirname(os.path.abspath(path)))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(page)
+
+
+def write_html(fig,
+               path,
+               compress=False,
+               include_plotlyjs=True,
+               post_script=None,
+               config=None):
+    '''Write the page of to_html to path.'''
+    _write(to_html(fig, compress, include_plotlyjs, post_script, config),
+           path, include_plotlyjs)
+
+
+def figure_html(fig, compress=False, plotlyjs='embed', post_script=None):
+    '''
+    fig.to_html, or to_html with compressed arrays. plotlyjs is one of
+    PLOTLYJS_MODES; with 'directory' the page loads the bundle (see
+    bundle_name) from its own directory. post_script is run after the
+    plot is drawn.
+    '''
+    if plotlyjs not in PLOTLYJS_MODES:
+        raise ValueError('Unknown plotlyjs mode %s. Available: %s' %
+                         (plotlyjs, ', '.join(PLOTLYJS_MODES)))
+    include = True if plotlyjs == 'embed' else plotlyjs
+    if compress:
+        return to_html(fig,
+                       compress=True,
+                       include_plotlyjs=include,
+                       post_script=post_script)
+    if plotlyjs == 'directory':
+        # plotly.py would load plotly.min.js, a path names the bundle.
+        include = bundle_name()
+    return fig.to_html(include_plotlyjs=include, post_script=post_script)
+
+
+def write_page(page, path, plotlyjs='embed'):
+    '''
+    Write a page of figure_html to path, and with 'directory' the
+    bundle it loads next to it.
+    '''
+    _write(page, path, plotlyjs)
+
+
+def write_figure(fig,
+                 path,
+                 compress=False,
+                 plotlyjs='embed',
+                 post_script=None):
+    '''Write the page of figure_html to path, see write_page.'''
+    write_page(figure_html(fig, compress, plotlyjs, post_script), path,
+               plotlyjs)
+
+
+def write_index(odir, title=None, pages=None):
+    '''
+    Write index.html in odir, linking every html page in it. pages are
+    the file names in odir if already listed, e.g. by an OutputIndex.
+    '''
+    if pages is None:
+        pages = os.listdir(odir)
+    pages = sorted(f for f in pages if f.endswith('.html') and f != INDEX)
+    title = html.escape(title or os.path.basename(os.path.abspath(odir)))
+    links = '\n'.join('<li><a href="%s">%s</a></li>' %
+                      (quote(f), html.escape(f)) for f in pages)
+    path = os.path.join(odir, INDEX)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<!doctype html>\n<html>\n<head>\n'
+                '<meta charset="utf-8" />\n<title>%s</title>\n'
+                '</head>\n<body>\n<h1>%s</h1>\n<p>%d pages</p>\n'
+                '<ul>\n%s\n</ul>\n</body>\n</html>\n' %
+                (title, title, len(pages), links))
+    return path
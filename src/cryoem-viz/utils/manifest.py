@@ -0,0 +1,80 @@
+'''
+Index of the outputs already rendered into a directory.
+The directory is listed once, and a manifest persisted next to the
+outputs remembers, for every input, the output it produced, the mtime and
+size of its source file(s) and the render parameters. Skip checks are set
+and dict lookups, and an output is rendered again when its sources or
+its parameters change.
+'''
+
+import os
+import json
+
+MANIFEST = '.cryoem-viz-manifest.json'
+
+
+def _normalize(params):
+    return json.loads(json.dumps(params or {}, sort_keys=True, default=str))
+
+
+def fingerprint(sources):
+    '''[path, mtime_ns, size] of every source file.'''
+    if isinstance(sources, str):
+        sources = [sources]
+    fp = []
+    for src in sources:
+        st = os.stat(src)
+        fp.append([os.path.abspath(src), st.st_mtime_ns, st.st_size])
+    return fp
+
+
+class OutputIndex:
+    '''
+    Skip-done index of one output directory for one set of render
+    parameters. Entries are keyed by the absolute path of the (first)
+    source. Outputs that exist but were rendered before the manifest was
+    introduced are considered done.
+    '''
+
+    def __init__(self, odir, params=None):
+        self.odir = odir
+        self.params = _normalize(params)
+        self.path = os.path.join(odir, MANIFEST)
+        self.existing = set(os.listdir(odir)) if os.path.isdir(odir) else set()
+        self.entries = {}
+        if MANIFEST in self.existing:
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = {}
+
+    @staticmethod
+    def _key(sources):
+        src = sources if isinstance(sources, str) else sources[0]
+        return os.path.abspath(src)
+
+    def is_done(self, sources, oname):
+        '''True if oname exists and is up to date with sources.'''
+        if oname not in self.existing:
+            return False
+        entry = self.entries.get(self._key(sources))
+        if entry is None:
+            return True
+        return (entry['output'] == oname
+                and entry['params'] == self.params
+                and entry['sources'] == fingerprint(sources))
+
+    def record(self, sources, oname):
+        self.entries[self._key(sources)] = dict(output=oname,
+                                                sources=fingerprint(sources),
+                                                params=self.params)
+        self.existing.add(oname)
+
+    def save(self):
+        if not os.path.isdir(self.odir):
+            return
+        tmp = self.path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
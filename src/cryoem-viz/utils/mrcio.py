@@ -0,0 +1,63 @@
+'''
+Out-of-core MRC reading on top of mrcfile.mmap.
+Only the frames or slabs that are needed are paged in, so the resident
+set of a worker stays bounded by the size of one slab and its result,
+not by the size of the file.
+'''
+
+import mrcfile
+import numpy as np
+
+
+def open_mrc(path):
+    return mrcfile.mmap(path, mode='r', permissive=True)
+
+
+def mrc_shape(path):
+    '''Shape of the data block, read from the header only.'''
+    with open_mrc(path) as mrc:
+        return mrc.data.shape
+
+
+def iter_slabs(path, slab=16):
+    '''
+    Yield (start, array) slabs of at most slab sections along the first
+    axis of a 3d file (z of a volume, frames of a movie stack).
+    A 2d file is yielded as a single slab of one section.
+    '''
+    with open_mrc(path) as mrc:
+        data = mrc.data
+        if data.ndim == 2:
+            yield 0, np.array(data[np.newaxis])
+            return
+        for start in range(0, data.shape[0], slab):
+            yield start, np.array(data[start:start + slab])
+
+
+def read_slice(path, index=0):
+    '''A single section (2d array) of the file.'''
+    with open_mrc(path) as mrc:
+        data = mrc.data
+        if data.ndim == 2:
+            if index != 0:
+                raise IndexError('%s is a 2d image' % path)
+            return np.array(data)
+        return np.array(data[index])
+
+
+def read_micrograph(path, slab=8):
+    '''
+    Read a micrograph as a 2d array.
+    A movie stack is summed frame by frame, slab frames at a time.
+    '''
+    with open_mrc(path) as mrc:
+        data = mrc.data
+        if data.ndim == 2:
+            return np.array(data)
+        if data.shape[0] == 1:
+            return np.array(data[0])
+        total = np.zeros(data.shape[-2:], dtype=np.float32)
+        for start in range(0, data.shape[0], slab):
+            total += np.sum(data[start:start + slab], axis=0,
+                            dtype=np.float32)
+        return total
@@ -0,0 +1,144 @@
+'''
+Three stage pipeline for the per-micrograph tools: reader threads
+prefetch the input of the next tasks, a process pool computes, and a
+writer thread saves the results, so reading, computing and writing
+overlap. The stages are connected by bounded queues, which bound the
+number of inputs and results held in memory.
+
+Tasks are argument tuples as for utils.batch.run_batch and the summary
+is the same, so utils.batch.print_summary applies.
+'''
+
+import os
+import time
+import queue
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from utils.batch import print_summary
+
+_DONE = object()
+
+
+def _record(task, error=None, tb=None, seconds=0.):
+    return dict(label=task[0],
+                ok=error is None,
+                error=error,
+                traceback=tb,
+                seconds=seconds)
+
+
+def _failure(e):
+    return '%s: %s' % (type(e).__name__, e), traceback.format_exc()
+
+
+def _timed(work, task, data):
+    t0 = time.perf_counter()
+    result = work(task, data)
+    return result, time.perf_counter() - t0
+
+
+def run_pipeline(read,
+                 work,
+                 write,
+                 tasks,
+                 workers=None,
+                 readers=2,
+                 depth=None,
+                 skipped=0,
+                 verbose=True):
+    '''
+    For every task run read(task) in one of readers threads,
+    work(task, data) in a pool of workers processes, and
+    write(task, result) in a writer thread. work must be a top-level
+    function. At most depth inputs wait for a worker and at most depth
+    results wait for the writer (default 2 * workers). A failing task
+    is recorded and the others go on. Returns a summary dict, see
+    utils.batch.print_summary; skipped is only reported.
+    '''
+    tasks = list(tasks)
+    workers = workers or os.cpu_count() or 1
+    workers = max(1, min(workers, len(tasks) or 1))
+    depth = depth or 2 * workers
+    readers = max(1, min(readers, len(tasks) or 1))
+
+    inputs = queue.Queue(maxsize=depth)
+    results = queue.Queue(maxsize=depth)
+    records = []
+    pending = {}
+    lock = threading.Lock()
+    todo = iter(tasks)
+
+    def reader():
+        while True:
+            with lock:
+                task = next(todo, _DONE)
+            if task is _DONE:
+                inputs.put(_DONE)
+                return
+            try:
+                inputs.put((task, read(task), None))
+            except Exception as e:
+                inputs.put((task, None, _failure(e)))
+
+    def writer():
+        while True:
+            item = results.get()
+            if item is _DONE:
+                return
+            task, result, seconds = item
+            try:
+                write(task, result)
+                records.append(_record(task, seconds=seconds))
+            except Exception as e:
+                records.append(_record(task, *_failure(e), seconds=seconds))
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=reader, daemon=True)
+               for _ in range(readers)]
+    threads.append(threading.Thread(target=writer, daemon=True))
+    for t in threads:
+        t.start()
+
+    if verbose:
+        print('Processing in %d parallel processes....' % workers)
+
+    def collect(done):
+        for f in done:
+            task = pending.pop(f)
+            try:
+                result, seconds = f.result()
+            except Exception as e:
+                records.append(_record(task, *_failure(e)))
+            else:
+                results.put((task, result, seconds))
+
+    with ProcessPoolExecutor(workers) as pool:
+        running = readers
+        while running:
+            item = inputs.get()
+            if item is _DONE:
+                running -= 1
+                continue
+            task, data, error = item
+            if error is not None:
+                records.append(_record(task, *error))
+                continue
+            pending[pool.submit(_timed, work, task, data)] = task
+            del data
+            if len(pending) >= depth:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(wait(pending)[0])
+
+    results.put(_DONE)
+    for t in threads:
+        t.join()
+
+    summary = dict(records=records,
+                   elapsed=time.perf_counter() - t0,
+                   skipped=skipped)
+    if verbose:
+        print_summary(summary)
+    return summary
@@ -0,0 +1,79 @@
+'''
+Scatter traces shared by the plotting tools.
+SVG scatters (go.Scatter) add an element per point to the page, WebGL
+scatters (go.Scattergl) draw on the GPU. With render='auto' the WebGL
+trace is used above WEBGL_THRESHOLD points. The threshold is a starting
+point, not a measured cutover: benchmarks/bench_render.py measures both
+modes in a browser, and --render overrides the choice.
+'''
+
+import base64
+import numpy as np
+import plotly.graph_objects as go
+
+RENDER_MODES = ('auto', 'svg', 'webgl')
+WEBGL_THRESHOLD = 10000
+
+# numpy dtypes plotly.js has typed arrays for.
+_TYPED = {
+    'int8': 'i1',
+    'uint8': 'u1',
+    'int16': 'i2',
+    'uint16': 'u2',
+    'int32': 'i4',
+    'uint32': 'u4',
+    'float32': 'f4',
+    'float64': 'f8',
+}
+
+
+def use_webgl(n, render='auto'):
+    '''Whether a figure showing n points at once is drawn with WebGL.'''
+    if render not in RENDER_MODES:
+        raise ValueError('Unknown render mode %s. Available: %s' %
+                         (render, ', '.join(RENDER_MODES)))
+    if render == 'auto':
+        return n > WEBGL_THRESHOLD
+    return render == 'webgl'
+
+
+def scatter_type(n, render='auto'):
+    '''go.Scattergl or go.Scatter for a figure showing n points at once.'''
+    return go.Scattergl if use_webgl(n, render) else go.Scatter
+
+
+def typed_array(a):
+    '''
+    A numpy array as a plotly.js typed array spec (base64 of its bytes).
+    plotly.py only encodes trace data this way; arrays in layout, such as
+    restyle arguments of buttons, would otherwise be written as JSON
+    numbers.
+    '''
+    a = np.asarray(a)
+    if a.dtype.kind == 'b':
+        a = a.astype(np.uint8)
+    elif a.dtype.kind in 'iu' and a.dtype.name not in _TYPED:
+        info = np.iinfo(np.int32)
+        fits = not a.size or (a.min() >= info.min and a.max() <= info.max)
+        a = a.astype(np.int32 if fits else np.float64)
+    elif a.dtype.name not in _TYPED:
+        a = a.astype(np.float64)
+    a = np.ascontiguousarray(a, dtype=a.dtype.newbyteorder('<'))
+    return dict(dtype=_TYPED[a.dtype.name],
+                bdata=base64.b64encode(a.tobytes()).decode('ascii'))
+
+
+def color_buttons(df, columns, trace=0, hovertemplate=None):
+    '''
+    Dropdown buttons recoloring one trace by each of columns through
+    restyle, so the coordinates are serialized once instead of once per
+    column. A hovertemplate is prefixed with the column name.
+    '''
+    buttons = []
+    for c in columns:
+        style = {'marker.color': [typed_array(df[c].to_numpy())]}
+        if hovertemplate is not None:
+            style['hovertemplate'] = c + hovertemplate
+        buttons.append(dict(method='restyle', args=[style, [trace]],
+                            label=c))
+    return buttons
@@ -0,0 +1,74 @@
+'''
+Single-pass, slab-wise orthogonal projections of an MRC volume.
+The volume is memory-mapped and swept once along z. Each slab contributes
+a partial z projection and its own rows of the y and x projections, so
+memory stays constant at a few slabs whatever the size of the map.
+'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from utils.mrcio import open_mrc
+
+
+def _project_slab(data, start, stop, mip):
+    a = np.asarray(data[start:stop], dtype=np.float32)
+    out = dict(start=start,
+               x=np.sum(a, axis=0, dtype=np.float64),
+               y=np.sum(a, axis=1, dtype=np.float64),
+               z=np.sum(a, axis=2, dtype=np.float64))
+    if mip:
+        out.update(mx=np.max(a, axis=0), my=np.max(a, axis=1),
+                   mz=np.max(a, axis=2))
+    return out
+
+
+def project_volume(path, slab=32, workers=None, mip=False):
+    '''
+    Sum projections of a volume along its three axes, as numpy would give
+    with np.sum(a, axis=0), np.sum(a, axis=1) and np.sum(a, axis=2).
+    Returns a dict with keys x, y, z, plus mx, my, mz (maximum intensity
+    projections along the same axes) when mip is True.
+    '''
+    workers = workers or os.cpu_count() or 1
+    with open_mrc(path) as mrc:
+        data = mrc.data
+        if data.ndim != 3:
+            raise ValueError('%s is not a 3d volume' % path)
+        nz, ny, nx = data.shape
+
+        proj = dict(x=np.zeros((ny, nx)), y=np.empty((nz, nx)),
+                    z=np.empty((nz, ny)))
+        if mip:
+            proj.update(mx=np.full((ny, nx), -np.inf, dtype=np.float32),
+                        my=np.empty((nz, nx), dtype=np.float32),
+                        mz=np.empty((nz, ny), dtype=np.float32))
+
+        def merge(part):
+            s = part['start']
+            n = len(part['y'])
+            proj['x'] += part['x']
+            proj['y'][s:s + n] = part['y']
+            proj['z'][s:s + n] = part['z']
+            if mip:
+                np.maximum(proj['mx'], part['mx'], out=proj['mx'])
+                proj['my'][s:s + n] = part['my']
+                proj['mz'][s:s + n] = part['mz']
+
+        # At most two slabs per worker are in flight at any time.
+        with ThreadPoolExecutor(workers) as ex:
+            pending = set()
+            for start in range(0, nz, slab):
+                pending.add(
+                    ex.submit(_project_slab, data, start,
+                              min(start + slab, nz), mip))
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    for f in done:
+                        merge(f.result())
+            for f in pending:
+                merge(f.result())
+    return proj
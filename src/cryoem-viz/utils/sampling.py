@@ -0,0 +1,99 @@
+'''
+Random row subsets of STAR tables, drawn while the rows stream past so
+only the sampled rows are ever parsed.
+
+subset follows the --subset option of the tools: a value below 1 is a
+fraction of the rows, a value above 1 a number of rows, and 1 means all
+rows. Every row gets one uniform draw from the generator, in file order,
+so a given seed picks the same rows however the file is read (chunk by
+chunk from the text, or at once from the sidecar cache).
+'''
+
+import numpy as np
+import pandas as pd
+
+
+def is_subset(subset):
+    return subset is not None and float(subset) != 1.0
+
+
+def bernoulli(n, fraction, rng):
+    '''Mask keeping each of n rows with probability fraction.'''
+    return rng.random(n) < fraction
+
+
+def smallest(keys, k):
+    '''Sorted positions of the k smallest keys.'''
+    if k >= len(keys):
+        return np.arange(len(keys))
+    return np.sort(np.argpartition(keys, k)[:k])
+
+
+class Reservoir:
+    '''
+    Uniform sample of k items of a stream, without replacement.
+    Each item gets a random key and the k smallest keys are kept, which
+    is reservoir sampling done a chunk of items at a time.
+    '''
+
+    def __init__(self, k, rng):
+        self.k = int(k)
+        self.rng = rng
+        self.seen = 0
+        self.keys = np.empty(0)
+        self.index = np.empty(0, dtype=np.int64)
+        self.items = []
+
+    def offer(self, items):
+        keys = self.rng.random(len(items))
+        index = np.arange(self.seen, self.seen + len(items))
+        self.seen += len(items)
+        if len(self.keys) == self.k:
+            new = np.flatnonzero(keys < self.keys.max())
+            if not len(new):
+                return
+            keys, index = keys[new], index[new]
+            items = [items[i] for i in new]
+        keys = np.concatenate([self.keys, keys])
+        index = np.concatenate([self.index, index])
+        items = self.items + list(items)
+        if len(keys) > self.k:
+            keep = np.argpartition(keys, self.k)[:self.k]
+            keys, index = keys[keep], index[keep]
+            items = [items[i] for i in keep]
+        self.keys, self.index, self.items = keys, index, items
+
+    def result(self):
+        '''The sampled items in stream order.'''
+        return [self.items[i] for i in np.argsort(self.index)]
+
+
+def stratified(keys, subset, rng):
+    '''
+    Mask taking the same fraction of the rows of every stratum (rows
+    with equal keys), and at least one row of each.
+    '''
+    codes, uniques = pd.factorize(np.asarray(keys, dtype=object),
+                                  use_na_sentinel=False)
+    n = len(codes)
+    draws = rng.random(n)
+    fraction = subset if subset < 1 else subset / max(n, 1)
+    counts = np.bincount(codes, minlength=len(uniques))
+    quota = np.maximum(1, np.rint(counts * fraction)).astype(np.int64)
+    order = np.lexsort((draws, codes))
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n) - np.repeat(np.cumsum(counts) - counts,
+                                           counts)
+    return rank < quota[codes]
+
+
+def sample_mask(n, subset, rng, strata=None):
+    '''Mask of the rows of an n row table kept by subset.'''
+    subset = float(subset)
+    if strata is not None:
+        return stratified(strata, subset, rng)
+    if subset < 1:
+        return bernoulli(n, subset, rng)
+    mask = np.zeros(n, dtype=bool)
+    mask[smallest(rng.random(n), int(subset))] = True
+    return mask
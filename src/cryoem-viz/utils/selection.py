@@ -0,0 +1,166 @@
+'''
+Compiled row selection expressions for STAR tables, e.g.
+
+    rlnDefocusU > 10000 & rlnClassNumber in (1, 3) & rlnAngleTilt < 90
+
+Names are columns. Supported are comparisons (also chained, and `in` /
+`not in` a tuple or list), & | ~ (or and or not), parentheses, and
++ - * / between columns and numbers. As in DataFrame.query, & and | bind
+less tightly than comparisons, and ~ more tightly: ~a > 2 is (~a) > 2,
+negate a comparison with ~(a > 2) or not a > 2. The expression is
+compiled once and each evaluation is one vectorized pass over the
+needed columns producing a single boolean mask.
+'''
+
+import io
+import ast
+import operator
+import tokenize
+import functools
+import numpy as np
+
+_COMPARE = {
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+}
+
+_ARITH = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+
+_BOOL_TOKENS = {'&': 'and', '|': 'or'}
+
+
+def _rewrite(expr):
+    '''Turn & | into and or so comparisons bind first.'''
+    tokens = []
+    for tok in tokenize.generate_tokens(io.StringIO(expr.strip()).readline):
+        if tok.type == tokenize.OP and tok.string in _BOOL_TOKENS:
+            tokens.append((tokenize.NAME, _BOOL_TOKENS[tok.string]))
+        else:
+            tokens.append((tok.type, tok.string))
+    return tokenize.untokenize(tokens)
+
+
+def _values(node):
+    if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        return [_constant(e) for e in node.elts]
+    return [_constant(node)]
+
+
+def _constant(node):
+    if isinstance(node, ast.Constant):
+        return node.value
+    if (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub)
+            and isinstance(node.operand, ast.Constant)):
+        return -node.operand.value
+    raise ValueError('Expected a constant, got: %s' % ast.unparse(node))
+
+
+class Selection:
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.columns = []
+        tree = ast.parse(_rewrite(expr), mode='eval')
+        self._eval = self._compile(tree.body)
+
+    def __call__(self, df):
+        '''Boolean mask of the rows of df matching the expression.'''
+        mask = np.asarray(self._eval(df))
+        if mask.ndim == 0:
+            mask = np.full(len(df), bool(mask))
+        return mask.astype(bool, copy=False)
+
+    def _compile(self, node):
+        if isinstance(node, ast.Name):
+            name = node.id
+            if name not in self.columns:
+                self.columns.append(name)
+            return lambda df: df[name].to_numpy()
+
+        if isinstance(node, ast.Constant):
+            value = node.value
+            return lambda df: value
+
+        if isinstance(node, ast.BoolOp):
+            parts = [self._compile(v) for v in node.values]
+            op = (np.logical_and
+                  if isinstance(node.op, ast.And) else np.logical_or)
+            # Pairwise, so constant parts broadcast against columns.
+            return lambda df: functools.reduce(op, [p(df) for p in parts])
+
+        if isinstance(node, ast.UnaryOp):
+            operand = self._compile(node.operand)
+            if isinstance(node.op, ast.Not):
+                return lambda df: np.logical_not(operand(df))
+            if isinstance(node.op, ast.Invert):
+                # Logical not of booleans, bitwise of integers.
+                return lambda df: np.invert(np.asarray(operand(df)))
+            if isinstance(node.op, ast.USub):
+                return lambda df: -operand(df)
+
+        if isinstance(node, ast.BinOp) and type(node.op) in _ARITH:
+            op = _ARITH[type(node.op)]
+            left = self._compile(node.left)
+            right = self._compile(node.right)
+            return lambda df: op(left(df), right(df))
+
+        if isinstance(node, ast.Compare):
+            terms = [self._compile(node.left)]
+            tests = []
+            for i, (cmp, right) in enumerate(zip(node.ops, node.comparators)):
+                if isinstance(cmp, (ast.In, ast.NotIn)):
+                    tests.append(self._membership(terms[i], right,
+                                                  isinstance(cmp, ast.NotIn)))
+                    terms.append(None)
+                elif type(cmp) in _COMPARE:
+                    if terms[i] is None:
+                        raise ValueError('Cannot compare the result of '
+                                         '`in`: %s' % ast.unparse(node))
+                    terms.append(self._compile(right))
+                    tests.append(self._comparison(_COMPARE[type(cmp)],
+                                                  terms[i], terms[i + 1]))
+                else:
+                    break
+            else:
+                if len(tests) == 1:
+                    return tests[0]
+                return lambda df: functools.reduce(np.logical_and,
+                                                   [t(df) for t in tests])
+
+        raise ValueError('Unsupported selection expression: %s' %
+                         ast.unparse(node))
+
+    @staticmethod
+    def _comparison(op, left, right):
+        return lambda df: op(left(df), right(df))
+
+    @staticmethod
+    def _membership(left, node, negate):
+        values = _values(node)
+        if left is None:
+            raise ValueError('`in` must follow a column or value')
+
+        def test(df):
+            # A constant on the left is a scalar, columns are arrays.
+            a = np.asarray(left(df))
+            if a.dtype.kind in 'biuf':
+                found = np.isin(a, [v for v in values
+                                    if not isinstance(v, str)])
+            else:
+                found = np.isin(a.astype(str), [str(v) for v in values])
+            return ~found if negate else found
+
+        return test
+
+
+def compile_selection(expr):
+    return Selection(expr)
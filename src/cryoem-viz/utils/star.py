@@ -0,0 +1,718 @@
+'''
+STAR file reading and writing shared by the starviz tools and
+star_handler. Loop blocks are located by a byte-level scan and parsed with
+the pandas C parser, restricted to the requested columns. Files ending
+with .gz are read and written gzip-compressed.
+'''
+
+import io
+import os
+import re
+import gzip
+import itertools
+import numpy as np
+import pandas as pd
+
+from utils import sampling, starcache
+from utils.batch import failed, run_batch
+
+# Set to 0 to neither read nor write sidecar caches.
+STAR_CACHE_ENV = 'CRYOEM_VIZ_STAR_CACHE'
+# Smaller files parse faster than a cache would load, they are not cached.
+STAR_CACHE_MIN_BYTES = 1 << 20
+
+
+def _use_cache(path, cache):
+    if cache is None:
+        return (os.environ.get(STAR_CACHE_ENV, '1') != '0'
+                and os.path.getsize(path) >= STAR_CACHE_MIN_BYTES)
+    return cache
+
+
+def _block_name(names, block):
+    '''Block given by name, or by index into the blocks of the file.'''
+    if isinstance(block, int):
+        return names[block]
+    if block not in names:
+        raise KeyError('No data block %s, found: %s' %
+                       (block, ', '.join(names)))
+    return block
+
+
+def numericise(value):
+    for t in (int, float):
+        try:
+            return t(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _is_number(token):
+    try:
+        float(token)
+    except ValueError:
+        return False
+    return True
+
+
+# A loop value, quoted values may contain whitespace.
+_TOKEN = re.compile(rb'"[^"]*"|\S+')
+# A value in single quotes, which start and end it only next to
+# whitespace, so apostrophes in unquoted values are left alone.
+_SINGLE = re.compile(rb"(?<!\S)'([^'\"\n]*)'(?!\S)")
+
+
+def _requote(data):
+    '''
+    Loop rows with 'single' quoted values "double" quoted, as the
+    tokenizer and pandas read them.
+    '''
+    if b"'" not in data:
+        return data
+    return _SINGLE.sub(rb'"\1"', data)
+
+
+def _field(line, k):
+    '''The k-th value of a loop row, without its quotes.'''
+    if b'"' not in line:
+        return line.split(None, k + 1)[k]
+    value = _TOKEN.findall(line)[k]
+    return value[1:-1] if value.startswith(b'"') else value
+
+
+def _empty(columns):
+    '''A loop block without rows, float64 columns as in starfile.'''
+    return pd.DataFrame(np.zeros((0, len(columns))), columns=columns)
+
+
+def _open(path, mode='rb'):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class _Stream:
+    '''
+    Forward-only reader of a binary file with a pushback buffer, so the
+    blocks of a file are read in one pass without seeking back. Seeking
+    back in a gzip file decompresses it again from the start.
+    '''
+
+    def __init__(self, f):
+        self.f = f
+        self.pushed = b''
+
+    def unread(self, data):
+        self.pushed = data + self.pushed
+
+    def read(self, n):
+        data, self.pushed = self.pushed[:n], self.pushed[n:]
+        if len(data) < n:
+            data += self.f.read(n - len(data))
+        return data
+
+    def readline(self):
+        i = self.pushed.find(b'\n')
+        if i >= 0:
+            line, self.pushed = self.pushed[:i + 1], self.pushed[i + 1:]
+            return line
+        line, self.pushed = self.pushed + self.f.readline(), b''
+        return line
+
+
+class _LoopReader(io.RawIOBase):
+    '''
+    The data of the loop block at the position of a _Stream, up to the
+    next line starting with data_, which is left in the stream.
+    '''
+
+    def __init__(self, stream, size=1 << 22):
+        self.stream = stream
+        self.size = size
+        self.buf = b''
+        self.pos = 0
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        # Chunks end on a line boundary, so a data_ line starts a chunk or
+        # follows a newline in it.
+        chunk = self.stream.read(self.size)
+        if chunk and not chunk.endswith(b'\n'):
+            chunk += self.stream.readline()
+        i = (b'\n' + chunk).find(b'\ndata_')
+        if i >= 0:
+            self.stream.unread(chunk[i:])
+            chunk = chunk[:i]
+        self.done = i >= 0 or not chunk
+        self.buf = self.buf[self.pos:] + _requote(chunk)
+        self.pos = 0
+
+    def readinto(self, b):
+        while self.pos == len(self.buf) and not self.done:
+            self._fill()
+        n = min(len(b), len(self.buf) - self.pos)
+        b[:n] = memoryview(self.buf)[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def first_row(self):
+        '''Tokens of the first data row, None without rows.'''
+        self.buf, self.pos = self.buf[self.pos:], 0
+        start = 0
+        while True:
+            i = self.buf.find(b'\n', start)
+            if i < 0 and not self.done:
+                self._fill()
+                continue
+            line = self.buf[start:] if i < 0 else self.buf[start:i]
+            tokens = _TOKEN.findall(line)
+            if tokens and not tokens[0].startswith(b'#'):
+                return [t.decode() for t in tokens]
+            if i < 0:
+                return None
+            start = i + 1
+
+    def drain(self):
+        while not self.done:
+            self.buf, self.pos = b'', 0
+            self._fill()
+        self.buf, self.pos = b'', 0
+
+
+def _blocks(f):
+    '''
+    Walk the data blocks of an open STAR file in one pass. Yields a dict
+    with the name and kind of each block, and for loop blocks its columns
+    and a _LoopReader of its data (None for other blocks, which have
+    their values). Unread loop data is skipped when the walk goes on.
+    '''
+    stream = _Stream(f)
+    cur = None
+    while True:
+        line = stream.readline()
+        if not line:
+            break
+        s = line.strip()
+        if s.startswith(b'data_'):
+            if cur is not None:
+                yield cur, None
+            cur = dict(name=s[5:].decode(), kind='pairs', values={})
+        elif cur is None or not s or s.startswith(b'#'):
+            continue
+        elif s.startswith(b'loop_'):
+            cur.update(kind='loop', columns=[])
+            del cur['values']
+            while True:
+                line = stream.readline()
+                s = line.strip()
+                if s.startswith(b'_'):
+                    cur['columns'].append(s.split()[0][1:].decode())
+                elif not line or s:
+                    break
+            stream.unread(line)
+            reader = _LoopReader(stream)
+            yield cur, reader
+            reader.drain()
+            cur = None
+        elif s.startswith(b'_'):
+            k, v = _pair(s.decode())
+            cur['values'][k[1:]] = numericise(v)
+    if cur is not None:
+        yield cur, None
+
+
+def scan_star(path):
+    '''
+    Index the data blocks of a STAR file without parsing the loop data.
+    Returns a list of dicts with the name and kind of each block; loop
+    blocks have their columns, other blocks have their values.
+    '''
+    with _open(path) as f:
+        return [b for b, _ in _blocks(f)]
+
+
+def _find_block(f, block):
+    '''
+    (block, reader) of the block given by name or index from _blocks(f),
+    the blocks after it are not read.
+    '''
+    names = []
+    for k, (b, reader) in enumerate(_blocks(f)):
+        if b['name'] == block or k == block:
+            return b, reader
+        names.append(b['name'])
+    raise KeyError('No data block %s, found: %s' %
+                   (block, ', '.join(names)))
+
+
+def _pair(line):
+    '''
+    Key and value of a line of a pairs block. The value is the rest of
+    the line after the key, unquoted, up to a # comment.
+    '''
+    parts = line.split(None, 1)
+    k, v = parts[0], parts[1].strip() if len(parts) > 1 else ''
+    if v[:1] in ('"', "'") and v.find(v[0], 1) > 0:
+        return k, v[1:v.find(v[0], 1)]
+    return k, v.split('#', 1)[0].strip()
+
+
+def _loop_columns(b, reader, columns=None, numeric=False):
+    '''
+    Columns of a loop block to parse, None if the block has no rows.
+    With numeric=True columns whose first value is not a number are left
+    out.
+    '''
+    names = b['columns']
+    use = names if columns is None else [c for c in names if c in columns]
+    row = reader.first_row()
+    if row is None:
+        return None
+    if numeric:
+        use = [c for c, t in zip(names, row) if c in use and _is_number(t)]
+    return use
+
+
+def _parse_rows(data, names, columns):
+    '''Parse loop rows (bytes, or a binary file) into the given columns.'''
+    if isinstance(data, bytes):
+        data = io.BytesIO(data)
+    return pd.read_csv(data,
+                       sep=r'\s+',
+                       header=None,
+                       names=names,
+                       usecols=columns,
+                       comment='#',
+                       keep_default_na=False,
+                       na_values=['nan', 'NaN', '<NA>'],
+                       index_col=False,
+                       engine='c')
+
+
+def _read_loop(b, reader, columns=None, numeric=False):
+    use = _loop_columns(b, reader, columns, numeric)
+    if use is None:
+        return _empty(b['columns'] if columns is None else
+                      [c for c in b['columns'] if c in columns])
+    if not use:
+        # No column to parse, only the rows are counted.
+        n = sum(len(lines) for lines in _data_lines(reader))
+        return pd.DataFrame(index=pd.RangeIndex(n))
+    df = _parse_rows(io.BufferedReader(reader, 1 << 20), b['columns'], use)
+    if numeric:
+        df = df.select_dtypes(include='number')
+    return df
+
+
+def _read_found(b, reader, columns=None, numeric=False):
+    '''Parse the block b of _blocks, with its reader.'''
+    if b['kind'] == 'pairs':
+        return {
+            k: v
+            for k, v in b['values'].items()
+            if (columns is None or k in columns) and (
+                not numeric or not isinstance(v, str))
+        }
+    return _read_loop(b, reader, columns, numeric)
+
+
+def read_block(path, block=0, columns=None, numeric=False):
+    '''
+    Parse one block of a STAR file, without the sidecar cache.
+    Only the requested columns of a loop block are materialised, and with
+    numeric=True columns whose first value is not a number are skipped.
+    The file is read up to the end of the block.
+    '''
+    if isinstance(block, int) and block < 0:
+        block = _block_name([b['name'] for b in scan_star(path)], block)
+    with _open(path) as f:
+        return _read_found(*_find_block(f, block), columns, numeric)
+
+
+def read_star(path, block=None, columns=None, numeric=False, cache=None):
+    '''
+    Read a STAR file like starfile.read(path, always_dict=True).
+    With block (a name, or an index) only that block is returned.
+    columns restricts loop blocks to the given columns and numeric=True
+    to their numeric columns; the other columns are never materialised.
+    The first read writes a sidecar column cache (see utils.starcache),
+    later reads of the unchanged file only load the requested columns.
+    Without the cache the file is read in one pass.
+    '''
+    cache = _use_cache(path, cache)
+    meta = starcache.load_meta(path) if cache else None
+
+    if meta is None and not cache:
+        if block is not None:
+            return read_block(path, block, columns, numeric)
+        with _open(path) as f:
+            return {
+                b['name']: _read_found(b, reader, columns, numeric)
+                for b, reader in _blocks(f)
+            }
+
+    if meta is None:
+        with _open(path) as f:
+            blocks = {b['name']: _read_found(b, reader)
+                      for b, reader in _blocks(f)}
+        starcache.save(path, blocks)
+        meta = starcache.load_meta(path)
+        if meta is None:  # directory not writable
+            return read_star(path, block, columns, numeric, cache=False)
+
+    names = [b['name'] for b in meta['blocks']]
+    if block is not None:
+        b = meta['blocks'][names.index(_block_name(names, block))]
+        return starcache.load_block(path, meta, b, columns, numeric)
+    return {
+        b['name']: starcache.load_block(path, meta, b, columns, numeric)
+        for b in meta['blocks']
+    }
+
+
+# A blank or comment line after the first, which is not a row of a loop
+# block. Anchored on the newline so the search skips ahead quickly.
+_NON_DATA = re.compile(rb'\n[ \t\r]*(?:\n|#)')
+
+
+def _split_data(buf):
+    lines = buf.split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    if lines and (not _is_data(lines[0]) or _NON_DATA.search(buf)):
+        lines = [line for line in lines if _is_data(line)]
+    return lines
+
+
+def _data_lines(reader, size=1 << 24):
+    '''
+    Data lines of a loop block, read from its _LoopReader, without their
+    newline, in lists of the lines of size bytes of the file. Lines are
+    only split, not parsed.
+    '''
+    f = io.BufferedReader(reader, 1 << 20)
+    tail = b''
+    for chunk in iter(lambda: f.read(size), b''):
+        buf = tail + chunk
+        cut = buf.rfind(b'\n') + 1
+        buf, tail = buf[:cut], buf[cut:]
+        if buf:
+            yield _split_data(buf)
+    if tail.strip():
+        yield _split_data(tail + b'\n')
+
+
+def sample_star(path,
+                block=0,
+                subset=1.0,
+                stratify=None,
+                seed=None,
+                columns=None,
+                numeric=False,
+                cache=None):
+    '''
+    Read a random subset of the rows of a loop block (see utils.sampling
+    for the meaning of subset). Below 1 every row is kept with that
+    probability, above 1 a reservoir keeps that many rows. With stratify
+    (a column name, e.g. rlnMicrographName) the same fraction of the rows
+    of each of its values is taken instead, at least one row of each.
+    Without a sidecar cache the block is only split into lines and the
+    sampled lines are parsed, so a 1% subset costs little more than
+    reading the file up to the end of the block; stratify reads it twice,
+    once to pick the values of its column out of the lines.
+    Rows keep their file order.
+    '''
+    if not sampling.is_subset(subset):
+        return read_star(path, block, columns, numeric, cache)
+    subset = float(subset)
+    rng = np.random.default_rng(seed)
+
+    if _use_cache(path, cache) and starcache.load_meta(path) is not None:
+        df = read_star(path, block, columns, numeric, cache=True)
+        strata = None
+        if stratify is not None:
+            strata = read_star(path, block, [stratify], cache=True)[stratify]
+            strata = strata.to_numpy()
+        df = df[sampling.sample_mask(len(df), subset, rng, strata)]
+        return df.reset_index(drop=True)
+
+    if isinstance(block, int) and block < 0:
+        block = _block_name([b['name'] for b in scan_star(path)], block)
+    with _open(path) as f:
+        b, reader = _find_block(f, block)
+        if b['kind'] == 'pairs':
+            raise ValueError('Block %s of %s is not a loop' %
+                             (b['name'], path))
+        use = _loop_columns(b, reader, columns, numeric)
+        if not use:
+            return _read_loop(b, reader, columns, numeric)
+
+        if stratify is not None:
+            k = b['columns'].index(stratify)
+            strata = []
+            for lines in _data_lines(reader):
+                strata += [_field(line, k) for line in lines]
+        elif subset < 1:
+            rows = []
+            for lines in _data_lines(reader):
+                rows += itertools.compress(
+                    lines, sampling.bernoulli(len(lines), subset, rng))
+        else:
+            reservoir = sampling.Reservoir(subset, rng)
+            for lines in _data_lines(reader):
+                reservoir.offer(lines)
+            rows = reservoir.result()
+
+    if stratify is not None:
+        mask = sampling.stratified(strata, subset, rng)
+        rows, start = [], 0
+        with _open(path) as f:
+            for lines in _data_lines(_find_block(f, b['name'])[1]):
+                rows += itertools.compress(lines,
+                                           mask[start:start + len(lines)])
+                start += len(lines)
+
+    if not rows:
+        return _empty(use)
+    df = _parse_rows(b'\n'.join(rows), b['columns'], use)
+    if numeric:
+        df = df.select_dtypes(include='number')
+    return df
+
+
+def _read_file(path, k, block, columns, subset, stratify, seed):
+    return k, sample_star(path, block, subset, stratify, seed, columns)
+
+
+def read_star_files(paths,
+                    block=None,
+                    columns=None,
+                    subset=1.0,
+                    stratify=None,
+                    seed=None,
+                    workers=None,
+                    progress=True):
+    '''
+    Read the same loop block from many STAR files with
+    utils.batch.run_batch. Each file is subsampled in its worker with
+    sample_star, using its own random stream derived from seed.
+    Returns one DataFrame in the order of paths, with a `frame` column
+    holding the index of the file each row comes from. Files that fail
+    are reported and left out, so they have no rows; ValueError if none
+    can be read.
+    '''
+    paths = list(paths)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(paths) or 1))
+    seeds = np.random.SeedSequence(seed).spawn(len(paths))
+    tasks = [(p, k, block, columns, subset, stratify, s)
+             for k, (p, s) in enumerate(zip(paths, seeds))]
+    step = max(1, len(paths) // 20)
+    done = itertools.count(1)
+
+    def report(record):
+        n = next(done)
+        if n % step == 0 or n == len(paths):
+            print('Read %d/%d star files' % (n, len(paths)))
+
+    summary = run_batch(_read_file,
+                        tasks,
+                        workers=workers,
+                        chunksize=max(1, min(64, len(paths) // (workers * 8))),
+                        verbose=progress,
+                        values=True,
+                        callback=report if progress else None)
+    bad = failed(summary)
+    if paths and len(bad) == len(paths):
+        raise ValueError('None of the %d star files could be read, %s: %s' %
+                         (len(paths), bad[0]['label'], bad[0]['error']))
+    for r in bad:
+        print('Left out %s: %s' % (r['label'], r['error']))
+    results = sorted((r['value'] for r in summary['records'] if r['ok']),
+                     key=lambda v: v[0])
+    dfs = [df.assign(frame=k) for k, df in results]
+    if not dfs:
+        return pd.DataFrame({'frame': pd.Series(dtype=np.int64)})
+    return pd.concat(dfs, ignore_index=True)
+
+
+def _is_data(line):
+    s = line.strip()
+    return bool(s) and not s.startswith(b'#')
+
+
+def _stream_chunk(lines, names, columns, selectors, rng, subset):
+    '''
+    Data flags of the lines, and their keep flags for every selector.
+    Comment and blank lines are always kept.
+    '''
+    data = np.fromiter((_is_data(line) for line in lines),
+                       dtype=bool,
+                       count=len(lines))
+    rows = list(itertools.compress(lines, data))
+    if rows and columns:
+        df = _parse_rows(_requote(b''.join(rows)), names, columns)
+    else:
+        df = pd.DataFrame(index=pd.RangeIndex(len(rows)), columns=columns)
+    sample = np.ones(len(rows), dtype=bool)
+    if subset < 1.0:
+        sample = sampling.bernoulli(len(rows), subset, rng)
+    keeps = []
+    for select in selectors:
+        keep = np.ones(len(lines), dtype=bool)
+        keep[data] = np.asarray(select(df), dtype=bool) & sample
+        keeps.append(keep)
+    return data, keeps
+
+
+def stream_select(path,
+                  outputs,
+                  selectors,
+                  block=None,
+                  columns=None,
+                  subset=1.0,
+                  seed=None,
+                  chunksize=100000):
+    '''
+    Filter one loop block of a STAR file into one or more outputs in a
+    single pass with bounded memory.
+    Everything but the data rows of the target block (the first loop
+    block if block is None) is copied verbatim, and the kept rows are
+    written as they were in the input. selectors are functions taking a
+    DataFrame of the given columns of a chunk of rows and returning a
+    boolean mask, one per output. subset (a fraction) additionally keeps
+    every row with that probability.
+    Returns the number of rows written to each output.
+    '''
+    if float(subset) > 1.0:
+        raise ValueError('A subset of a number of rows needs the whole '
+                         'block, it cannot be streamed')
+    rng = np.random.default_rng(seed)
+    outs = [_open(o, 'wb') for o in outputs]
+    counts = [0] * len(outs)
+
+    def write(line):
+        for o in outs:
+            o.write(line)
+
+    try:
+        with _open(path) as f:
+            name, names, in_loop = None, None, False
+            line = f.readline()
+            # Headers, copied until the first row of the target block.
+            while line:
+                s = line.strip()
+                if s.startswith(b'data_'):
+                    name, in_loop = s[5:].decode(), False
+                elif s.startswith(b'loop_'):
+                    in_loop, names = True, []
+                elif in_loop and s.startswith(b'_'):
+                    names.append(s.split()[0][1:].decode())
+                elif (in_loop and _is_data(line)
+                      and (block is None or name == block)):
+                    break
+                write(line)
+                line = f.readline()
+            if not line:
+                raise KeyError('No loop data in block %s of %s' %
+                               (block, path))
+
+            # Rows of the target block, chunk by chunk.
+            use = names if columns is None else [
+                c for c in names if c in columns
+            ]
+            rest = b''
+            lines = [line]
+            while True:
+                lines.extend(itertools.islice(f, chunksize - len(lines)))
+                end = next((i for i, line in enumerate(lines)
+                            if line.startswith(b'data_')), None)
+                if end is not None:
+                    rest = b''.join(lines[end:])
+                    lines = lines[:end]
+                data, keeps = _stream_chunk(lines, names, use, selectors,
+                                            rng, subset)
+                for k, (o, keep) in enumerate(zip(outs, keeps)):
+                    o.write(b''.join(itertools.compress(lines, keep)))
+                    counts[k] += int(np.count_nonzero(keep & data))
+                if end is not None or len(lines) < chunksize:
+                    break
+                lines = []
+
+            # Blocks after the target one.
+            write(rest)
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                write(chunk)
+    finally:
+        for o in outs:
+            o.close()
+    return counts
+
+
+def _format_column(a, fmt=None):
+    '''%-format of a loop column and the values it is applied to.'''
+    if fmt is not None:
+        return fmt, a.tolist()
+    if a.dtype.kind == 'f':
+        return '%r', a.tolist()  # shortest exact repr
+    if a.dtype.kind in 'iu':
+        return '%d', a.tolist()
+    if a.dtype.kind == 'b':
+        return '%s', a.tolist()
+    s = pd.Series(a, dtype=str)
+    quote = (s == '') | s.str.contains(r'\s', regex=True)
+    if quote.any():
+        s = s.where(~quote, '"' + s + '"')
+    return '%s', s.tolist()
+
+
+def _format_value(v):
+    if isinstance(v, float):
+        return repr(v)
+    v = str(v)
+    return '"%s"' % v if not v or any(c.isspace() for c in v) else v
+
+
+def write_star(blocks, path, formats=None, chunksize=100000,
+               compresslevel=6):
+    '''
+    Write a STAR file from blocks as read_star returns them (a dict of
+    DataFrames for loop blocks and dicts for the others), or from a
+    single DataFrame.
+    Each loop column gets one %-format and every row is formatted with
+    the joined formats in one step, chunksize rows at a time, and written
+    in large buffered writes. Floats are written with their shortest exact
+    repr so the file reads back to the same values; formats maps column
+    names to %-formats (e.g. '%.6f') to override that. A path ending with
+    .gz is gzip-compressed.
+    '''
+    if isinstance(blocks, pd.DataFrame):
+        blocks = {'': blocks}
+    formats = formats or {}
+    if str(path).endswith('.gz'):
+        f = gzip.open(path, 'wt', compresslevel=compresslevel)
+    else:
+        f = open(path, 'w', buffering=1 << 24)
+    with f:
+        f.write('\n# version 30001\n')
+        for name, block in blocks.items():
+            f.write('\ndata_%s\n\n' % name)
+            if not isinstance(block, pd.DataFrame):
+                for k, v in block.items():
+                    f.write('_%s %s\n' % (k, _format_value(v)))
+                continue
+            f.write('loop_ \n')
+            f.writelines('_%s #%d \n' % (c, i + 1)
+                         for i, c in enumerate(block.columns))
+            for start in range(0, len(block), chunksize):
+                chunk = block.iloc[start:start + chunksize]
+                fmts, cols = zip(*[
+                    _format_column(chunk[c].to_numpy(), formats.get(c))
+                    for c in block.columns
+                ])
+                row = ' '.join(fmts)
+                f.write('\n'.join([row % r for r in zip(*cols)]))
+                f.write('\n')
@@ -0,0 +1,116 @@
+'''
+Binary sidecar cache of STAR files, one .npy file per column.
+The cache of run_data.star lives in .run_data.star.cache/ next to it and
+is valid as long as the size and mtime of the STAR file are unchanged.
+Columns are loaded individually, so reading one column of a large file
+does not touch the others.
+'''
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+CACHE_VERSION = 1
+
+
+def sidecar(path):
+    d, name = os.path.split(os.path.abspath(path))
+    return os.path.join(d, '.' + name + '.cache')
+
+
+def _stat(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _scalar(v):
+    return v.item() if isinstance(v, np.generic) else v
+
+
+def _encode(a):
+    '''Strings are stored as ASCII bytes when possible, 1 byte a char.'''
+    if a.dtype != object:
+        return a
+    try:
+        return np.asarray(a, dtype=bytes)
+    except UnicodeEncodeError:
+        return np.asarray(a, dtype=str)
+
+
+def _decode(a):
+    return a.astype(str) if a.dtype.kind == 'S' else a
+
+
+def load_meta(path):
+    '''Metadata of a valid cache of path, None if there is none.'''
+    try:
+        with open(os.path.join(sidecar(path), 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    size, mtime = _stat(path)
+    if (meta.get('version') != CACHE_VERSION or meta['size'] != size
+            or meta['mtime_ns'] != mtime):
+        return None
+    return meta
+
+
+def load_block(path, meta, block, columns=None, numeric=False):
+    '''
+    A block of a cached STAR file: a DataFrame for loop blocks, a dict
+    for the others. columns restricts which columns are loaded,
+    numeric=True skips string columns.
+    '''
+    if block['kind'] == 'pairs':
+        return {
+            k: v
+            for k, v in block['values'].items()
+            if (columns is None or k in columns) and (
+                not numeric or not isinstance(v, str))
+        }
+    cols = block['columns']
+    if columns is not None:
+        cols = [c for c in cols if c['name'] in columns]
+    if numeric:
+        cols = [c for c in cols if c['kind'] in 'biuf']
+    root = sidecar(path)
+    return pd.DataFrame(
+        {c['name']: _decode(np.load(os.path.join(root, c['file'])))
+         for c in cols},
+        columns=[c['name'] for c in cols])
+
+
+def save(path, blocks):
+    '''
+    Write the cache of path from a dict of blocks (DataFrames for loop
+    blocks, dicts for the others).
+    Does nothing if the directory is not writable.
+    '''
+    size, mtime = _stat(path)
+    root = sidecar(path)
+    tmp = root + '.%d.tmp' % os.getpid()
+    meta = dict(version=CACHE_VERSION, size=size, mtime_ns=mtime, blocks=[])
+    try:
+        os.makedirs(tmp)
+        for i, (name, block) in enumerate(blocks.items()):
+            if isinstance(block, pd.DataFrame):
+                cols = []
+                for j, c in enumerate(block.columns):
+                    a = _encode(block[c].to_numpy())
+                    fname = '%d-%d.npy' % (i, j)
+                    np.save(os.path.join(tmp, fname), a, allow_pickle=False)
+                    cols.append(dict(name=c, file=fname, kind=a.dtype.kind))
+                meta['blocks'].append(dict(name=name, kind='loop',
+                                           columns=cols))
+            else:
+                values = {k: _scalar(v) for k, v in block.items()}
+                meta['blocks'].append(dict(name=name, kind='pairs',
+                                           values=values))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(root, ignore_errors=True)
+        os.replace(tmp, root)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
@@ -0,0 +1,171 @@
+'''
+Tile pyramids of micrographs for overlays at full resolution.
+
+Level 0 of a pyramid fits in one tile; every next level doubles the
+resolution, up to the full size micrograph. All levels come from one
+read and one forward FFT of the micrograph (utils.fft.downsample_levels)
+and are cut into PNG tiles:
+
+  <dir>/<level>/<row>_<col>.png
+
+The figure of an overlay then embeds no image at all. A script added to
+the page shows, after every zoom or pan, the tiles of the coarsest level
+that still has a pixel per screen pixel, over the tiles of level 0.
+'''
+
+import os
+import json
+from urllib.parse import quote
+import numpy as np
+import plotly.graph_objects as go
+from PIL import Image
+from utils.fft import downsample_levels
+from utils.mrcio import read_micrograph
+
+TILE = 256
+# Percentiles of each level mapped to black and white.
+CONTRAST = (0.1, 99.9)
+# Pixels the percentiles are estimated from.
+SAMPLE = 1 << 20
+
+VIEWER = '''
+var gd = document.getElementById('{plot_id}');
+var P = @PYRAMID@;
+var shown = null;
+
+function levelTiles(k, x0, x1, y0, y1) {
+    var L = P.levels[k], T = P.tile;
+    // Display units per pixel of the level.
+    var sx = P.factor * P.width / L.width;
+    var sy = P.factor * P.height / L.height;
+    var ox = -0.5 * P.factor, oy = -0.5 * P.factor;
+    var c0 = Math.max(0, Math.floor((x0 - ox) / (T * sx)));
+    var c1 = Math.min(L.cols - 1, Math.floor((x1 - ox) / (T * sx)));
+    var r0 = Math.max(0, Math.floor((y0 - oy) / (T * sy)));
+    var r1 = Math.min(L.rows - 1, Math.floor((y1 - oy) / (T * sy)));
+    var images = [];
+    for (var r = r0; r <= r1; r++) {
+        for (var c = c0; c <= c1; c++) {
+            images.push({
+                source: P.path + '/' + k + '/' + r + '_' + c + '.png',
+                xref: 'x', yref: 'y', layer: 'below', sizing: 'stretch',
+                xanchor: 'left', yanchor: 'top',
+                x: ox + c * T * sx, y: oy + r * T * sy,
+                sizex: Math.min(T, L.width - c * T) * sx,
+                sizey: Math.min(T, L.height - r * T) * sy
+            });
+        }
+    }
+    return images;
+}
+
+function updateTiles() {
+    var xa = gd._fullLayout.xaxis, ya = gd._fullLayout.yaxis;
+    var x0 = Math.min.apply(null, xa.range);
+    var x1 = Math.max.apply(null, xa.range);
+    var y0 = Math.min.apply(null, ya.range);
+    var y1 = Math.max.apply(null, ya.range);
+    // Full size pixels per screen pixel.
+    var need = (x1 - x0) / P.factor / xa._length;
+    var k = 0;
+    while (k < P.levels.length - 1 &&
+           P.width / P.levels[k].width > need) {
+        k++;
+    }
+    var images = levelTiles(0, x0, x1, y0, y1);
+    if (k > 0) images = images.concat(levelTiles(k, x0, x1, y0, y1));
+    var key = images.map(function (im) { return im.source; }).join();
+    if (key == shown) return;
+    shown = key;
+    Plotly.relayout(gd, {images: images});
+}
+
+gd.on('plotly_relayout', function (e) {
+    var keys = Object.keys(e || {});
+    if (keys.length && keys.every(function (k) {
+        return k.indexOf('images') == 0;
+    })) return;
+    updateTiles();
+});
+updateTiles();
+'''
+
+
+def level_heights(height, tile=TILE):
+    '''Heights of the levels, coarsest first, the last one is height.'''
+    heights = [int(height)]
+    while heights[-1] > tile:
+        heights.append(heights[-1] // 4 * 2)
+    return heights[::-1]
+
+
+def to_bytes(img):
+    '''img as uint8, CONTRAST percentiles mapped to 0 and 255.'''
+    step = max(1, img.size // SAMPLE)
+    lo, hi = np.percentile(img.ravel()[::step], CONTRAST)
+    scaled = (img - lo) * (255. / ((hi - lo) or 1.))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def write_pyramid(img, path, tile=TILE, backend='numpy'):
+    '''
+    Write the tile pyramid of the 2d image img into the directory path.
+    Returns its description, the levels from coarsest to full size.
+    '''
+    img = np.asarray(img, dtype=np.float32)
+    heights = level_heights(img.shape[0], tile)
+    levels = downsample_levels(img, heights[:-1], backend) + [img]
+    desc = []
+    for k, level in enumerate(levels):
+        level = to_bytes(level)
+        os.makedirs(os.path.join(path, str(k)), exist_ok=True)
+        h, w = level.shape
+        rows, cols = -(-h // tile), -(-w // tile)
+        for r in range(rows):
+            for c in range(cols):
+                block = level[r * tile:(r + 1) * tile,
+                              c * tile:(c + 1) * tile]
+                name = os.path.join(path, str(k), '%d_%d.png' % (r, c))
+                Image.fromarray(block).save(name)
+        desc.append(dict(width=w, height=h, rows=rows, cols=cols))
+    return dict(tile=tile,
+                width=img.shape[1],
+                height=img.shape[0],
+                levels=desc)
+
+
+def write_micrograph_pyramid(mic, odir, oname, tile=TILE, backend='numpy'):
+    '''
+    Write the pyramid of the micrograph mic next to the page oname in
+    odir. Returns the pyramid and its path relative to the page.
+    '''
+    path = os.path.splitext(oname)[0] + '_tiles'
+    pyramid = write_pyramid(read_micrograph(mic), os.path.join(odir, path),
+                            tile, backend)
+    return pyramid, path
+
+
+def figure(pyramid, factor):
+    '''
+    Empty figure the overlay is drawn on, in place of px.imshow of the
+    micrograph downsampled by factor. Trace 0 only spans the image.
+    '''
+    # Edges of the full size pixels, centered on integer coordinates.
+    x = (np.array([0, pyramid['width']]) - 0.5) * factor
+    y = (np.array([0, pyramid['height']]) - 0.5) * factor
+    fig = go.Figure(
+        go.Scatter(x=x,
+                   y=y,
+                   mode='markers',
+                   marker=dict(opacity=0),
+                   hoverinfo='skip',
+                   showlegend=False))
+    fig.update_xaxes(range=list(x), showgrid=False, zeroline=False)
+    fig.update_yaxes(range=list(y[::-1]), showgrid=False, zeroline=False)
+    return fig
+
+
+def viewer(pyramid, path, factor):
+    '''post_script of the page loading the tiles of pyramid from path.'''
+    spec = dict(pyramid, path=quote(path), factor=factor)
+    return VIEWER.replace('@PYRAMID@', json.dumps(spec))
@@ -1,17 +1,23 @@
 import numpy as np
+from PIL import Image
 
+from utils.fft import get_downsampler
 
-def downsample(img, height):
+
+def downsample(img, height, backend='numpy', workers=None):
     '''
-    Downsample 2d array using fourier transform.
-    factor is the downsample factor.
+    Downsample 2d array (or a stack of them) using fourier transform.
+    height is the height of the output, the h/w ratio is kept.
+    FFT plans and buffers are shared between calls on same-shaped images,
+    see utils.fft.Downsampler.
     '''
-    m, n = img.shape[-2:]
-    ds_factor = m / height
-    width = int(n / ds_factor / 2) * 2
-    F = np.fft.rfft2(img)
-    A = F[..., 0:height // 2, 0:width // 2 + 1]
-    B = F[..., -height // 2:, 0:width // 2 + 1]
-    F = np.concatenate([A, B], axis=0)
-    f = np.fft.irfft2(F, s=(height, width))
-    return f
+    img = np.asarray(img)
+    return get_downsampler(img.shape[-2:], int(height), backend,
+                           workers)(img)
+
+
+def to_image(img):
+    '''8 bit grayscale PIL image of img, scaled to its full range.'''
+    newImg = ((img - img.min()) / ((img.max() - img.min()) + 1e-7) * 255)
+    newImg = Image.fromarray(newImg).convert('L')
+    return newImg
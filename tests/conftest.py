@@ -0,0 +1,9 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src', 'cryoem-viz'))
+# No sidecar caches next to the sample files.
+os.environ['CRYOEM_VIZ_STAR_CACHE'] = '0'
+
+SAMPLES = os.path.join(ROOT, 'samples')
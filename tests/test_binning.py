@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import binning
+
+
+def assert_numpy_counts(df, bins):
+    for (edges, counts), name in zip(binning.histograms(df, bins),
+                                     df.columns):
+        expected, _ = np.histogram(df[name].dropna(), edges)
+        np.testing.assert_array_equal(counts, expected)
+
+
+@pytest.mark.parametrize('lo, hi, bins', [(0, 1, 7), (-1.3, 2.9, 13),
+                                          (0.1, 0.7, 3), (3, 10, 5)])
+def test_histograms_values_on_edges(lo, hi, bins):
+    # Every value is an edge, where rounding picks the wrong bin.
+    edges = np.linspace(lo, hi, bins + 1)
+    df = pd.DataFrame({'a': edges, 'b': edges[::-1]})
+    assert_numpy_counts(df, bins)
+
+
+@pytest.mark.parametrize('bins', [7, 'auto'])
+def test_histograms_match_numpy(bins):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'uniform': rng.uniform(0, 0.7, 1000),
+        'classes': rng.integers(1, 5, 1000),
+    })
+    df.loc[3, 'uniform'] = np.nan
+    assert_numpy_counts(df, bins)
+
+
+def test_histograms_constant_column():
+    df = pd.DataFrame({'a': np.full(10, 2.5)})
+    (edges, counts), = binning.histograms(df, 4)
+    expected, expected_edges = np.histogram(df['a'], 4)
+    np.testing.assert_allclose(edges, expected_edges)
+    np.testing.assert_array_equal(counts, expected)
+
+
+def test_grid2d_constant_column():
+    x = np.full(5, 3.)
+    y = np.arange(5.)
+    xedges, yedges, counts, _, pixel = binning.grid2d(x, y, 8)
+    assert len(xedges) == len(yedges) == 9
+    assert counts.shape == (8, 8)
+    assert counts.sum() == 5
+    np.testing.assert_array_equal(np.histogram2d(x, y, [xedges, yedges])[0],
+                                  counts)
+    assert np.all(pixel >= 0)
+
+
+def test_densest():
+    pixel = np.array([0, 1, 1, 2, 1, 2, -1])
+    counts = np.bincount(pixel[pixel >= 0], minlength=4)
+    np.testing.assert_array_equal(binning.densest(pixel, counts, 3),
+                                  [1, 2, 4])
+    pos = binning.densest(pixel, counts, 4, rng=0)
+    assert len(pos) == 4
+    assert np.all(np.diff(pos) > 0)
+    assert set(pixel[pos]) <= {1, 2}
+
+
+@pytest.mark.parametrize('rings', [1, 2, 7, 30])
+def test_sphere_grid_equal_area(rings):
+    zedges, ncells = binning.sphere_grid(rings)
+    assert len(zedges) == rings + 1
+    assert zedges[0] == 1 and zedges[-1] == -1
+    # A band between heights z0 > z1 has area 2 pi (z0 - z1).
+    area = 2 * np.pi * -np.diff(zedges) / ncells
+    np.testing.assert_allclose(area, 4 * np.pi / ncells.sum())
+
+
+@pytest.mark.parametrize('rings', [1, 2, 7, 30])
+def test_sphere_cells_round_trip(rings):
+    grid = binning.sphere_grid(rings)
+    zedges, ncells = grid
+    band = np.repeat(np.arange(rings), ncells)
+    index = np.concatenate([np.arange(n) for n in ncells])
+    # The centre of every cell is found in that cell.
+    z = (zedges[band] + zedges[band + 1]) / 2
+    tilt = np.degrees(np.arccos(z))
+    rot = (index + 0.5) * 360. / ncells[band]
+    cell = binning.sphere_cells(rot, tilt, grid)
+    np.testing.assert_array_equal(cell, np.arange(ncells.sum()))
+    # Rot is periodic, and missing angles have no cell.
+    np.testing.assert_array_equal(
+        binning.sphere_cells(rot - 360., tilt, grid), cell)
+    np.testing.assert_array_equal(
+        binning.sphere_cells([np.nan, 10.], [10., np.nan], grid), [-1, -1])
+
+
+def test_sphere_cells_uniform():
+    # Uniform directions fill the cells evenly, as cells of equal area.
+    rng = np.random.default_rng(0)
+    n = 1000000
+    rot = rng.uniform(0, 360, n)
+    tilt = np.degrees(np.arccos(rng.uniform(-1, 1, n)))
+    grid = binning.sphere_grid(10)
+    total = grid[1].sum()
+    counts = np.bincount(binning.sphere_cells(rot, tilt, grid),
+                         minlength=total)
+    mean = n / total
+    assert np.all(np.abs(counts - mean) < 6 * np.sqrt(mean))
@@ -0,0 +1,27 @@
+import os
+
+import numpy as np
+
+from utils import cache
+
+
+def test_entries_evicted_meanwhile(tmp_path, monkeypatch):
+    rc = cache.RenderCache(str(tmp_path))
+    for k in ('aa01', 'aa02', 'bb01'):
+        rc.put(k, np.zeros(10))
+    scandir = os.scandir
+    removed = []
+
+    def listing(path):
+        # Another worker evicts an entry between scandir and stat.
+        found = list(scandir(path))
+        for e in found:
+            if e.name.endswith('.npy') and not removed:
+                os.remove(e.path)
+                removed.append(e.path)
+        return iter(found)
+
+    monkeypatch.setattr(cache.os, 'scandir', listing)
+    paths = [p for _, _, p in rc.entries()]
+    assert len(paths) == 2
+    assert removed[0] not in paths
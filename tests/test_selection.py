@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.selection import Selection
+
+DF = pd.DataFrame({
+    'rlnClassNumber': [1, 2, 3, 3],
+    'rlnDefocusU': [9000., 11000., 12000., 8000.],
+    'rlnMicrographName': ['a.mrc', 'b.mrc', 'a.mrc', 'c.mrc'],
+})
+
+
+@pytest.mark.parametrize('expr, expected', [
+    ('rlnDefocusU > 10000 & rlnClassNumber in (1, 3)', [0, 0, 1, 0]),
+    ('rlnMicrographName not in ["a.mrc"]', [0, 1, 0, 1]),
+    ('8500 < rlnDefocusU <= 11000', [1, 1, 0, 0]),
+    ('3 in (1, 3)', [1, 1, 1, 1]),
+    ('3 not in (1, 3) | rlnClassNumber == 2', [0, 1, 0, 0]),
+    ('~(rlnDefocusU > 10000) & rlnClassNumber > 1', [0, 0, 0, 1]),
+    ('not rlnClassNumber > 2', [1, 1, 0, 0]),
+])
+def test_selection(expr, expected):
+    np.testing.assert_array_equal(Selection(expr)(DF), np.array(expected,
+                                                                 dtype=bool))
+
+
+@pytest.mark.parametrize('expr', [
+    '3 in rlnClassNumber',
+    'rlnClassNumber in (1, 2) < 3',
+    'rlnClassNumber ** 2 > 1',
+])
+def test_unsupported(expr):
+    with pytest.raises(ValueError):
+        Selection(expr)
+
+
+@pytest.mark.parametrize('expr', [
+    '~rlnClassNumber > -3',
+    '~rlnClassNumber == -4 | ~(rlnDefocusU < 10000)',
+    '~(rlnClassNumber > 2) & rlnDefocusU > 8500',
+])
+def test_invert_as_query(expr):
+    # ~ applies to the operand next to it, before comparisons.
+    np.testing.assert_array_equal(Selection(expr)(DF),
+                                  DF.eval(expr).to_numpy())
@@ -0,0 +1,199 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import starfile
+
+from conftest import SAMPLES
+from utils import star
+
+AUTOPICK = sorted(
+    glob.glob(os.path.join(SAMPLES, 'input', 'AutoPick', 'job010', '*',
+                           '*.star')))
+
+# starfile.read cannot parse these pairs, they are only read here.
+GENERAL = '''
+# version 30001
+
+data_general
+
+_rlnImageSize 256  # in pixels
+_rlnOpticsGroupName "optics group 1"
+_rlnMicrographName  mic's.mrc
+_rlnComment  two words  # comment
+'''
+
+LOOPS = '''
+data_optics
+
+loop_
+_rlnOpticsGroup #1
+_rlnVoltage #2
+1 300.0
+2 200.0
+
+data_particles
+
+loop_
+_rlnMicrographName #1
+_rlnCoordinateX #2
+_rlnClassNumber #3
+a.mrc 10.5 1
+a.mrc 20.25 2
+# a comment
+b.mrc 30.0 1
+'''
+
+
+@pytest.fixture
+def multi(tmp_path):
+    path = tmp_path / 'multi.star'
+    path.write_text(GENERAL + LOOPS)
+    return str(path)
+
+
+@pytest.fixture
+def loops(tmp_path):
+    path = tmp_path / 'loops.star'
+    path.write_text(LOOPS)
+    return str(path)
+
+
+@pytest.mark.parametrize('path', AUTOPICK)
+def test_matches_starfile(path):
+    ours = star.read_star(path, cache=False)
+    theirs = starfile.read(path, always_dict=True)
+    assert list(ours) == list(theirs)
+    for name in theirs:
+        pd.testing.assert_frame_equal(ours[name], theirs[name])
+
+
+def test_loops_match_starfile(loops):
+    ours = star.read_star(loops, cache=False)
+    theirs = starfile.read(loops, always_dict=True)
+    assert list(ours) == list(theirs)
+    for name in theirs:
+        pd.testing.assert_frame_equal(ours[name], theirs[name])
+
+
+def test_read_once(multi, monkeypatch):
+    calls = []
+    open_ = star._open
+    monkeypatch.setattr(star, '_open',
+                        lambda path, *a: calls.append(path) or open_(path, *a))
+    blocks = star.read_star(multi, cache=False)
+    assert list(blocks) == ['general', 'optics', 'particles']
+    assert len(calls) == 1
+
+
+def test_pairs(multi):
+    general = star.read_star(multi, 'general', cache=False)
+    assert general == {
+        'rlnImageSize': 256,
+        'rlnOpticsGroupName': 'optics group 1',
+        'rlnMicrographName': "mic's.mrc",
+        'rlnComment': 'two words',
+    }
+
+
+def test_numeric_keeps_rows(multi):
+    df = star.read_star(multi, 'particles', ['rlnMicrographName'],
+                        numeric=True, cache=False)
+    assert df.shape == (3, 0)
+    df = star.read_star(multi, 'particles', numeric=True, cache=False)
+    assert list(df.columns) == ['rlnCoordinateX', 'rlnClassNumber']
+    np.testing.assert_array_equal(df['rlnClassNumber'], [1, 2, 1])
+
+
+@pytest.mark.parametrize('name', ['out.star', 'out.star.gz'])
+def test_round_trip(tmp_path, name):
+    blocks = {
+        'general': {
+            'rlnImageSize': 256,
+            'rlnOpticsGroupName': 'optics group 1',
+        },
+        'particles': pd.DataFrame({
+            'rlnMicrographName': ['a b.mrc', 'c.mrc', "it's.mrc"],
+            'rlnCoordinateX': [10.5, np.nan, 1 / 3],
+            'rlnClassNumber': [1, 2, 3],
+        }),
+    }
+    path = str(tmp_path / name)
+    star.write_star(blocks, path)
+    read = star.read_star(path, cache=False)
+    assert list(read) == list(blocks)
+    assert read['general'] == blocks['general']
+    pd.testing.assert_frame_equal(read['particles'], blocks['particles'])
+    pd.testing.assert_frame_equal(
+        star.read_star(path, 'particles', numeric=True, cache=False),
+        blocks['particles'][['rlnCoordinateX', 'rlnClassNumber']])
+
+
+def test_read_star_files(loops, tmp_path, capsys):
+    missing = str(tmp_path / 'missing.star')
+    df = star.read_star_files([loops, missing, loops], 'particles',
+                              workers=1, progress=False)
+    assert df['frame'].dtype.kind == 'i'
+    np.testing.assert_array_equal(df['frame'], [0, 0, 0, 2, 2, 2])
+    assert 'Left out %s' % missing in capsys.readouterr().out
+    with pytest.raises(ValueError, match='None of the 1 star files'):
+        star.read_star_files([missing], 'particles', workers=1,
+                             progress=False)
+    empty = star.read_star_files([], 'particles', progress=False)
+    assert empty['frame'].dtype.kind == 'i'
+
+
+QUOTED = '''
+data_particles
+
+loop_
+_rlnMicrographName #1
+_rlnImageName #2
+_rlnCoordinateX #3
+'a b.mrc' "c d.mrc" 1.5
+it's.mrc 'e' 2.5
+'''
+
+EMPTY = '''
+data_particles
+
+loop_
+_rlnMicrographName #1
+_rlnCoordinateX #2
+'''
+
+
+@pytest.mark.parametrize('text', [QUOTED, EMPTY], ids=['quoted', 'empty'])
+def test_quotes_and_empty_loops(tmp_path, text):
+    path = str(tmp_path / 'p.star')
+    with open(path, 'w') as f:
+        f.write(text)
+    ours = star.read_star(path, 'particles', cache=False)
+    # starfile turns every ' into ", which the apostrophe would break.
+    theirs = starfile.read(path, always_dict=True)['particles']
+    if text == QUOTED:
+        theirs.loc[1, 'rlnMicrographName'] = "it's.mrc"
+    pd.testing.assert_frame_equal(ours, theirs)
+
+
+def test_single_quotes_keep_columns(tmp_path):
+    path = str(tmp_path / 'p.star')
+    with open(path, 'w') as f:
+        f.write(QUOTED)
+    df = star.read_star(path, 'particles', numeric=True, cache=False)
+    assert list(df.columns) == ['rlnCoordinateX']
+    df = star.sample_star(path, 'particles', 2, seed=0)
+    assert df['rlnImageName'].tolist() == ['c d.mrc', 'e']
+
+
+def test_stratify_quoted(tmp_path):
+    path = str(tmp_path / 'p.star')
+    rows = ['"a b.mrc" \'c %d\' %d' % (i % 2, i) for i in range(100)]
+    with open(path, 'w') as f:
+        f.write('data_particles\n\nloop_\n_rlnMicrographName #1\n'
+                '_rlnGroupName #2\n_rlnClassNumber #3\n' + '\n'.join(rows))
+    # At least one row of each of the two groups.
+    df = star.sample_star(path, 'particles', 0.01, 'rlnGroupName', seed=0)
+    assert sorted(df['rlnGroupName']) == ['c 0', 'c 1']
@@ -0,0 +1,76 @@
+import importlib.util
+import os
+
+import pandas as pd
+import pytest
+
+from conftest import ROOT
+from utils import star
+
+spec = importlib.util.spec_from_file_location(
+    'star_handler', os.path.join(ROOT, 'src', 'cryoem-viz', 'tools',
+                                 'star_handler.py'))
+star_handler = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(star_handler)
+
+TWO_BLOCKS = '''
+data_optics
+
+loop_
+_rlnOpticsGroup #1
+_rlnVoltage #2
+%s
+
+data_particles
+
+loop_
+_rlnCoordinateX #1
+_rlnClassNumber #2
+%s
+'''
+
+
+@pytest.fixture
+def particles(tmp_path):
+    path = tmp_path / 'particles.star'
+    rows = ['%d.5 %d' % (i, i % 3 + 1) for i in range(100)]
+    path.write_text(TWO_BLOCKS % ('\n'.join(rows[:20]), '\n'.join(rows)))
+    return str(path)
+
+
+def run(**args):
+    defaults = dict(blockheader=None, key=None, select=False,
+                    equals_to=None, smaller_than=None, bigger_than=None,
+                    subset=1.0, seed=0, stratify=None, expr=None,
+                    selection=None, stream=False, chunksize=100000)
+    star_handler.main(**dict(defaults, **args))
+
+
+@pytest.mark.parametrize('subset', [0.5, 10])
+def test_subset_keeps_other_blocks(particles, tmp_path, subset):
+    out = str(tmp_path / 'out.star')
+    run(input=particles, output=out, subset=subset)
+    # The first loop block is sampled, the others are written as read.
+    blocks = star.read_star(out, cache=False)
+    assert list(blocks) == ['optics', 'particles']
+    assert 0 < len(blocks['optics']) < 20
+    assert len(blocks['particles']) == 100
+
+
+def test_copy_without_blockheader(particles, tmp_path):
+    out = str(tmp_path / 'out.star')
+    run(input=particles, output=out)
+    blocks = star.read_star(out, cache=False)
+    for name, df in star.read_star(particles, cache=False).items():
+        pd.testing.assert_frame_equal(blocks[name], df)
+
+
+def test_select_without_blockheader(particles, tmp_path):
+    out = str(tmp_path / 'out.star')
+    # The first loop block is selected from.
+    run(input=particles, output=out, expr='rlnOpticsGroup > 15')
+    blocks = star.read_star(out, cache=False)
+    assert list(blocks) == ['optics', 'particles']
+    assert blocks['optics']['rlnOpticsGroup'].tolist() == [
+        15.5, 16.5, 17.5, 18.5, 19.5]
+    assert len(blocks['particles']) == 100